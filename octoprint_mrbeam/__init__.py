@@ -57,7 +57,6 @@ from .materials import materials
 from octoprint_mrbeam.gcodegenerator.jobtimeestimation import JobTimeEstimation
 from .analytics.uploader import AnalyticsFileUploader
 from octoprint.filemanager.destinations import FileDestinations
-from octoprint_mrbeam.util.material_csv_parser import parse_csv
 from octoprint_mrbeam.util.calibration_marker import CalibrationMarker
 
 # this is a easy&simple way to access the plugin and all injections everywhere within the plugin
@@ -273,7 +272,12 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 			job_time=0.0,
 			terminal=False,
 			terminal_show_checksums=True,
+			grbl_pipelined_sending=True,  # pack as many commands as fit into grbl's rx buffer into one serial write
 			converter_min_required_disk_space=100 * 1024 * 1024,  # 100MB, in theory 371MB is the maximum expected file size for full working area engraving at highest resolution.
+			converter_raster_engine='numpy',  # 'numpy' or 'legacy', see ImageProcessor.RASTER_ENGINE_*
+			converter_cache_folder='gcode_cache',  # gcode of unchanged design elements is reused from here (.octoprint/...). Empty to disable.
+			converter_cache_max_size=50 * 1024 * 1024,  # 50MB, least recently used entries are removed
+			converter_processes=1,  # worker processes converting images and colors in parallel (forks of OctoPrint, max 2), 1 converts in this process
 			dev=dict(
 				debug=False,  # deprecated
 				terminalMaxLines=2000,
@@ -294,8 +298,13 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 				cam_analytics=False,
 				folder='analytics',  # laser job analytics base folder (.octoprint/...)
 				filename='analytics_log.json',
-				usage_filename='usage.yaml',
-				usage_backup_filename='usage_bak.yaml'
+				usage_filename='usage.yaml',  # export, usage is stored in usage_store_filename
+				usage_backup_filename='usage_bak.yaml',
+				usage_store_filename='usage.json',
+				usage_store_backup_filename='usage_bak.json',
+				usage_flush_interval=60.0,  # seconds, usage data is written at least this often while lasering
+				segment_size=256 * 1024,  # 256kB, analytics are stored in gzip'ed segments of up to this size
+				checksums_io_budget=2 * 1024 * 1024,  # bytes/s, max read rate while checksumming the software folders
 			),
 			cam=dict(
 				cam_img_width=image_default_width,
@@ -310,6 +319,8 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 				correctionTmpFile='{}/cam/last_markers.json'.format(settings().getBaseFolder('base')),
 				lensCalibrationFile='{}/cam/lens_correction_{}x{}.npz'.format(settings().getBaseFolder('base'), image_default_width, image_default_height),
 				saveCorrectionDebugImages=False,
+				frameDiffThreshold=50,  # grey levels, the picture is processed again if a tile of its thumbnail changed more
+				frameDiffTileThreshold=0.1,  # or if this fraction of the pixels of a tile changed their histogram bin
 			),
 			gcode_nextgen=dict(
 				enabled=True,
@@ -838,6 +849,24 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 		# self._logger.info("custom_material(): response: %s", data)
 		return make_response(jsonify(res), 200)
 
+	# simpleApiCommand: material_settings; GET /material_settings
+	def material_settings(self):
+		try:
+			data, etag = materials(self).get_material_settings(self.get_model_id())
+		except Exception as err:
+			self._logger.exception(err.message)
+			return make_response(err.message, 500)
+
+		if request.method == "GET" and etag in request.if_none_match:
+			r = make_response("", 304)
+		else:
+			r = make_response(data, 200)
+			r.mimetype = "application/json"
+		r.set_etag(etag)
+		# browsers have to revalidate, which is a 304 without body as long as nothing changed
+		r.headers["Cache-Control"] = "no-cache"
+		return r
+
 	# simpleApiCommand: leds;
 	def set_leds_update(self, data):
 		self._logger.info("leds() request: %s", data)
@@ -1012,6 +1041,11 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 
 	### Initial Camera Calibration - END ###
 
+	@octoprint.plugin.BlueprintPlugin.route("/material_settings", methods=["GET"])
+	@restricted_access
+	def material_settings_wrapper(self):
+		return self.material_settings()
+
 	# Laser cutter profiles
 	@octoprint.plugin.BlueprintPlugin.route("/profiles", methods=["GET"])
 	def laserCutterProfilesList(self):
@@ -1415,7 +1449,7 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 		elif command == "analytics_init":
 			return self.analytics_init(data)
 		elif command == "analytics_upload":
-			AnalyticsFileUploader.upload_now(self)
+			AnalyticsFileUploader.upload_now(self, self.analytics_handler._analytics_lock)
 			return NO_CONTENT
 		elif command == "focus_reminder":
 			return self.focus_reminder(data)
@@ -1434,12 +1468,7 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 			# TODO select which Mr Beam version to parse the materials for
 			# TODO Select "Mr Beam II" laserhead for the DreamCut Ready variant
 			# TODO ANDY Load materials when the user logs in as well
-
-			try:
-				return make_response(jsonify(parse_csv(laserhead=self.get_model_id())), 200)  # TODO : Give parse_csv the right laserhead type
-			except Exception as err:
-				self._logger.exception(err.message)
-				return make_response(err.message, 500)
+			return self.material_settings()
 		elif command == "on_camera_picture_transfer":
 			self.lid_handler.on_front_end_pic_received()
 		elif command == "leds":
@@ -1668,10 +1697,18 @@ class MrBeamPlugin(octoprint.plugin.SettingsPlugin,
 			maxWidth = profile['volume']['width']
 			maxHeight = profile['volume']['depth']
 
+			cache_dir = None
+			if self._settings.get(['converter_cache_folder']):
+				cache_dir = os.path.join(self._settings.getBaseFolder('base'), self._settings.get(['converter_cache_folder']))
+
 			# TODO implement cancelled_Jobs, to check if this particular Job has been canceled
 			# TODO implement check "_cancel_job"-loop inside engine.convert(...), to stop during conversion, too
 			engine = Converter(params, model_path, workingAreaWidth=maxWidth, workingAreaHeight=maxHeight,
-			                   min_required_disk_space=self._settings.get(['converter_min_required_disk_space']))
+			                   min_required_disk_space=self._settings.get(['converter_min_required_disk_space']),
+			                   raster_engine=self._settings.get(['converter_raster_engine']),
+			                   cache_dir=cache_dir,
+			                   cache_max_size=self._settings.get(['converter_cache_max_size']),
+			                   processes=self._settings.get_int(['converter_processes']))
 			engine.convert(is_job_cancelled, on_progress, on_progress_args, on_progress_kwargs)
 
 			is_job_cancelled()  # check if canceled during conversion
@@ -1,19 +1,15 @@
 # coding=utf-8
 
 import time
-import json
 import os.path
 import logging
-import sys
-import fileinput
 import re
 import uuid
 import collections
 
-from octoprint_mrbeam.util import json_serialisor
 from value_collector import ValueCollector
 from cpu import Cpu
-from threading import Thread, Timer, Lock
+from threading import Thread, Timer, Lock, Condition
 
 from octoprint_mrbeam.mrb_logger import mrb_logger
 from octoprint.events import Events as OctoPrintEvents
@@ -21,6 +17,7 @@ from octoprint_mrbeam.mrbeam_events import MrBeamEvents
 from analytics_keys import AnalyticsKeys as ak
 from timer_handler import TimerHandler
 from uploader import AnalyticsFileUploader
+from analytics_writer import AnalyticsFileWriter, AnalyticsSegments
 
 # singleton
 _instance = None
@@ -35,7 +32,9 @@ def analyticsHandler(plugin):
 
 class AnalyticsHandler(object):
 	QUEUE_MAXSIZE = 1000
+	COLLECTOR_PROFILE_WINDOW = 60.0  # seconds, per-minute profile of dust, intensity and laser temperature in the job summaries
 	ANALYTICS_LOG_VERSION = 11  # bumped in 0.6.7.1
+	REDACT_FILENAME_REGEX = re.compile(r"\"filename\": \"[^\"]+\"")
 
 	def __init__(self, plugin):
 		self._plugin = plugin
@@ -57,7 +56,15 @@ class AnalyticsHandler(object):
 		self.analytics_folder = os.path.join(self._settings.getBaseFolder("base"), self._settings.get(['analytics', 'folder']))
 		if not os.path.isdir(self.analytics_folder):
 			os.makedirs(self.analytics_folder)
-		self.analytics_file = os.path.join(self.analytics_folder, self._settings.get(['analytics', 'filename']))
+		analytics_filename = self._settings.get(['analytics', 'filename'])
+		self.analytics_segments = AnalyticsSegments(self.analytics_folder, analytics_filename)
+		# uncompressed analytics files of former versions
+		legacy_file = os.path.join(self.analytics_folder, analytics_filename)
+		for legacy_path in (legacy_file + '.1', legacy_file):
+			try:
+				self.analytics_segments.import_legacy_file(legacy_path)
+			except Exception as e:
+				self._logger.exception('Exception during import of analytics file {}: {}'.format(legacy_path, e))
 
 		# Session-specific data
 		self._session_id = "{uuid}@{serial}".format(serial=self._snr, uuid=uuid.uuid4().hex)
@@ -82,6 +89,13 @@ class AnalyticsHandler(object):
 
 		# Initialize queue for analytics data and queue-to-file writer
 		self._analytics_queue = collections.deque(maxlen=self.QUEUE_MAXSIZE)
+		self._analytics_queue_cond = Condition()
+		self._analytics_writer = None
+		self._max_queue_depth = 0
+		self._dropped_events = 0
+		self._file_writer = AnalyticsFileWriter(self.analytics_segments,
+		                                        self._analytics_lock,
+		                                        self._settings.get(['analytics', 'segment_size']))
 
 		# Activate analytics
 		if self.is_analytics_enabled():
@@ -104,14 +118,16 @@ class AnalyticsHandler(object):
 	def _activate_analytics(self):
 		# Restart queue if the analytics were disabled before
 		if not self._no_choice_made:
-			self._analytics_queue = collections.deque(maxlen=self.QUEUE_MAXSIZE)
+			with self._analytics_queue_cond:
+				self._analytics_queue = collections.deque(maxlen=self.QUEUE_MAXSIZE)
 		else:
 			self._no_choice_made = False
 
 		# Start writer thread
-		analytics_writer = Thread(target=self._write_queue_to_analytics_file)
-		analytics_writer.daemon = True
-		analytics_writer.start()
+		if self._analytics_writer is None or not self._analytics_writer.is_alive():
+			self._analytics_writer = Thread(target=self._write_queue_to_analytics_file, name='AnalyticsWriter')
+			self._analytics_writer.daemon = True
+			self._analytics_writer.start()
 
 	def is_analytics_enabled(self):
 		return self._analytics_enabled and not self._support_mode
@@ -132,6 +148,9 @@ class AnalyticsHandler(object):
 				# self._add_device_event(ak.Device.Event.ANALYTICS_ENABLED, payload=dict(enabled=False))
 				self._analytics_enabled = False
 				self._timer_handler.cancel_timers()
+				# let the writer thread end
+				with self._analytics_queue_cond:
+					self._analytics_queue_cond.notify()
 				self._settings.set_boolean(["analyticsEnabled"], False)
 		except Exception as e:
 			self._logger.exception('Exception during analytics_user_permission_change: {}'.format(e))
@@ -440,6 +459,7 @@ class AnalyticsHandler(object):
 			ak.Device.Cpu.THROTTLE_ALERTS: Cpu(state='shutdown', repeat=False).get_cpu_throttle_warnings(),
 		}
 		self._add_device_event(ak.Device.Event.SHUTDOWN, payload=payload)
+		self._add_log_event(ak.Log.Event.ANALYTICS_WRITER, payload=self.get_writer_stats())
 
 	def _event_slicing_started(self, event, payload):
 		self._init_new_job()
@@ -562,6 +582,7 @@ class AnalyticsHandler(object):
 
 	def _event_laser_job_finished(self, event, payload):
 		self._add_job_event(ak.Job.Event.LASERJOB_FINISHED, payload={ak.Job.STATUS: self._current_job_final_status})
+		self._add_log_event(ak.Log.Event.ANALYTICS_WRITER, payload=self.get_writer_stats())
 		self._cleanup_job()
 
 		# We have to wait until the 'laserjob_finished' line is written before we upload
@@ -649,10 +670,34 @@ class AnalyticsHandler(object):
 
 	def _add_to_queue(self, element):
 		try:
-			self._analytics_queue.append(element)
+			with self._analytics_queue_cond:
+				if len(self._analytics_queue) == self._analytics_queue.maxlen:
+					# the deque drops the oldest element
+					self._dropped_events += 1
+				self._analytics_queue.append(element)
+				self._max_queue_depth = max(self._max_queue_depth, len(self._analytics_queue))
+				self._analytics_queue_cond.notify()
 		except Exception as e:
 			self._logger.info('Exception during _add_to_queue: {}'.format(e))
 
+	def get_writer_stats(self):
+		"""
+		Queue depth and write latency of the analytics writer
+		"""
+		stats = self._file_writer.get_stats()
+		stats.update({
+			'queue_depth': len(self._analytics_queue),
+			'max_queue_depth': self._max_queue_depth,
+			'dropped_events': self._dropped_events,
+		})
+		return stats
+
+	def seal_analytics_segment(self):
+		"""
+		Seals the segment the writer is appending to, so everything written so far can be uploaded
+		"""
+		self._file_writer.seal()
+
 	# -------- COLLECTOR METHODS (COMM_ACC2) ---------------------------------------------------------------------------
 	def collect_dust_value(self, dust_value):
 		if self._current_dust_collector is not None:
@@ -676,9 +721,9 @@ class AnalyticsHandler(object):
 				self._logger.exception('Exception during collect_laser_intensity_value: {}'.format(e))
 
 	def _init_collectors(self):
-		self._current_dust_collector = ValueCollector('DustColl')
-		self._current_intensity_collector = ValueCollector('IntensityColl')
-		self._current_lasertemp_collector = ValueCollector('TempColl')
+		self._current_dust_collector = ValueCollector('DustColl', window=self.COLLECTOR_PROFILE_WINDOW)
+		self._current_intensity_collector = ValueCollector('IntensityColl', window=self.COLLECTOR_PROFILE_WINDOW)
+		self._current_lasertemp_collector = ValueCollector('TempColl', window=self.COLLECTOR_PROFILE_WINDOW)
 
 	def _add_collector_details(self):
 		lh_info = {
@@ -729,29 +774,22 @@ class AnalyticsHandler(object):
 	def _write_queue_to_analytics_file(self):
 		try:
 			while self.is_analytics_enabled():
-				if not os.path.isfile(self.analytics_file):
-					self._init_json_file()
-
-				with self._analytics_lock:
-					while self._analytics_queue:
-						with open(self.analytics_file, 'a') as f:
-							data = self._analytics_queue.popleft()
-							data_string = None
-							try:
-								data_string = json.dumps(data, sort_keys=False, default=json_serialisor) + '\n'
-							except:
-								self._logger.info('Exception during json dump in _write_queue_to_analytics_file')
-
-							if data_string:
-								f.write(data_string)
-				time.sleep(0.1)
+				with self._analytics_queue_cond:
+					if not self._analytics_queue:
+						# only wake up without new events if written data needs to be synced
+						self._analytics_queue_cond.wait(self._file_writer.sync_timeout())
+					batch = list(self._analytics_queue)
+					self._analytics_queue.clear()
+
+				if batch:
+					self._file_writer.write(batch)
+				else:
+					self._file_writer.sync_if_due()
+			self._file_writer.close()
 
 		except Exception as e:
 			self._logger.exception('Exception during _write_queue_to_analytics_file: {}'.format(e), analytics=False)
 
-	def _init_json_file(self):
-		open(self.analytics_file, 'w+').close()
-
 	# -------- INITIAL ANALYTICS PROCEDURE -----------------------------------------------------------------------------
 	def initial_analytics_procedure(self, consent):
 		if consent == 'agree':
@@ -764,6 +802,9 @@ class AnalyticsHandler(object):
 
 	def delete_analytics_files(self):
 		self._logger.info("Deleting analytics files...")
+		with self._analytics_lock:
+			self._file_writer.discard()
+			self.analytics_segments.clear()
 		folder = self.analytics_folder
 		for analytics_file in os.listdir(folder):
 			file_path = os.path.join(folder, analytics_file)
@@ -776,17 +817,18 @@ class AnalyticsHandler(object):
 
 	def process_analytics_files(self):
 		self._logger.info("Processing analytics files...")
-		folder = self.analytics_folder
-		idx = None
-		for analytics_file in os.listdir(folder):
-			file_path = os.path.join(folder, analytics_file)
+		self.seal_analytics_segment()
+		with self._analytics_lock:
+			segments = self.analytics_segments.sealed()
+		for segment in segments:
 			try:
-				if os.path.isfile(file_path) and "analytics" in analytics_file:
-					# open + remove file_names + save
-					for idx, line in enumerate(fileinput.input(file_path, inplace=1)):
-						line = re.sub(r"\"filename\": \"[^\"]+\"", "", line)
-						sys.stdout.write(line)
-					self._logger.info('File processed: {file}'.format(file=file_path))
+				# remove file_names, one streaming pass per segment
+				with self._analytics_lock:
+					self.analytics_segments.redact(segment, self._redact_line)
+				self._logger.info('File processed: {file}'.format(file=segment['name']))
 			except Exception as e:
-				self._logger.exception(
-					'Exception when processing line {line} of file {file}: {e}'.format(line=idx, file=file_path, e=e))
+				self._logger.exception('Exception when processing file {file}: {e}'.format(file=segment['name'], e=e))
+
+	@classmethod
+	def _redact_line(cls, line):
+		return cls.REDACT_FILENAME_REGEX.sub("", line)
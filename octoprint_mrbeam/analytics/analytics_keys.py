@@ -155,6 +155,7 @@ class AnalyticsKeys:
 			CAMERA = 'camera'
 			OS_HEALTH = 'os_health'
 			ANALYTICS_FILE_CROP = 'analytics_file_crop'
+			ANALYTICS_WRITER = 'analytics_writer'
 			I2C_MONITORING = 'i2c_monitoring'
 
 		class Level:
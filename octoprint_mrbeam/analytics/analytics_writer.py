@@ -0,0 +1,397 @@
+# coding=utf-8
+
+import json
+import os
+import re
+import time
+import zlib
+
+from octoprint_mrbeam.util import json_serialisor
+from octoprint_mrbeam.mrb_logger import mrb_logger
+from analytics_keys import AnalyticsKeys as ak
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+COMPRESS_LEVEL = 6
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AnalyticsSegments(object):
+	"""
+	The analytics store: gzip compressed segment files plus an index of them in the analytics folder.
+	For filename 'analytics_log.json' these are analytics_log.000001.json.gz, analytics_log.000002.json.gz, ...
+	and analytics_log.index.json.
+	Only the newest segment is open for writing (see AnalyticsFileWriter). All others are sealed: they are complete
+	gzip files which don't change anymore, except when they get redacted.
+	All methods except the constructor have to be called with the analytics lock held.
+	"""
+
+	INDEX_VERSION = 1
+
+	def __init__(self, folder, filename):
+		self._logger = mrb_logger("octoprint.plugins.mrbeam.analytics.analyticssegments")
+		self.folder = folder
+		self._root = os.path.splitext(filename)[0]
+		self._segment_regex = re.compile(r'^{}\.(\d+)\.json\.gz$'.format(re.escape(self._root)))
+		self.index_file = os.path.join(folder, '{}.index.json'.format(self._root))
+		self.segments = []
+		self._next_seq = 1
+
+		self._load_index()
+		self._recover()
+
+	def new_segment(self):
+		segment = dict(
+			name='{root}.{seq:06d}.json.gz'.format(root=self._root, seq=self._next_seq),
+			sealed=False,
+			events=0,
+			raw_size=0,
+			size=0,
+			created=time.time(),
+		)
+		self._next_seq += 1
+		self.segments.append(segment)
+		# an unsealed segment in the index is recovered after a crash
+		self._save_index()
+		return segment
+
+	def seal(self, segment, events, raw_size, size):
+		segment.update(sealed=True, events=events, raw_size=raw_size, size=size)
+		self._save_index()
+
+	def sealed(self):
+		return [s for s in self.segments if s['sealed']]
+
+	def path(self, segment):
+		return os.path.join(self.folder, segment['name'])
+
+	def total_size(self):
+		return sum(s['size'] for s in self.sealed())
+
+	def total_events(self):
+		return sum(s['events'] for s in self.sealed())
+
+	def remove(self, segment):
+		try:
+			os.remove(self.path(segment))
+		except OSError:
+			pass
+		if segment in self.segments:
+			self.segments.remove(segment)
+		self._save_index()
+
+	def crop(self, max_size):
+		"""
+		Removes the oldest sealed segments until all of them together are not bigger than max_size.
+		:return: number of removed segments
+		"""
+		removed = 0
+		for segment in self.sealed():
+			if self.total_size() <= max_size:
+				break
+			self.remove(segment)
+			removed += 1
+		return removed
+
+	def redact(self, segment, line_filter):
+		"""
+		Rewrites a sealed segment in a single streaming pass.
+		:param line_filter: function which gets every line (json string) and returns the line to keep
+		"""
+		if segment not in self.segments:
+			# uploaded in the meantime
+			return
+		lines = (line_filter(line) for line in read_segment_lines(self.path(segment)))
+		events, raw_size, size = write_segment_lines(self.path(segment), lines)
+		self.seal(segment, events, raw_size, size)
+
+	def import_legacy_file(self, path):
+		"""
+		Compresses an uncompressed analytics file (written by former versions) into a sealed segment.
+		"""
+		if not os.path.isfile(path):
+			return
+		segment = self.new_segment()
+		with open(path, 'rb') as f:
+			events, raw_size, size = write_segment_lines(self.path(segment), f)
+		self.seal(segment, events, raw_size, size)
+		if not events:
+			self.remove(segment)
+		os.remove(path)
+		self._logger.info("Imported analytics file %s into %s (%s -> %s bytes)", path, segment['name'], raw_size, size)
+
+	def clear(self):
+		for segment in list(self.segments):
+			self.remove(segment)
+
+	def _load_index(self):
+		try:
+			if os.path.isfile(self.index_file):
+				with open(self.index_file, 'r') as f:
+					index = json.load(f)
+				self.segments = index['segments']
+				self._next_seq = index['next_seq']
+		except Exception as e:
+			self._logger.warn("Can't read analytics index %s, rebuilding it: %s", self.index_file, e)
+			self.segments = []
+
+	def _save_index(self):
+		index = dict(version=self.INDEX_VERSION, next_seq=self._next_seq, segments=self.segments)
+		tmp_file = self.index_file + '.tmp'
+		with open(tmp_file, 'w') as f:
+			json.dump(index, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp_file, self.index_file)
+
+	def _recover(self):
+		# Segments which were not sealed (crash or power loss) and segment files the index doesn't know about
+		# are rewritten into proper gzip files: everything up to the last complete line is kept.
+		indexed = set()
+		for segment in list(self.segments):
+			if not os.path.isfile(self.path(segment)):
+				self.segments.remove(segment)
+				continue
+			indexed.add(segment['name'])
+			if not segment['sealed']:
+				self._recover_segment(segment)
+
+		for name in sorted(os.listdir(self.folder)):
+			match = self._segment_regex.match(name)
+			if name.startswith(self._root) and name.endswith('.tmp'):
+				# left over from an interrupted rewrite, the original is still there
+				os.remove(os.path.join(self.folder, name))
+			elif match and name not in indexed:
+				self._next_seq = max(self._next_seq, int(match.group(1)) + 1)
+				segment = dict(name=name, sealed=False, events=0, raw_size=0, size=0, created=os.path.getmtime(os.path.join(self.folder, name)))
+				self.segments.append(segment)
+				self._recover_segment(segment)
+		self.segments.sort(key=lambda s: s['name'])
+		self._save_index()
+
+	def _recover_segment(self, segment):
+		try:
+			events, raw_size, size = write_segment_lines(self.path(segment), read_segment_lines(self.path(segment)))
+			segment.update(sealed=True, events=events, raw_size=raw_size, size=size)
+			self._logger.info("Recovered analytics segment %s: %s events", segment['name'], events)
+			if not events:
+				self.remove(segment)
+		except Exception as e:
+			self._logger.exception("Can't recover analytics segment %s, removing it: %s", segment['name'], e)
+			self.remove(segment)
+
+
+def read_segment_lines(path):
+	"""
+	Yields all complete lines of a segment file, also of one which was not sealed.
+	"""
+	decompressor = zlib.decompressobj(GZIP_WBITS)
+	rest = ''
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(READ_CHUNK_SIZE)
+			if not chunk:
+				break
+			try:
+				data = decompressor.decompress(chunk)
+			except zlib.error:
+				# corrupted from here on
+				break
+			lines = (rest + data).split('\n')
+			rest = lines.pop()
+			for line in lines:
+				yield line + '\n'
+
+
+def write_segment_lines(path, lines):
+	"""
+	Compresses lines into a new segment file which replaces path once it's completely written.
+	Lines which are None or empty are skipped.
+	:return: (number of lines, uncompressed size, compressed size)
+	"""
+	compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+	events = raw_size = 0
+	tmp_file = path + '.tmp'
+	with open(tmp_file, 'wb') as f:
+		for line in lines:
+			if line:
+				events += 1
+				raw_size += len(line)
+				f.write(compressor.compress(line))
+		f.write(compressor.flush())
+		f.flush()
+		os.fsync(f.fileno())
+		size = f.tell()
+	os.rename(tmp_file, path)
+	return events, raw_size, size
+
+
+class AnalyticsFileWriter(object):
+	"""
+	Appends batches of analytics events to the open segment of the analytics store.
+	Every batch is compressed and sync-flushed into the segment file and the file is flushed to the OS while holding the
+	analytics lock, so everything written so far can be decompressed by others. The file is only fsync'ed to the SD card
+	when FSYNC_SIZE bytes were written or FSYNC_INTERVAL seconds passed since the first unsynced write.
+	When the segment gets bigger than segment_size, or when seal() is called (upload), the gzip stream is finished and
+	the segment is sealed. The next batch starts a new segment.
+	"""
+
+	WRITE_BUFFER_SIZE = 64 * 1024
+	FSYNC_SIZE = 64 * 1024
+	FSYNC_INTERVAL = 10.0
+
+	def __init__(self, segments, lock, segment_size):
+		self._logger = mrb_logger("octoprint.plugins.mrbeam.analytics.analyticswriter")
+		self.segments = segments
+		self.segment_size = segment_size
+		self._lock = lock
+		self._segment = None
+		self._file = None
+		self._compressor = None
+		self._segment_events = 0
+		self._segment_raw_size = 0
+		self._unsynced_bytes = 0
+		self._unsynced_since = None
+
+		self.events_written = 0
+		self.batches_written = 0
+		self.segments_sealed = 0
+		self.raw_bytes = 0
+		self.compressed_bytes = 0
+		self.max_batch_size = 0
+		self._write_time = 0.0
+		self.max_write_time = 0.0
+		self._latency = 0.0
+		self.max_latency = 0.0
+
+	def write(self, events):
+		"""
+		Serializes, compresses and appends the events.
+		:param events: list of analytics events (dicts)
+		"""
+		lines = []
+		for event in events:
+			try:
+				lines.append(json.dumps(event, sort_keys=False, default=json_serialisor) + '\n')
+			except:
+				self._logger.info('Exception during json dump in AnalyticsFileWriter')
+		if not lines:
+			return
+
+		start = time.time()
+		with self._lock:
+			self._open()
+			raw = ''.join(lines)
+			data = self._compressor.compress(raw) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+			self._file.write(data)
+			self._file.flush()
+			self._segment_events += len(lines)
+			self._segment_raw_size += len(raw)
+			self.raw_bytes += len(raw)
+			self.compressed_bytes += len(data)
+			self._unsynced_bytes += len(data)
+			if self._unsynced_since is None:
+				self._unsynced_since = start
+			if self._file.tell() >= self.segment_size:
+				self._seal()
+			elif self._unsynced_bytes >= self.FSYNC_SIZE:
+				self._sync()
+		end = time.time()
+
+		self.events_written += len(lines)
+		self.batches_written += 1
+		self.max_batch_size = max(self.max_batch_size, len(events))
+		self._write_time += end - start
+		self.max_write_time = max(self.max_write_time, end - start)
+		# time from the creation of the event until it's written
+		for event in events:
+			latency = end - event.get(ak.Header.TIMESTAMP, end)
+			self._latency += latency
+			self.max_latency = max(self.max_latency, latency)
+
+	def sync_timeout(self):
+		"""
+		:return: seconds until the written data needs to be synced, None if everything is synced
+		"""
+		if self._unsynced_since is None:
+			return None
+		return max(self._unsynced_since + self.FSYNC_INTERVAL - time.time(), 0)
+
+	def sync_if_due(self):
+		timeout = self.sync_timeout()
+		if timeout is not None and timeout <= 0:
+			with self._lock:
+				self._sync()
+
+	def seal(self):
+		"""
+		Seals the open segment, if there is one.
+		"""
+		with self._lock:
+			self._seal()
+
+	def close(self):
+		self.seal()
+
+	def discard(self):
+		"""
+		Closes the open segment without sealing it. Has to be called with the analytics lock held.
+		"""
+		if self._file is not None:
+			self._file.close()
+		self._file = None
+		self._compressor = None
+		self._segment = None
+		self._unsynced_bytes = 0
+		self._unsynced_since = None
+
+	def get_stats(self):
+		return {
+			'events_written': self.events_written,
+			'batches_written': self.batches_written,
+			'max_batch_size': self.max_batch_size,
+			'segments_sealed': self.segments_sealed,
+			'raw_bytes': self.raw_bytes,
+			'compressed_bytes': self.compressed_bytes,
+			'compression_ratio': float(self.raw_bytes) / self.compressed_bytes if self.compressed_bytes else None,
+			'avg_write_time': self._write_time / self.batches_written if self.batches_written else None,
+			'max_write_time': self.max_write_time,
+			'avg_latency': self._latency / self.events_written if self.events_written else None,
+			'max_latency': self.max_latency,
+		}
+
+	def _open(self):
+		if self._segment is not None and self._segment not in self.segments.segments:
+			# removed by delete_analytics_files()
+			self.discard()
+		if self._segment is None:
+			self._segment = self.segments.new_segment()
+			self._file = open(self.segments.path(self._segment), 'wb', self.WRITE_BUFFER_SIZE)
+			self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+			self._segment_events = 0
+			self._segment_raw_size = 0
+
+	def _sync(self):
+		if self._file is not None and self._unsynced_since is not None:
+			self._file.flush()
+			os.fsync(self._file.fileno())
+		self._unsynced_bytes = 0
+		self._unsynced_since = None
+
+	def _seal(self):
+		if self._segment is None:
+			return
+		self._file.write(self._compressor.flush())
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._unsynced_bytes = 0
+		self._unsynced_since = None
+		size = self._file.tell()
+		self._file.close()
+		self.segments.seal(self._segment, self._segment_events, self._segment_raw_size, size)
+		self.segments_sealed += 1
+		self._logger.debug("Sealed analytics segment %s: %s events, %s -> %s bytes",
+		                   self._segment['name'], self._segment_events, self._segment_raw_size, size)
+		self._file = None
+		self._compressor = None
+		self._segment = None
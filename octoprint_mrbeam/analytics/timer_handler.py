@@ -7,12 +7,11 @@ from threading import Timer
 
 from analytics_keys import AnalyticsKeys as ak
 from octoprint_mrbeam.mrb_logger import mrb_logger
-from octoprint_mrbeam.util.cmd_exec import exec_cmd, exec_cmd_output
+from octoprint_mrbeam.util.dir_checksum import DirChecksums
 
 
 class TimerHandler:
-	MAX_FILE_SIZE_BYTES = 50000000  # 50 MB
-	NUM_ROWS_TO_KEEP = 20000
+	MAX_FILE_SIZE_BYTES = 50000000  # 50 MB of compressed analytics segments
 
 	DISK_SPACE_TIMER = 3.0
 	NUM_FILES_TIMER = 5.0
@@ -22,6 +21,9 @@ class TimerHandler:
 	SW_AND_CHECKSUMS_TIMER = 40.0
 	FILE_CROP_TIMER = 60.0
 
+	CHECKSUMS_CACHE_FILE = 'checksums_cache.json'
+	CHECKSUMS_NICENESS = 19
+
 	SELF_CHECK_USER_AGENT = 'MrBeamPlugin self check'
 	ONLINE_CHECK_URL = 'https://find.mr-beam.org/onlinecheck'
 
@@ -60,28 +62,24 @@ class TimerHandler:
 
 	def _crop_analytics_file_if_too_big(self):
 		try:
-			if os.path.exists(self._analytics_handler.analytics_file):
-				analytics_size = os.path.getsize(self._analytics_handler.analytics_file)
+			segments = self._analytics_handler.analytics_segments
+			with self._analytics_lock:
+				analytics_size = segments.total_size()
 				if analytics_size > self.MAX_FILE_SIZE_BYTES:
-					with self._analytics_lock:
-						self._logger.info('Cropping analytics file...')
-
-						command = 'echo "$(tail -n {lines} {file})" > {file}'\
-							.format(lines=self.NUM_ROWS_TO_KEEP, file=self._analytics_handler.analytics_file)
-						success = exec_cmd(command, shell=True)
-
-						if success:
-							self._logger.info('Cropping of the analytics file finished.')
-						else:
-							self._logger.warning('Could not crop analytics file.')
+					self._logger.info('Cropping analytics files...')
+					removed = segments.crop(self.MAX_FILE_SIZE_BYTES)
+					self._logger.info('Cropping of the analytics files finished, removed %s segments.', removed)
 
 					payload = {
-						ak.Log.SUCCESS: success,
+						ak.Log.SUCCESS: True,
 						ak.Log.AnalyticsFile.PREV_SIZE: analytics_size,
-						ak.Log.AnalyticsFile.NEW_SIZE: os.path.getsize(self._analytics_handler.analytics_file),
-						ak.Log.AnalyticsFile.NUM_LINES: self.NUM_ROWS_TO_KEEP,
+						ak.Log.AnalyticsFile.NEW_SIZE: segments.total_size(),
+						ak.Log.AnalyticsFile.NUM_LINES: segments.total_events(),
 					}
-					self._plugin.analytics_handler.add_analytics_file_crop(payload)
+				else:
+					payload = None
+			if payload is not None:
+				self._plugin.analytics_handler.add_analytics_file_crop(payload)
 
 		except Exception:
 			self._logger.exception('Exception during _crop_analytics_file_if_too_big')
@@ -208,13 +206,18 @@ class TimerHandler:
 			sw_versions = self._get_software_versions()
 
 			if self._analytics_handler.is_analytics_enabled():
-				for name, conf in folders.iteritems():
-					cmd = 'find "{folder}" -type f -exec md5sum {{}} \; | sort -k 2 | md5sum'.format(folder=conf.get('src_path'))
-					out, code = exec_cmd_output(cmd, shell=True)
-					if out:
-						if name not in sw_versions:
-							sw_versions[name] = {}
-						sw_versions[name]['checksum'] = out.replace("  -", '').strip()
+				# on Linux this only affects the calling thread, which is this Timer's and ends afterwards
+				os.nice(self.CHECKSUMS_NICENESS)
+				dir_checksums = DirChecksums(
+					cache_file=os.path.join(self._analytics_handler.analytics_folder, self.CHECKSUMS_CACHE_FILE),
+					io_budget=self._plugin._settings.get_int(['analytics', 'checksums_io_budget']))
+				checksums = dir_checksums.checksums({name: conf.get('src_path') for name, conf in folders.iteritems()})
+				for name, checksum in checksums.iteritems():
+					if name not in sw_versions:
+						sw_versions[name] = {}
+					sw_versions[name]['checksum'] = checksum
+				self._logger.info("_software_versions_and_checksums: %s files, %s of them hashed",
+				                  dir_checksums.files, dir_checksums.files_hashed)
 
 			self._logger.info("_software_versions_and_checksums: %s", sw_versions)
 			self._plugin.analytics_handler.add_software_versions(sw_versions)
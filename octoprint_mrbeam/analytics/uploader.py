@@ -3,6 +3,8 @@
 import requests
 import os
 import threading
+import uuid
+from cStringIO import StringIO
 
 try:
 	from octoprint_mrbeam.mrb_logger import mrb_logger
@@ -15,6 +17,65 @@ UPLOAD_URL_TEMPLATE = "https://storage-upload.googleapis.com/{bucket}"
 DELETE_FILES_AFTER_UPLOAD = True
 
 
+class MultipartFileStream(object):
+	"""
+	multipart/form-data body with some form fields and one file which is read from disk while the request is sent,
+	instead of loading the whole file into memory like requests does for files=...
+	The file is the last part, as the storage upload requires it.
+	Pass it as data= together with the content_type header.
+	"""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, fields, name, file, content_type='application/octet-stream'):
+		self.boundary = uuid.uuid4().hex
+		self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+		head = []
+		for key, value in fields.items():
+			head.append('--{b}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.format(
+				b=self.boundary, k=self._encode(key), v=self._encode(value)))
+		head.append('--{b}\r\nContent-Disposition: form-data; name="{n}"; filename="{f}"\r\nContent-Type: {t}\r\n\r\n'.format(
+			b=self.boundary, n=name, f=os.path.basename(file), t=content_type))
+		head = ''.join(head)
+		tail = '\r\n--{b}--\r\n'.format(b=self.boundary)
+
+		self._file = open(file, 'rb')
+		self._len = len(head) + os.fstat(self._file.fileno()).st_size + len(tail)
+		self._parts = [StringIO(head), self._file, StringIO(tail)]
+
+	def __len__(self):
+		return self._len
+
+	def __iter__(self):
+		while True:
+			chunk = self.read(self.CHUNK_SIZE)
+			if not chunk:
+				break
+			yield chunk
+
+	def read(self, size=-1):
+		res = []
+		while self._parts and (size < 0 or size > 0):
+			data = self._parts[0].read(size)
+			if not data:
+				self._parts.pop(0)
+				continue
+			res.append(data)
+			if size > 0:
+				size -= len(data)
+		return ''.join(res)
+
+	def close(self):
+		self._file.close()
+
+	@staticmethod
+	def _encode(value):
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		return str(value)
+
+
 class FileUploader:
 	STATUS_INIT = 'init'
 	STATUS_VERIFY = 'verify'
@@ -121,15 +182,18 @@ class FileUploader:
 		except Exception as e:
 			raise Exception('Exception during get_token: {}'.format(e))
 
-	def _upload_file(self, token_data):
+	def _upload_file(self, token_data, content_type='application/octet-stream'):
 		self.status['state'] = self.STATUS_UPLOAD
 
 		try:
 			upload_url = UPLOAD_URL_TEMPLATE.format(bucket=token_data['bucket'])
 			post_params = token_data['request_params']
-			files = {'file': open(self.file, 'rb')}
+			body = MultipartFileStream(post_params, 'file', self.file, content_type=content_type)
 
-			r = requests.post(upload_url, data=post_params, files=files)
+			try:
+				r = requests.post(upload_url, data=body, headers={'Content-Type': body.content_type})
+			finally:
+				body.close()
 			if r.status_code not in (requests.codes.ok, requests.codes.no_content):
 				raise Exception('status_code {}'.format(r.status_code))
 
@@ -170,21 +234,68 @@ class FileUploader:
 
 
 class AnalyticsFileUploader(FileUploader):
+	"""
+	Uploads the sealed segments of the analytics store, one request per segment.
+	The analytics lock is only held to seal the open segment and to remove uploaded segments, not during the upload,
+	so the analytics writer doesn't get blocked.
+	"""
 	_instance = None
 
 	def __init__(self, plugin, analytics_lock):
 		self._settings = plugin._settings
 		self._analytics_handler = plugin.analytics_handler
+		self._segments = self._analytics_handler.analytics_segments
 
 		FileUploader.__init__(
 			self,
 			plugin,
 			directory=self._analytics_handler.analytics_folder,
-			file=self._analytics_handler.analytics_file,
+			file=None,
 			upload_type='analytics',
 			lock=analytics_lock,
 		)
 
+	def _upload_and_delete_file(self):
+		try:
+			self._logger.debug("{} upload starting...".format(self.upload_type))
+			self.status['state'] = self.STATUS_INIT
+
+			try:
+				self._analytics_handler.seal_analytics_segment()
+				with self._lock:
+					segments = self._segments.sealed()
+
+				if not segments:
+					self._unsuccessful_upload_end('No analytics segments to upload', raise_except=False)
+					return
+
+				for segment in segments:
+					self.file = self._segments.path(segment)
+					self.status['file'] = self.file
+					token_data = self.get_token()
+					self._upload_file(token_data, content_type='application/gzip')
+					with self._lock:
+						self._remove_segment(segment)
+				self._successful_upload_end()
+
+			except Exception as e:
+				self._unsuccessful_upload_end(e)
+		except Exception as e:
+			self._logger.exception('Exception during _upload_and_delete_file: {}'.format(e))
+
+	def _remove_segment(self, segment):
+		self.status['state'] = self.STATUS_REMOVE
+
+		try:
+			if self.delete_on_success:
+				self._segments.remove(segment)
+				self._logger.debug('{} removed!'.format(self.file))
+			else:
+				self._remove_file()
+				self._segments.remove(segment)
+		except Exception as e:
+			raise Exception('Exception during _remove_segment: {}'.format(e))
+
 	@staticmethod
 	def upload_now(plugin, analytics_lock):
 		try:
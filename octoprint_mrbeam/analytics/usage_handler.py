@@ -1,4 +1,6 @@
+import json
 import os
+import tempfile
 import time
 import yaml
 
@@ -16,6 +18,13 @@ def usageHandler(plugin):
 
 
 class UsageHandler(object):
+	"""
+	Usage counters are updated in memory on every progress event and stored in usage.json every usage_flush_interval
+	seconds, at the end of a job and on shutdown. Files are written to a temp file which is renamed, so a power loss
+	never leaves a half written file. usage.yaml is written at the end of a job as a human readable export;
+	it's also read once if there is no usage.json yet.
+	"""
+
 	def __init__(self, plugin):
 		self._logger = mrb_logger("octoprint.plugins.mrbeam.analytics.usage")
 		self._plugin = plugin
@@ -34,8 +43,18 @@ class UsageHandler(object):
 		analyticsfolder = os.path.join(self._settings.getBaseFolder("base"), self._settings.get(['analytics','folder']))
 		if not os.path.isdir(analyticsfolder):
 			os.makedirs(analyticsfolder)
-		self._storage_file = os.path.join(analyticsfolder, self._settings.get(['analytics','usage_filename']))
-		self._backup_file =  os.path.join(analyticsfolder, self._settings.get(['analytics','usage_backup_filename']))
+		self._storage_file = os.path.join(analyticsfolder, self._settings.get(['analytics','usage_store_filename']))
+		self._backup_file = os.path.join(analyticsfolder, self._settings.get(['analytics','usage_store_backup_filename']))
+		self._export_file = os.path.join(analyticsfolder, self._settings.get(['analytics','usage_filename']))
+		self._export_backup_file = os.path.join(analyticsfolder, self._settings.get(['analytics','usage_backup_filename']))
+		self._flush_interval = self._settings.get_float(['analytics','usage_flush_interval'])
+
+		self._dirty = False
+		self._last_flush = 0.0
+		self._flush_count = 0
+		self._flush_time = 0.0
+		self._max_flush_time = 0.0
+		self._last_flush_time = None
 
 		self._usage_data = None
 		self._load_usage_data()
@@ -76,6 +95,7 @@ class UsageHandler(object):
 		self._event_bus.subscribe(OctoPrintEvents.PRINT_CANCELLED, self.event_stop)
 		self._event_bus.subscribe(MrBeamEvents.PRINT_PROGRESS, self.event_write)
 		self._event_bus.subscribe(MrBeamEvents.LASER_HEAD_READ, self.event_laser_head_read)
+		self._event_bus.subscribe(OctoPrintEvents.SHUTDOWN, self.event_shutdown)
 
 	def event_laser_head_read(self, event, payload):
 		# Update laser head info if necessary --> Only update if there is a serial number different than the previous
@@ -96,10 +116,15 @@ class UsageHandler(object):
 	def event_write(self, event, payload):
 		if self.start_time_total >= 0:
 			self._set_time(payload['time'])
+			if event == OctoPrintEvents.PRINT_PAUSED:
+				self._write_usage_data()
+			elif time.time() - self._last_flush >= self._flush_interval:
+				self._write_usage_data()
 
 	def event_stop(self, event, payload):
 		if event == OctoPrintEvents.PRINT_DONE:
 			self._usage_data['succ_jobs']['count'] = self._usage_data['succ_jobs']['count'] + 1
+			self._dirty = True
 
 		if self.start_time_total >= 0:
 			self._set_time(payload['time'])
@@ -109,7 +134,14 @@ class UsageHandler(object):
 			self.start_time_carbon_filter = -1
 			self.start_time_gantry = -1
 			self.start_time_compressor = -1
+			self._write_usage_data(export=True)
 			self.write_usage_analytics(action='job_finished')
+		elif self._dirty:
+			self._write_usage_data(export=True)
+
+	def event_shutdown(self, event, payload):
+		if self._dirty:
+			self._write_usage_data(export=True)
 
 	def _set_time(self, job_duration):
 		if job_duration is not None and job_duration > 0.0:
@@ -121,30 +153,30 @@ class UsageHandler(object):
 
 			if self._plugin.compressor_handler.has_compressor():
 				self._usage_data['compressor']['job_time'] = self.start_time_compressor + job_duration
-			self._write_usage_data()
+			self._dirty = True
 
 	def reset_prefilter_usage(self):
 		self._usage_data['prefilter']['job_time'] = 0
 		self.start_time_prefilter = -1
-		self._write_usage_data()
+		self._write_usage_data(export=True)
 		self.write_usage_analytics(action='reset_prefilter')
 
 	def reset_carbon_filter_usage(self):
 		self._usage_data['carbon_filter']['job_time'] = 0
 		self.start_time_prefilter = -1
-		self._write_usage_data()
+		self._write_usage_data(export=True)
 		self.write_usage_analytics(action='reset_carbon_filter')
 
 	def reset_laser_head_usage(self):
 		self._usage_data['laser_head'][self._laser_head_serial]['job_time'] = 0
 		self.start_time_laser_head = -1
-		self._write_usage_data()
+		self._write_usage_data(export=True)
 		self.write_usage_analytics(action='reset_laser_head')
 
 	def reset_gantry_usage(self):
 		self._usage_data['gantry']['job_time'] = 0
 		self.start_time_prefilter = -1
-		self._write_usage_data()
+		self._write_usage_data(export=True)
 		self.write_usage_analytics(action='reset_gantry')
 
 	def _log_usage_data(self, usage_data):
@@ -165,7 +197,8 @@ class UsageHandler(object):
 					serial_number=self._laser_head_serial),
 				gantry=self._usage_data['gantry']['job_time'],
 				compressor=self._usage_data['compressor']['job_time'],
-				action=action
+				action=action,
+				flush=self.get_flush_stats(),
 			)
 
 			self._analytics_handler.add_mrbeam_usage(usage_data)
@@ -174,6 +207,15 @@ class UsageHandler(object):
 		except KeyError as e:
 			self._logger.info('Could not write analytics for usage, missing key: {e}'.format(e=e))
 
+	def get_flush_stats(self):
+		return dict(
+			count=self._flush_count,
+			interval=self._flush_interval,
+			last_time=self._last_flush_time,
+			avg_time=self._flush_time / self._flush_count if self._flush_count else None,
+			max_time=self._max_flush_time,
+		)
+
 	def get_prefilter_usage(self):
 		if 'prefilter' in self._usage_data:
 			return self._usage_data['prefilter']['job_time']
@@ -207,26 +249,35 @@ class UsageHandler(object):
 	def _load_usage_data(self):
 		success = False
 		recovery_try = False
-		if os.path.isfile(self._storage_file):
+		if os.path.isfile(self._storage_file) or os.path.isfile(self._backup_file) or not os.path.isfile(self._export_file):
+			storage_file, backup_file, load = self._storage_file, self._backup_file, json.load
+		else:
+			# stored by a former version
+			self._logger.info("Migrating usage data from %s", self._export_file)
+			storage_file, backup_file, load = self._export_file, self._export_backup_file, yaml.safe_load
+
+		if os.path.isfile(storage_file):
 			try:
 				data = None
-				with open(self._storage_file, 'r') as stream:
-					data = yaml.safe_load(stream)
+				with open(storage_file, 'r') as stream:
+					data = load(stream)
 				if self._validate_data(data):
 					self._usage_data = data
 					success = True
 					self._write_usage_data(file=self._backup_file)
+					if storage_file != self._storage_file:
+						self._write_usage_data()
 			except:
-				self._logger.error("Can't read _storage_file file: %s", self._storage_file)
+				self._logger.error("Can't read _storage_file file: %s", storage_file)
 
 		if not success:
-			self._logger.warn("Trying to recover from _backup_file file: %s", self._backup_file)
+			self._logger.warn("Trying to recover from _backup_file file: %s", backup_file)
 			recovery_try = True
-			if os.path.isfile(self._backup_file):
+			if os.path.isfile(backup_file):
 				try:
 					data = None
-					with open(self._backup_file, 'r') as stream:
-						data = yaml.safe_load(stream)
+					with open(backup_file, 'r') as stream:
+						data = load(stream)
 					if self._validate_data(data):
 						data['restored'] = data['restored'] + 1 if 'restored' in data else 1
 						self._usage_data = data
@@ -242,17 +293,44 @@ class UsageHandler(object):
 			if recovery_try:
 				self._write_usage_data()
 
-	def _write_usage_data(self, file=None):
+	def _write_usage_data(self, file=None, export=False):
+		"""
+		Writes the usage data to usage.json (or file) and, if export is set, to usage.yaml
+		"""
+		start = time.time()
 		self._usage_data['version'] = self._plugin_version
-		self._usage_data['ts'] = time.time()
+		self._usage_data['ts'] = start
 		self._usage_data['serial'] = self._device_serial
 		file = self._storage_file if file is None else file
 		try:
-			with open(file, 'w') as outfile:
-				yaml.dump(self._usage_data, outfile, default_flow_style=False)
+			self._write_file(file, json.dumps(self._usage_data, sort_keys=True))
+			if export:
+				self._write_file(self._export_file, yaml.safe_dump(self._usage_data, default_flow_style=False))
 		except:
 			self._logger.exception("Can't write file %s due to an exception: ", file)
 
+		if file == self._storage_file:
+			self._dirty = False
+			self._last_flush = time.time()
+			self._last_flush_time = self._last_flush - start
+			self._flush_count += 1
+			self._flush_time += self._last_flush_time
+			self._max_flush_time = max(self._max_flush_time, self._last_flush_time)
+
+	def _write_file(self, file, data):
+		# write a temp file next to it and rename it, so file is always either the old or the new version
+		tmp_fd, tmp_file = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(file))
+		try:
+			with os.fdopen(tmp_fd, 'w') as outfile:
+				outfile.write(data)
+				outfile.flush()
+				os.fsync(outfile.fileno())
+			os.rename(tmp_file, file)
+		except:
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+			raise
+
 	def _init_missing_usage_data(self):
 		# Initialize prefilter in case it wasn't stored already --> From the total usage
 		if 'prefilter' not in self._usage_data:
@@ -1,53 +1,240 @@
-import numpy as np
-from octoprint_mrbeam.mrb_logger import mrb_logger
+import math
+import time
+
+
+class QuantileSketch(object):
+	"""
+	Mergeable quantile sketch (KLL style compactors).
+	Level i holds up to k items, each of them stands for 2**i samples. When a level gets more, it gets sorted
+	and every other item is promoted to the next level. So memory grows only with log(count / k) and results are exact
+	as long as no more than k samples were added.
+	"""
+
+	DEFAULT_SIZE = 200
+
+	def __init__(self, k=DEFAULT_SIZE):
+		self.k = k
+		self.levels = [[]]
+		self.count = 0
+		self._offset = 0
+
+	def add(self, value):
+		level = self.levels[0]
+		level.append(value)
+		self.count += 1
+		if len(level) > self.k:
+			self._compress()
+
+	def extend(self, values):
+		self.levels[0].extend(values)
+		self.count += len(values)
+		if len(self.levels[0]) > self.k:
+			self._compress()
+
+	def merge(self, other):
+		for i, items in enumerate(other.levels):
+			if i == len(self.levels):
+				self.levels.append([])
+			self.levels[i].extend(items)
+		self.count += other.count
+		self._compress()
+
+	def is_exact(self):
+		return len(self.levels) == 1
+
+	def quantile(self, q):
+		"""
+		:param q: 0..1
+		:return: value at quantile q, interpolated like numpy.percentile() as long as the sketch is exact
+		"""
+		if not self.count:
+			return None
+		if self.is_exact():
+			items = sorted(self.levels[0])
+			pos = q * (len(items) - 1)
+			lo = int(math.floor(pos))
+			hi = min(lo + 1, len(items) - 1)
+			return items[lo] + (items[hi] - items[lo]) * (pos - lo)
+
+		weighted = sorted((value, 1 << i) for i, items in enumerate(self.levels) for value in items)
+		target = q * (sum(w for _, w in weighted) - 1)
+		rank = 0
+		for value, weight in weighted:
+			rank += weight
+			if rank > target:
+				return value
+		return weighted[-1][0]
+
+	def _compress(self):
+		i = 0
+		while i < len(self.levels):
+			items = self.levels[i]
+			if len(items) > self.k:
+				items.sort()
+				# compact an even number of items, an odd one stays on this level
+				keep = [items.pop()] if len(items) % 2 else []
+				if i + 1 == len(self.levels):
+					self.levels.append([])
+				self.levels[i + 1].extend(items[self._offset::2])
+				self._offset ^= 1
+				self.levels[i] = keep
+			i += 1
 
 
 class ValueCollector(object):
-	def __init__(self, name):
+	"""
+	Summarizes samples in constant memory: mean and std, min, max and a QuantileSketch for percentiles.
+	addValue() is called per command by the comm thread, so samples are buffered and folded into the statistics
+	in batches of BATCH_SIZE (Chan et al.).
+	If window (seconds) is given, also count/mean/min/max per time window are kept as profile of the job.
+	If there are more than max_windows of them, neighbours are merged and the window doubles.
+	"""
+
+	MAX_WINDOWS = 120
+	BATCH_SIZE = 256
+
+	def __init__(self, name, window=None, max_windows=MAX_WINDOWS):
 		self.name = name
-		self.valueList = list()
-		# self._logger = mrb_logger("octoprint.plugins.mrbeam.analyticshandler")
+		self.window = window
+		self.max_windows = max_windows
 
-	def addValue(self, value):
-		self.valueList.append(value)
+		self.count = 0
+		self.mean = 0.0
+		self._m2 = 0.0
+		self.min = None
+		self.max = None
+		self.latest = None
+		self.sketch = QuantileSketch()
+		self._pending = []
+
+		self._start_ts = None
+		# finished windows and the current one: [start offset, count, sum, min, max]
+		self._windows = []
+		self._current_window = None
+
+	def addValue(self, value, ts=None):
+		self._pending.append(value)
+		self.latest = value
+		if len(self._pending) >= self.BATCH_SIZE:
+			self._fold()
+
+		if self.window:
+			self._add_to_window(value, time.time() if ts is None else ts)
+
+	def merge(self, other):
+		"""
+		Adds the statistics of another ValueCollector. Windows are not merged.
+		"""
+		other._fold()
+		self._fold()
+		self._merge_stats(other.count, other.mean, other._m2, other.min, other.max)
+		self.latest = other.latest
+		self.sketch.merge(other.sketch)
 
 	def getSummary(self):
 		"""
-		Returns a dict with all the dust statistics
-		(mean,median,count,std,)
-		:param valueList:
+		Returns a dict with all the statistics
+		(mean,median,count,std,...) and the profile if a window is set
 		:return:
 		"""
-		count = len(self.valueList)
-		# self._logger.debug('Collector <{}> has values: {}'.format(self.name,self.valueList))
-
-		if count > 0:
-			arr = np.asarray(self.valueList)
+		self._fold()
+		if self.count > 0:
 			descDict = {
-				'median': np.median(arr),
-				'mean': np.mean(arr),
-				'min': min(self.valueList),
-				'max': max(self.valueList),
-				'25p': np.percentile(arr,25),
-				'75p': np.percentile(arr,75),
-				'std': np.std(arr),
-				'count': len(self.valueList)
+				'median': self.sketch.quantile(.5),
+				'mean': self.mean,
+				'min': self.min,
+				'max': self.max,
+				'25p': self.sketch.quantile(.25),
+				'75p': self.sketch.quantile(.75),
+				'std': math.sqrt(self._m2 / self.count),
+				'count': self.count
 			}
 		else:
-			descDict = {'count':count}
+			descDict = {'count': self.count}
 
 		# make all values float for json.dump()-compability
 		for key in descDict:
 			descDict[key] = round(descDict[key],4)
 
+		if self.window:
+			descDict['profile'] = self.getProfile()
 		return descDict
 
+	def getProfile(self):
+		"""
+		:return: list of dicts (t: start of the window in seconds since the first sample, count, mean, min, max)
+		"""
+		windows = self._windows + ([self._current_window] if self._current_window else [])
+		return [dict(t=int(w[0]), count=w[1], mean=round(w[2] / w[1], 4), min=round(w[3], 4), max=round(w[4], 4))
+		        for w in windows]
+
 	def get_latest_value(self):
 		"""
 		Returns the most recent element of the ValueCollector
 		:return:
 		"""
 		try:
-			return round(self.valueList[-1],4)
-		except: #mainly for IndexError
+			return round(self.latest,4)
+		except: #mainly for TypeError
 			return None
+
+	def _fold(self):
+		values = self._pending
+		if not values:
+			return
+		self._pending = []
+		count = len(values)
+		mean = sum(values) / float(count)
+		m2 = sum((v - mean) ** 2 for v in values)
+		self._merge_stats(count, mean, m2, min(values), max(values))
+		self.sketch.extend(values)
+
+	def _merge_stats(self, count, mean, m2, min_value, max_value):
+		if not count:
+			return
+		total = self.count + count
+		delta = mean - self.mean
+		self._m2 += m2 + delta * delta * self.count * count / float(total)
+		self.mean += delta * count / float(total)
+		self.count = total
+		self.min = min_value if self.min is None else min(self.min, min_value)
+		self.max = max_value if self.max is None else max(self.max, max_value)
+
+	def _add_to_window(self, value, ts):
+		if self._start_ts is None:
+			self._start_ts = ts
+		offset = ts - self._start_ts
+		w = self._current_window
+		if w is not None and offset < w[0] + self.window:
+			w[1] += 1
+			w[2] += value
+			w[3] = min(w[3], value)
+			w[4] = max(w[4], value)
+			return
+
+		if w is not None:
+			self._windows.append(w)
+			if len(self._windows) >= self.max_windows:
+				self._merge_windows()
+		start = offset - offset % self.window
+		if self._windows and self._windows[-1][0] == start:
+			# window just doubled by merging
+			self._current_window = self._windows.pop()
+			self._add_to_window(value, ts)
+		else:
+			self._current_window = [start, 1, value, value, value]
+
+	def _merge_windows(self):
+		self.window *= 2
+		merged = []
+		for w in self._windows:
+			start = w[0] - w[0] % self.window
+			if merged and merged[-1][0] == start:
+				m = merged[-1]
+				m[1] += w[1]
+				m[2] += w[2]
+				m[3] = min(m[3], w[3])
+				m[4] = max(m[4], w[4])
+			else:
+				merged.append([start] + w[1:])
+		self._windows = merged
@@ -4,7 +4,7 @@ import cv2, logging
 import numpy as np
 from numpy.linalg import norm
 from itertools import chain
-from threading import Event
+from threading import Event, Lock
 from abc import ABCMeta, abstractmethod
 # Python 3 : use ABC instead of ABCMeta
 
@@ -45,6 +45,16 @@ DEFAULT_STILL_RES = RESOLUTIONS['2592x1944']  # Be careful : Resolutions accepte
 # before being undistorted and served
 DIFF_TOLERANCE = 50
 
+# FrameSignature: size of the thumbnail relative to the picture, grid of tiles (rows, cols) and bins of the tile histograms
+SIGNATURE_SCALE = Fraction(1, 8)
+SIGNATURE_TILES = (4, 4)
+SIGNATURE_BINS = 16
+# fraction of the pixels of a tile that need to change their histogram bin for the tile to be seen as changed
+TILE_DIFF_TOLERANCE = .1
+
+# initial size of the JPEG buffers of the MrbPicWorker, they grow if needed
+DEFAULT_JPEG_BUFFER_SIZE = 1024 * 1024
+
 class Camera:
 	__metaclass__ = ABCMeta
 
@@ -58,6 +68,51 @@ class Camera:
 
 	pass
 
+class FrameSlot(object):
+	"""
+	One entry of the MrbPicWorker ring buffer.
+	The JPEG is written into a preallocated buffer which is reused for the following frames,
+	the decoded picture and its brightness measurements are computed on demand and cached.
+	"""
+
+	__slots__ = ('data', 'size', 'frame', 'brightness')
+
+	def __init__(self, capacity):
+		self.data = bytearray(capacity)
+		self.size = 0
+		self.frame = None
+		self.brightness = None
+
+	def reset(self):
+		self.size = 0
+		self.frame = None
+		self.brightness = None
+
+	def write(self, buf):
+		end = self.size + len(buf)
+		if end > len(self.data):
+			# grow with a new buffer, the old one might still be exported to numpy
+			data = bytearray(max(end, 2 * len(self.data)))
+			data[:self.size] = self.data[:self.size]
+			self.data = data
+		self.data[self.size:end] = buf
+		self.size = end
+
+	def jpeg(self):
+		"""The JPEG as a numpy array, sharing the memory of the buffer"""
+		return np.frombuffer(self.data, dtype=np.uint8, count=self.size)
+
+	def decode(self):
+		if self.frame is None and self.size > 0:
+			self.frame = cv2.imdecode(self.jpeg(), cv2.IMREAD_COLOR)
+		return self.frame
+
+	def get_brightness(self):
+		if self.brightness is None and self.decode() is not None:
+			self.brightness = brightness_result(self.frame)
+		return self.brightness
+
+
 class MrbPicWorker(object):
 	"""
 	The class that take care of buffering the pictures taken from the camera.
@@ -65,41 +120,36 @@ class MrbPicWorker(object):
 	to split the work on a different thread)
 	See "Advanced Recipies" in the PiCamera tutorials:
 	https://picamera.readthedocs.io/en/release-1.13/recipes2.html
+
+	The camera thread only copies the JPEG into a ring of reused buffers (maxSize finished frames
+	plus the one being written). Decoding and brightness measurements happen in the thread asking for them.
 	"""
-	def __init__(self, maxSize=3, debug=False):
+	def __init__(self, maxSize=3, debug=False, bufferSize=DEFAULT_JPEG_BUFFER_SIZE):
 		self.images = []
 		self.firstImg = True
-		self.buffers = [io.BytesIO() for _ in range(maxSize)]
-		self.bufferIndex = 0
-		self.latest = None
-		self.good_corner_bright = []
 		assert(maxSize > 0)
 		self._maxSize = maxSize
+		self.slots = [FrameSlot(bufferSize) for _ in range(maxSize + 1)]
+		self.bufferIndex = 0
+		self.nb_frames = 0
+		# protects the finished slots while they get decoded
+		self._lock = Lock()
 		self.times = []  # exposure time values
-		self.adjust_brightness = []
 		self.busy = Event()
 		self._logger = logging.getLogger("mrbeam.camera.MrbPicWorker")
 		if debug: self._logger.setLevel(logging.DEBUG)
 		else: self._logger.setLevel(logging.WARNING)
 
 	def currentBuf(self):
-		return self.buffers[self.bufferIndex]
+		return self.slots[self.bufferIndex]
 
 	def flush(self):
 		# Is called when the camera is done writing the whole image into the buffer
-		self.currentBuf().seek(0)
-		self.latest = cv2.imdecode(np.fromstring(self.currentBuf().getvalue(), np.int8),
-								   cv2.IMREAD_COLOR)
-		self.bufferIndex = (self.bufferIndex + 1) % self._maxSize
-		self.currentBuf().seek(0)
-		self.currentBuf().truncate()
-		if len(self.good_corner_bright) > self._maxSize:
-			del self.good_corner_bright[0]
-			del self.adjust_brightness[0]
-		bright_adjust, goodRois = brightness_result(self.latest)
-		self.good_corner_bright.append(goodRois)
-		self.adjust_brightness.append(bright_adjust)
-		# TODO adjust camera shutter speed with these brightness measurements
+		if self.currentBuf().size > 0:
+			with self._lock:
+				self.bufferIndex = (self.bufferIndex + 1) % len(self.slots)
+				self.currentBuf().reset()
+				self.nb_frames += 1
 		self.busy.clear()
 
 	def write(self, buf):  # (self, buf: bytearray):
@@ -107,13 +157,37 @@ class MrbPicWorker(object):
 		Write into the current buffer.
 		Will automatically change buffer when a new JPEG image is detected.
 		"""
-		if buf.startswith(b'\xff\xd8') and self.currentBuf().tell() > 0:
+		if buf.startswith(b'\xff\xd8') and self.currentBuf().size > 0:
 			# New frame; and the current buffer is not flushed.
 			self.flush()
 		# Add the buffer to the currently selected buffer
 		self.busy.set()
 		self.currentBuf().write(buf)
 
+	def _finishedSlots(self):
+		"""The slots holding a finished frame, oldest first"""
+		n = min(self.nb_frames, self._maxSize)
+		return [self.slots[(self.bufferIndex - i) % len(self.slots)] for i in range(n, 0, -1)]
+
+	@property
+	def latest(self):
+		"""The last picture taken (decoded on the first access)"""
+		with self._lock:
+			slots = self._finishedSlots()
+			return slots[-1].decode() if slots else None
+
+	def _brightness(self):
+		with self._lock:
+			return [b for b in (slot.get_brightness() for slot in self._finishedSlots()) if b is not None]
+
+	@property
+	def good_corner_bright(self):
+		return [goodRois for _, goodRois in self._brightness()]
+
+	@property
+	def adjust_brightness(self):
+		return [bright_adjust for bright_adjust, _ in self._brightness()]
+
 	def allCornersCovered(self):
 		"""Tells if the buffered pictures cumulatively offer a good brightness for each corner"""
 		# Unused atm
@@ -133,8 +207,9 @@ class MrbPicWorker(object):
 		"""Saves the last image or the n-th last buffer"""
 		# Unused atm
 		assert(0 < n <= self._maxSize)
+		slot = self._finishedSlots()[-n]
 		f = io.open(path, 'wb')
-		ret = f.write(self.buffers[-n])
+		ret = f.write(slot.data[:slot.size])
 		f.close()
 		return ret
 
@@ -229,6 +304,62 @@ def goodBrightness(img, targetAvg=128, tolerance=80):
 	else:
 		return brightness - targetAvg
 
+class FrameSignature(object):
+	"""
+	Small summary of a picture to tell cheaply if the scene changed since another picture:
+	a blurred grey thumbnail and the grey value histograms of a grid of tiles.
+	Computing it takes a single pass over the full resolution picture (the downscaling),
+	comparing two signatures only touches the thumbnails.
+	"""
+
+	def __init__(self, img, scale=SIGNATURE_SCALE, tiles=SIGNATURE_TILES, bins=SIGNATURE_BINS, blur=3):
+		h, w = img.shape[:2]
+		thumb = cv2.resize(img, (max(int(w * scale), tiles[1]), max(int(h * scale), tiles[0])), interpolation=cv2.INTER_AREA)
+		if len(thumb.shape) == 3:
+			thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+		self.thumbnail = cv2.GaussianBlur(thumb, (blur, blur), 0)
+		self.tiles = tiles
+		self.histograms = self._tile_histograms(self.thumbnail, tiles, bins)
+
+	@staticmethod
+	def _tile_histograms(gray, tiles, bins):
+		"""
+		:return: array (rows, cols, bins) with the fraction of the pixels of each tile in each bin
+		"""
+		rows, cols = tiles
+		th, tw = gray.shape[0] // rows, gray.shape[1] // cols
+		binned = (gray[:rows * th, :cols * tw] // (256 // bins)).astype(np.intp)
+		# tile index of each pixel
+		tile_idx = (np.arange(rows * th) // th)[:, None] * cols + (np.arange(cols * tw) // tw)[None, :]
+		counts = np.bincount((tile_idx * bins + binned).ravel(), minlength=rows * cols * bins)
+		return counts.reshape(rows, cols, bins) / float(th * tw)
+
+	def diff(self, other):
+		"""
+		:return: for each tile (rows x cols arrays): the highest difference between the thumbnails (grey levels)
+		         and the distance of the histograms (0: same, 1: completely different)
+		"""
+		if self.thumbnail.shape != other.thumbnail.shape or self.tiles != other.tiles:
+			return np.full(self.tiles, 255), np.ones(self.tiles)
+		rows, cols = self.tiles
+		h, w = self.thumbnail.shape[:2]
+		th, tw = h // rows, w // cols
+		absdiff = cv2.absdiff(self.thumbnail, other.thumbnail)[:rows * th, :cols * tw]
+		tile_diff = absdiff.reshape(rows, th, cols, tw).max(axis=(1, 3))
+		tile_hist_diff = np.abs(self.histograms - other.histograms).sum(axis=2) / 2
+		return tile_diff, tile_hist_diff
+
+	def changed_tiles(self, other, thresh=DIFF_TOLERANCE, tile_thresh=TILE_DIFF_TOLERANCE):
+		"""
+		:return: list of (row, col) of the tiles that changed
+		"""
+		tile_diff, tile_hist_diff = self.diff(other)
+		return map(tuple, np.argwhere((tile_diff > thresh) | (tile_hist_diff > tile_thresh)))
+
+	def changed(self, other, thresh=DIFF_TOLERANCE, tile_thresh=TILE_DIFF_TOLERANCE):
+		"""Equivalent of gaussBlurDiff()"""
+		return len(self.changed_tiles(other, thresh=thresh, tile_thresh=tile_thresh)) > 0
+
 def get_same_size(imageA, imageB, upscale=True):
 	"""
 	Resizes the smallest to fit the larger image, or the other way around if upscale is False.
@@ -16,6 +16,8 @@ import logging
 
 
 BRIGHTNESS_TOLERANCE = 80 # TODO Keep the brightness of the images tolerable
+# How often (s) threads waiting for something else check whether they should stop
+STOP_CHECK_INTERVAL = .2
 
 
 class LoopThread(threading.Thread):
@@ -24,8 +26,9 @@ class LoopThread(threading.Thread):
 	def __init__(self, target, stopFlag, args=(), kwargs=None):
 		"""
 		Loops over the target function instead of stopping
-		At the end of each loop, the self.running Event is cleared.
-		To start a new loop, set the Event again ( loopThread.running.set() )
+		At the end of each loop, the self.running Event is cleared and the self.idle Event is set.
+		To start a new loop, call loopThread.trigger()
+		The waits are not polling (timed waits poll in python 2), so call interrupt() after setting the stopFlag.
 
 		:param target: target function
 		:type target: Callable
@@ -40,6 +43,8 @@ class LoopThread(threading.Thread):
 		# self.daemon = False
 		self.running = threading.Event()
 		self.running.clear()
+		self.idle = threading.Event()
+		self.idle.clear()
 		self.stopFlag = stopFlag
 		self._logger = mrb_logger('octoprint.plugins.mrbeam.loopthread', lvl=logging.INFO)
 		self.ret = None
@@ -55,17 +60,36 @@ class LoopThread(threading.Thread):
 			self._logger.exception("mrbeam.loopthread : %s, %s", e.__class__.__name__, e)
 			raise
 
-	def _loop(self):
+	def trigger(self):
+		"""Start a new loop"""
+		self.idle.clear()
+		self.running.set()
+
+	def interrupt(self):
+		"""Wakes the loop up so it can see the stopFlag"""
 		self.running.set()
+
+	def wait_idle(self):
+		"""
+		Blocks until the current loop is done or the loop stopped.
+		:return: True if the loop is done
+		"""
+		self.idle.wait()
+		return not self.stopFlag.isSet()
+
+	def _loop(self):
+		self.trigger()
 		while not self.stopFlag.isSet():
 			try:
 				self.ret = self.t(*self.__args, **self.__kw)
 			except Exception as e:
 				self._logger.exception(" %s, %s", e.__class__.__name__, e)
+				self.idle.set()
 				raise
 			self.running.clear()
-			while not self.stopFlag.isSet() and not self.running.isSet():
-				self.running.wait(.2)
+			self.idle.set()
+			self.running.wait()
+		self.idle.set()
 
 
 class MrbCamera(PiCamera, Camera):
@@ -176,11 +200,17 @@ class MrbCamera(PiCamera, Camera):
 			self._logger.debug("Camera already running or stopEvent set")
 
 	def stop(self, timeout=None):
-		if self.captureLoop.is_alive() and not self.stopEvent.isSet():
+		if self.captureLoop.is_alive():
 			self.stopEvent.set()
-			self.captureLoop.running.clear()
+			self.captureLoop.interrupt()
 			self.captureLoop.join(timeout)
 
+	def close(self):
+		# The stopEvent might have been set by someone else, make sure the capture loop ends
+		if getattr(self, 'captureLoop', None) is not None:
+			self.stop()
+		super(MrbCamera, self).close()
+
 	def async_capture(self, *args, **kw):
 		"""
 		Starts or signals the camera to start taking a new picture.
@@ -197,18 +227,15 @@ class MrbCamera(PiCamera, Camera):
 		                  self.captureLoop.running.isSet(),
 		                  self.captureLoop.stopFlag.isSet(),
 		                  self.shutter_speed)
-		time.sleep(.1)
-		self.captureLoop.running.set()  # Asks the loop to continue running, see LoopThread
+		self.captureLoop.trigger()  # Asks the loop to continue running, see LoopThread
 
 	def wait(self):
 		"""
 		Wait for the camera to be done capturing a picture. Blocking call.
 		It is ignored when stopEvent is set.
 		"""
-		while self.captureLoop.running.isSet() or self.worker.busy.isSet():
-			if self.stopEvent.isSet(): return
-			time.sleep(.02)
-		return
+		# capture() only returns once the picture is written and flushed into the worker
+		self.captureLoop.wait_idle()
 
 	def lastPic(self):
 		"""Returns the last picture taken"""
@@ -6,7 +6,11 @@ from threading import Event
 from types import NoneType
 # from typing import Union
 from itertools import chain
+from functools import partial
 from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+import ctypes
+import threading
 from fractions import Fraction
 from numpy.linalg import norm
 
@@ -37,6 +41,8 @@ HUE_BAND_UB = 200 # if value > 180 : loops back to 0
 # TODO make scalable with picture resolution
 MIN_MARKER_PIX = 700
 MAX_MARKER_PIX = 1500
+# Size (px) of the window searched around the last known position of a marker
+TRACKING_WINDOW = 120
 
 # Height (mm) from the bottom of the work area to the camera lens.
 CAMERA_HEIGHT = 582
@@ -56,6 +62,9 @@ import numpy as np
 
 PIXEL_THRESHOLD_MIN = MIN_MARKER_PIX
 
+# remap tables, see _getUndistortMaps() and _getComposedMaps()
+_remap_cache = {'undistort': {}, 'composed': {}}
+
 
 class MbPicPrepError(Exception):
 	"""Something went wrong when undistorting and aligning the picture for the front-end"""
@@ -75,8 +84,10 @@ def prepareImage(input_image,  #: Union[str, np.ndarray],
                  blur=7,
                  custom_pic_settings=None,
                  stopEvent=None,
-                 threads=-1):
-	# type: (Union[str, np.ndarray], basestring, np.ndarray, np.ndarray, Union[Mapping, basestring], Union[dict, None], tuple, int, bool, bool, bool, int, Union[None, Mapping], Union[None, Event], int) -> object
+                 threads=-1,
+                 pool=None,
+                 tracker=None):
+	# type: (Union[str, np.ndarray], basestring, np.ndarray, np.ndarray, Union[Mapping, basestring], Union[dict, None], tuple, int, bool, bool, bool, int, Union[None, Mapping], Union[None, Event], int, Union[None, MarkerDetectionPool], Union[None, MarkerTracker]) -> object
 	"""
 	Loads image from path_to_input_image, does some preparations (undistort, warp)
 	on it and saves it to path_to_output_img.
@@ -95,6 +106,8 @@ def prepareImage(input_image,  #: Union[str, np.ndarray],
 	:param custom_pic_settings: Map : used to update certain keys of the pic settings file
 	:param stopEvent: used to exit gracefully
 	:param threads: number of threads to use for the marker detection. Set -1, 1, 2, 3 or 4. (recommended : 4, default: -1)
+	:param pool: MarkerDetectionPool to use for the marker detection. Overrides threads.
+	:param tracker: MarkerTracker of the camera session, to search the markers close to their last position first
 	"""
 	logger = logging.getLogger('mrbeam.camera.undistort')
 	if debug_out:
@@ -136,6 +149,7 @@ def prepareImage(input_image,  #: Union[str, np.ndarray],
 		raise ValueError("path_to_input_image-_in_camera_undistort_needs_to_be_a_path_(string)_or_a_numpy_array")
 
 	if debug_out: save_debug_img(img, "raw")
+	raw_img = img
 
 	if cam_dist is not None and cam_matrix is not None:
 		# undistort image with cam_params
@@ -152,7 +166,9 @@ def prepareImage(input_image,  #: Union[str, np.ndarray],
 	outputPoints = _getColoredMarkerPositions(img,
                                               debug_out_path=dbg_markers,
                                               blur=blur,
-                                              threads=threads)
+                                              threads=threads,
+                                              pool=pool,
+                                              tracker=tracker)
 	markers = {}
 	# list of missed markers
 	missed = []
@@ -205,43 +221,51 @@ def prepareImage(input_image,  #: Union[str, np.ndarray],
                  % tuple(map(np.ndarray.tolist, map(workspaceCorners.__getitem__, ['NW', 'NE', 'SW', 'SE']))))
 	if debug_out: save_debug_img(_debug_drawCorners(img, workspaceCorners), "drawcorners")
 
-	# warp image
-	warpedImg = _warpImgByCorners(img, workspaceCorners, zoomed_out)
+	# undistort, warp and resize the raw image in one go
+	if cam_dist is not None and cam_matrix is not None:
+		warpedImg = _warpAndResize(raw_img, workspaceCorners, zoomed_out, size, cam_dist, cam_matrix)
+	else:
+		warpedImg = _warpAndResize(img, workspaceCorners, zoomed_out, size)
 	if debug_out: save_debug_img(warpedImg, "colorwarp")
 
 	if stopEvent and stopEvent.isSet(): return None, markers, missed, STOP_EVENT_ERR
 
-	# resize and do NOT make greyscale, then save it
+	# do NOT make greyscale, then save it
 	# cv2.imwrite(filename=path_to_output_image,
-	#             img=cv2.resize(warpedImg, size),
+	#             img=warpedImg,
 	#             params=[int(cv2.IMWRITE_JPEG_QUALITY), quality])
-	# resize and MAKE greyscale, then save it
+	# MAKE greyscale, then save it
 	cv2.imwrite(filename=path_to_output_image,
-                img=cv2.cvtColor(cv2.resize(warpedImg, size), cv2.COLOR_BGR2GRAY),
+                img=cv2.cvtColor(warpedImg, cv2.COLOR_BGR2GRAY),
                 params=[int(cv2.IMWRITE_JPEG_QUALITY), quality])
 
 	return workspaceCorners, markers, missed, err
 
-def _getColoredMarkerPositions(img, debug_out_path=None, blur=5, threads=-1):
+def _getColoredMarkerPositions(img, debug_out_path=None, blur=5, threads=-1, pool=None, tracker=None):
 	"""Allows a multi-processing implementation of the marker detection algo. Up to 4 processes needed."""
+	start = time.time()
 	outputPoints = {}
-	# check all 4 corners
-	if threads > 0:
+	if tracker is not None:
+		outputPoints.update(tracker.track(img, blur=blur))
+	# check the corners of the markers which couldn't be tracked
+	quadrants = [qd for qd in QD_KEYS if qd not in outputPoints]
+	if len(quadrants) == 0:
+		# all markers were tracked
+		pass
+	elif pool is not None:
+		outputPoints.update(pool.detect(img, debug_out_path=debug_out_path, blur=blur, quadrants=quadrants))
+	elif threads > 0:
 		# takes around ~ 10MB RAM / thread
 		p = Pool(threads)
 		results = {}
-		brightness = None
 		for roi, pos, qd in beamcam.getRois(img):
-			brightness = np.average(roi)
-			# print("brightness of corner {} : {}".format(qd, brightness))
-			outputPoints[qd] = {'brightness': brightness} # Todo Ignore -> Tested in the MrbImgWorker
+			if qd not in quadrants:
+				continue
 			results[qd] = (p.apply_async(_getColoredMarkerPosition,
                                          args=(roi,),
                                          kwds=dict(debug_out_path=debug_out_path,
                                                    blur=blur,
                                                    quadrant=qd)), pos)
-		while not all(r.ready() for r, pos in results.values()):
-			time.sleep(.1)
 		p.close()
 		for qd, (r, pos) in results.items():
 			outputPoints[qd] = r.get()
@@ -251,18 +275,141 @@ def _getColoredMarkerPositions(img, debug_out_path=None, blur=5, threads=-1):
 
 	else:
 		for roi, pos, qd in beamcam.getRois(img):
-			brightness = np.average(roi)
-			# print("brightness of corner {} : {}".format(qd, brightness))
-			outputPoints[qd] = {'brightness': brightness}
+			if qd not in quadrants:
+				continue
 			outputPoints[qd] = _getColoredMarkerPosition(roi,
                                                          debug_out_path=debug_out_path,
                                                          blur=blur,
                                                          quadrant=qd)
 			if outputPoints[qd] is not None:
 				outputPoints[qd]['pos'] += pos
+	if tracker is not None:
+		tracker.update(outputPoints, tracked=len(QD_KEYS) - len(quadrants), detection_time=time.time() - start)
 	return outputPoints
 
-def _getColoredMarkerPosition(roi, debug_out_path=None, blur=5, quadrant=None, d_min=8, d_max=30, visual_debug=False):
+class MarkerTracker(object):
+	"""
+	Remembers where and with which threshold each marker was found on the last picture.
+	The markers barely move between two pictures, so they are searched in a small window around that
+	position first, with the threshold that worked last time. Only the lost markers get searched in the whole corner.
+	Also counts tracked / fully searched markers and the detection time for the camera session analytics.
+	"""
+
+	def __init__(self, window=TRACKING_WINDOW):
+		self.window = window
+		self.last = {}
+		self.tracked = 0
+		self.full_search = 0
+		self.detections = 0
+		self.detection_time = 0.0
+		self.max_detection_time = 0.0
+
+	def reset(self):
+		"""Forget the last positions, e.g. after a new calibration"""
+		self.last = {}
+
+	def track(self, img, blur=5):
+		"""
+		:return: {qd: marker} for the markers found in the window around their last position
+		"""
+		found = {}
+		half = self.window // 2
+		for qd, last in self.last.items():
+			row, col = np.round(last['pos']).astype(int)
+			top, left = max(row - half, 0), max(col - half, 0)
+			window = img[top:row + half, left:col + half]
+			if window.shape[0] <= blur or window.shape[1] <= blur:
+				continue
+			marker = _getColoredMarkerPosition(window, blur=blur, quadrant=qd, thresh=last['thresh'])
+			if marker is not None:
+				marker['pos'] += np.array([top, left])
+				found[qd] = marker
+		return found
+
+	def update(self, outputPoints, tracked, detection_time):
+		for qd, marker in outputPoints.items():
+			if marker is None:
+				self.last.pop(qd, None)
+			else:
+				self.last[qd] = marker
+		self.tracked += tracked
+		self.full_search += len(outputPoints) - tracked
+		self.detections += 1
+		self.detection_time += detection_time
+		self.max_detection_time = max(self.max_detection_time, detection_time)
+
+	def get_stats(self):
+		searched = self.tracked + self.full_search
+		return {'tracked': self.tracked,
+		        'full_search': self.full_search,
+		        'track_rate': float(self.tracked) / searched if searched else None,
+		        'avg_detection_time': self.detection_time / self.detections if self.detections else None,
+		        'max_detection_time': self.max_detection_time if self.detections else None}
+
+class MarkerDetectionPool(object):
+	"""
+	Worker processes for the marker detection that stay alive during the whole camera session,
+	instead of forking a new Pool for every picture.
+	The ROIs are handed over to the workers through shared memory allocated before forking,
+	so only their shape goes through the pipe. ROIs bigger than img_shape would give are pickled as usual.
+	"""
+
+	def __init__(self, processes=4, img_shape=beamcam.LEGACY_STILL_RES[::-1] + (3,)):
+		self._logger = logging.getLogger('mrbeam.camera.MarkerDetectionPool')
+		self._lock = threading.Lock()
+		self._slot_size = max(roi.nbytes for roi, _, _ in beamcam.getRois(np.empty(img_shape, dtype=np.uint8)))
+		self._shared_rois = {qd: RawArray(ctypes.c_uint8, self._slot_size) for qd in QD_KEYS}
+		self._pool = Pool(processes, initializer=_initMarkerWorker, initargs=(self._shared_rois,))
+		self._logger.debug("Started %s marker detection workers, %s bytes of shared memory per ROI", processes, self._slot_size)
+
+	def detect(self, img, debug_out_path=None, blur=5, quadrants=QD_KEYS):
+		"""
+		Detects the markers in the given corners of img.
+		:return: same as _getColoredMarkerPositions()
+		"""
+		# the shared memory can only hold one picture at a time
+		with self._lock:
+			outputPoints = {}
+			results = []
+			for roi, pos, qd in beamcam.getRois(img):
+				if qd not in quadrants:
+					continue
+				kwds = dict(debug_out_path=debug_out_path, blur=blur, quadrant=qd)
+				if roi.dtype == np.uint8 and roi.nbytes <= self._slot_size:
+					_sharedRoi(self._shared_rois[qd], roi.shape)[...] = roi
+					func, args = _getColoredMarkerPositionShared, (roi.shape,)
+				else:
+					func, args = _getColoredMarkerPosition, (roi,)
+				results.append(self._pool.apply_async(func, args, kwds,
+				                                      callback=partial(_addMarkerResult, outputPoints, qd, pos)))
+			for r in results:
+				# blocks until the callback is done, raises the exceptions of the workers
+				r.get()
+			return outputPoints
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+# shared memory of a marker detection worker process, see MarkerDetectionPool
+_shared_rois = None
+
+def _initMarkerWorker(shared_rois):
+	global _shared_rois
+	_shared_rois = shared_rois
+
+def _sharedRoi(buf, shape):
+	return np.frombuffer(buf, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+
+def _getColoredMarkerPositionShared(shape, quadrant=None, **kw):
+	return _getColoredMarkerPosition(_sharedRoi(_shared_rois[quadrant], shape), quadrant=quadrant, **kw)
+
+def _addMarkerResult(outputPoints, qd, pos, result):
+	if result is not None:
+		result['pos'] += pos
+	outputPoints[qd] = result
+
+def _getColoredMarkerPosition(roi, debug_out_path=None, blur=5, quadrant=None, d_min=8, d_max=30, visual_debug=False, thresh=None):
 	"""
 	Tries to find a single pink marker inside the image (or the Region of Interest).
 	It then outputs the information about found marker (for now, just its center position).
@@ -278,8 +425,10 @@ def _getColoredMarkerPosition(roi, debug_out_path=None, blur=5, quadrant=None, d
 	:type d_min: int
 	:param d_max: maximal diameter of the *outer* (distorted) marker edge
 	:type d_max: int
-	:return:
-	:rtype:
+	:param thresh: threshold of the green channel. Determined with Otsu's method if None.
+	:type thresh: Union[None, float]
+	:return: dict with the position of the marker and the threshold used
+	:rtype: Union[None, dict]
 	"""
 	# Smooth out picture
 	roiBlur = cv2.GaussianBlur(roi, (blur, blur), 0)
@@ -288,11 +437,14 @@ def _getColoredMarkerPosition(roi, debug_out_path=None, blur=5, quadrant=None, d
 	greenBlur = cv2.transform(roiBlur, transformToGreen)
 	# if visual_debug: debugShow(greenBlur, "green")
 	# Threshold the green channel
-	ret, threshOtsuMask = cv2.threshold(greenBlur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+	if thresh is None:
+		thresh, threshOtsuMask = cv2.threshold(greenBlur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+	else:
+		thresh, threshOtsuMask = cv2.threshold(greenBlur, thresh, 255, cv2.THRESH_BINARY_INV)
 	blocksize = 11
 	gaussianMask = cv2.adaptiveThreshold(greenBlur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, blocksize, 2)
 	roiBlurThresh         =  cv2.bitwise_and( roiBlur, roiBlur, mask=cv2.bitwise_or(threshOtsuMask, gaussianMask))
-	debug_quad_path = debug_out_path.replace('.jpg', '{}.jpg'.format(quadrant))
+	debug_quad_path = debug_out_path.replace('.jpg', '{}.jpg'.format(quadrant)) if debug_out_path else None
 	for spot, center, start, stop in _get_white_spots(cv2.bitwise_or(threshOtsuMask, gaussianMask)):
 		spot.dtype = np.uint8
 		if visual_debug: cv2.imshow("{} : spot".format(quadrant), cv2.imdecode(np.fromiter(spot, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)); cv2.waitKey(0)
@@ -301,11 +453,13 @@ def _getColoredMarkerPosition(roi, debug_out_path=None, blur=5, quadrant=None, d
 			avg_hue = np.average([roiBlurThresh[pos] for pos in np.nonzero(cv2.bitwise_and(hue_vals, hue_vals, mask=spot))])
 			if HUE_BAND_LB <= avg_hue <= 180 or 0 <= avg_hue <= HUE_BAND_UB:
 				y, x = np.round(center).astype("int")  # y, x
-				debug_roi = cv2.drawMarker(cv2.cvtColor(cv2.bitwise_or(threshOtsuMask, gaussianMask), cv2.COLOR_GRAY2BGR), (x, y), (0, 0, 255), cv2.MARKER_CROSS, line_type=4)
-				cv2.imwrite(debug_quad_path, debug_roi, params=[cv2.IMWRITE_JPEG_QUALITY, 100])
-				return dict(pos=center, )
+				if debug_quad_path:
+					debug_roi = cv2.drawMarker(cv2.cvtColor(cv2.bitwise_or(threshOtsuMask, gaussianMask), cv2.COLOR_GRAY2BGR), (x, y), (0, 0, 255), cv2.MARKER_CROSS, line_type=4)
+					cv2.imwrite(debug_quad_path, debug_roi, params=[cv2.IMWRITE_JPEG_QUALITY, 100])
+				return dict(pos=center, thresh=thresh)
 	# No marker found
-	cv2.imwrite(debug_quad_path, roiBlurThresh)
+	if debug_quad_path:
+		cv2.imwrite(debug_quad_path, roiBlurThresh)
 	return None
 
 def isMarkerMask(mask, d_min=10, d_max=60, visual_debug=False):
@@ -451,11 +605,73 @@ def _inRange(img, lb, ub, colortype='hsv'):
 def _undistortImage(img, dist, mtx):
 	"""Apply the camera calibration matrices to distort the picture back straight"""
 	h, w = img.shape[:2]
-	newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w, h), 1, (w, h))
+	maps = _getUndistortMaps(dist, mtx, (w, h))
+	return cv2.remap(img, maps['fixed'][0], maps['fixed'][1], cv2.INTER_LINEAR)
 
-	# undistort image
-	mapx, mapy = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, (w, h), 5)
-	return cv2.remap(img, mapx, mapy, cv2.INTER_LINEAR)
+def _getUndistortMaps(dist, mtx, size):
+	"""
+	Returns the remap tables to undistort pictures of the given size (w, h).
+	They only depend on the lens calibration, so they are computed once and cached until clearRemapCache() is called.
+	:return: dict with 'fixed' : maps converted to fixed point (CV_16SC2) for a fast remap,
+	                   'float' : the maps as computed by cv2 (CV_32FC1), used to compose other transformations
+	"""
+	dist, mtx = np.asarray(dist), np.asarray(mtx)
+	key = (mtx.tobytes(), dist.tobytes(), tuple(size))
+	maps = _remap_cache['undistort'].get(key)
+	if maps is None:
+		newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, size, 1, size)
+		mapx, mapy = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, size, cv2.CV_32FC1)
+		maps = {'float': (mapx, mapy),
+		        'fixed': cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)}
+		_remap_cache['undistort'] = {key: maps}
+	return maps
+
+def _getComposedMaps(dist, mtx, img_size, corners, zoomed_out, size):
+	"""
+	Returns the fixed point remap tables for undistort -> warp by corners -> resize to `size`,
+	to be applied to the raw picture in a single cv2.remap.
+	The last tables are cached, the markers (and thus the corners) don't move as long as the camera doesn't.
+	"""
+	undistort_maps = _getUndistortMaps(dist, mtx, img_size)
+	key = (tuple(tuple(np.asarray(corners[qd]).tolist()) for qd in QD_KEYS), zoomed_out, tuple(size))
+	maps = _remap_cache['composed'].get(key)
+	if maps is None or maps['undistort'] is not undistort_maps:
+		transMatrix = _composedWarpMatrix(corners, zoomed_out, size)
+		# warping the undistort tables gives, for each pixel of the output picture, its position in the raw picture
+		mapx, mapy = [cv2.warpPerspective(m, transMatrix, tuple(size), flags=cv2.INTER_LINEAR,
+		                                  borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+		              for m in undistort_maps['float']]
+		maps = {'undistort': undistort_maps,
+		        'fixed': cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)}
+		_remap_cache['composed'] = {key: maps}
+	return maps['fixed']
+
+def _composedWarpMatrix(corners, zoomed_out, size):
+	"""Perspective transform of _warpImgByCorners() followed by the cv2.resize() to `size`"""
+	transMatrix, dst_size = _getWarpParams(corners, zoomed_out)
+	# cv2.resize maps the pixel centers onto each other
+	sx, sy = float(size[0]) / dst_size[0], float(size[1]) / dst_size[1]
+	resizeMatrix = np.array([[sx, 0, (sx - 1) / 2],
+	                         [0, sy, (sy - 1) / 2],
+	                         [0, 0, 1]])
+	return resizeMatrix.dot(transMatrix)
+
+def _warpAndResize(img, corners, zoomed_out, size, dist=None, mtx=None):
+	"""
+	Same result as cv2.resize(_warpImgByCorners(_undistortImage(img, dist, mtx), corners, zoomed_out), size),
+	but with a single interpolation step.
+	:param img: the raw picture. If dist or mtx are None, the picture is supposed to be undistorted already.
+	"""
+	if dist is None or mtx is None:
+		return cv2.warpPerspective(img, _composedWarpMatrix(corners, zoomed_out, size), tuple(size))
+	h, w = img.shape[:2]
+	map1, map2 = _getComposedMaps(dist, mtx, (w, h), corners, zoomed_out, size)
+	return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+def clearRemapCache():
+	"""Forget the cached remap tables, e.g. after a new lens or picture calibration"""
+	_remap_cache['undistort'] = {}
+	_remap_cache['composed'] = {}
 
 def _warpImgByCorners(image, corners, zoomed_out=False):
 	"""
@@ -465,6 +681,15 @@ def _warpImgByCorners(image, corners, zoomed_out=False):
 	:param zoomed_out: wether to zoom out the pic to account for object height
 	:return: image with corners warped
 	"""
+	transMatrix, dst_size = _getWarpParams(corners, zoomed_out)
+	# compute warped image
+	warpedImg = cv2.warpPerspective(image, transMatrix, dst_size)
+	return warpedImg
+
+def _getWarpParams(corners, zoomed_out=False):
+	"""
+	:return: perspective transform matrix and output size of _warpImgByCorners()
+	"""
 
 	def f(qd):
 		return np.array(corners[qd])
@@ -506,10 +731,7 @@ def _warpImgByCorners(image, corners, zoomed_out=False):
 
 	# get the perspective transform matrix
 	transMatrix = cv2.getPerspectiveTransform(src, dst)
-
-	# compute warped image
-	warpedImg = cv2.warpPerspective(image, transMatrix, dst_size)
-	return warpedImg
+	return transMatrix, dst_size
 
 def _get_white_spots(mask, min_pix=MIN_MARKER_PIX, max_pix=MAX_MARKER_PIX):
 	"""Iterates over the white connected spots on the picture (aka white blobs)"""
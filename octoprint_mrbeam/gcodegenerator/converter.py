@@ -3,7 +3,10 @@ import re
 import shutil
 import os
 import time
+import tempfile
+import collections
 import machine_settings
+from multiprocessing import Pool, cpu_count
 
 from biarc import biarc
 from point import Point
@@ -14,11 +17,20 @@ import simpletransform
 import cubicsuperpath
 
 from profiler import Profiler
+from path_order import PathOrderOptimizer
+from gcode_cache import GcodeCache
 from img2gcode import ImageProcessor
 from svg_util import get_path_d, _add_ns, unittouu
 
 from lxml import etree
 
+# Converter instance of the running conversion, inherited by the forked worker processes
+_pool_converter = None
+
+def _convert_unit_in_worker(idx):
+	return _pool_converter._convert_unit(idx)
+
+
 class Converter():
 
 	PLACEHOLDER_LASER_ON  = ";_laseron_"
@@ -50,12 +62,18 @@ class Converter():
 
 	_tempfile = "/tmp/_converter_output.tmp"
 
-	def __init__(self, params, model_path, workingAreaWidth = None, workingAreaHeight = None, min_required_disk_space=0):
+	# part of all gcode cache keys, increase if the generated gcode of an unchanged element changes
+	_cache_version = 1
+
+	# every worker is a fork of the whole OctoPrint process
+	MAX_PROCESSES = 2
+
+	def __init__(self, params, model_path, workingAreaWidth = None, workingAreaHeight = None, min_required_disk_space=0, raster_engine=None, processes=None, cache_dir=None, cache_max_size=50*1024*1024):
 		self._log = logging.getLogger("octoprint.plugins.mrbeam.converter")
 		self.workingAreaWidth = workingAreaWidth
 		self.workingAreaHeight = workingAreaHeight
 		self.optimize_path_order = True
-		self.optimize_max_paths = 500
+		self.optimize_2opt_window = 8 # max paths reversed in one 2-opt move after nearest neighbour sorting, 0 disables 2-opt
 
 		# debugging
 		self.transform_matrix = {}
@@ -70,6 +88,11 @@ class Converter():
 		self.svg_file = model_path
 		self.document=None
 		self._min_required_disk_space = min_required_disk_space
+		self._raster_engine = raster_engine
+		self._processes = max(1, min(processes or 1, self.MAX_PROCESSES, cpu_count()))
+		self._units = []
+		self._parts_dir = None
+		self._cache = GcodeCache(cache_dir, cache_max_size) if cache_dir else None
 		self._log.info('Converter Initialized: %s', self.options)
 		# todo need material,bounding_box_area here
 		self._add_conversion_details_analytics()
@@ -150,6 +173,17 @@ class Converter():
 			msg ="Only " + self._get_human_readable_bytes(totalAvailSpaceNonRoot) + " disk space available. Min required: " + self._get_human_readable_bytes(self._min_required_disk_space)
 			raise OutOfSpaceException(msg)
 
+	def check_free_space_for_part(self, part_file):
+		"""
+		The gcode of a unit exists twice while its part file gets appended to the output.
+		"""
+		disk = os.statvfs(os.path.dirname(self._tempfile))
+		availSpaceNonRoot = float(disk.f_bsize * disk.f_bavail)
+		part_size = os.path.getsize(part_file)
+		if availSpaceNonRoot < part_size:
+			msg = "Only " + self._get_human_readable_bytes(availSpaceNonRoot) + " disk space available. Required to merge " + os.path.basename(part_file) + ": " + self._get_human_readable_bytes(part_size)
+			raise OutOfSpaceException(msg)
+
 	def _get_human_readable_bytes(self, amount):
 		str = "%d Bytes" % amount
 		if(amount > 1024 and amount <= 1024*1024): # kB
@@ -221,207 +255,366 @@ class Converter():
 
 			fh.write(self._get_gcode_header())
 
-			# images
-			profiler.stop('write_gco_header').start('s5_images')
+			# images and paths are split into independent units, which are converted in parallel
+			# and concatenated in the order of self._units.
+			profiler.stop('write_gco_header').start('s5_collect_units')
+			self._units = []
 			self._log.info( 'Raster conversion: %s' % self.options['engrave'])
-			for layer in self.layers :
-				if layer in self.images and self.options['engrave']:
-					for imgNode in self.images[layer] :
-						file_id = imgNode.get('data-serveurl', '')
-						x = imgNode.get('x')
-						y = imgNode.get('y')
-						if x is None:
-							x = "0"
-						if y is None:
-							y = "0"
-
-						# pt units
-						x = float(x)
-						y = float(y)
-						w = float(imgNode.get("width"))
-						h = float(imgNode.get("height"))
-
-						_upperLeft = [x, y]
-						_lowerRight = [x + w, y + h]
-
-						# apply svg transforms
-						_mat = self._get_transforms(imgNode)
-						simpletransform.applyTransformToPoint(_mat, _upperLeft)
-						simpletransform.applyTransformToPoint(_mat, _lowerRight)
-
-						### original style with orientation points :( ... TODO
-						# mm conversion
-						upperLeft = self._transform(_upperLeft,layer, False)
-						lowerRight = self._transform(_lowerRight,layer, False)
-
-						w = abs(lowerRight[0] - upperLeft[0])
-						h = abs(lowerRight[1] - upperLeft[1])
-
-						# contrast = 1.0, sharpening = 1.0, beam_diameter = 0.25,
-						# intensity_black = 1000, intensity_white = 0, speed_black = 30, speed_white = 500,
-						# dithering = True, pierce_time = 500, separation = True, material = "default"
-						rasterParams = self.options['raster']
-						ip = ImageProcessor(output_filehandle = fh,
-											workingAreaWidth = self.workingAreaWidth,
-											workingAreaHeight = self.workingAreaHeight,
-						                    beam_diameter = rasterParams['beam_diameter'],
-						                    backlash_x = _mrbeam_plugin_implementation._settings.get(["machine", "backlash_compensation_x"]),
-						                    overshoot_distance = 1,
-											intensity_black = rasterParams['intensity_black'],
-											intensity_white = rasterParams['intensity_white'],
-											intensity_black_user = rasterParams['intensity_black_user'],
-											intensity_white_user = rasterParams['intensity_white_user'],
-											speed_black = rasterParams['speed_black'],
-											speed_white = rasterParams['speed_white'],
-											dithering = rasterParams['dithering'],
-											pierce_time = rasterParams['pierce_time'],
-											engraving_mode = rasterParams['engraving_mode'],
-											eng_compressor = rasterParams['eng_compressor'],
-											material = self.options['material'])
-											# material = rasterParams['material'] if 'material' in rasterParams else None)
-						data = imgNode.get('href')
-						if(data is None):
-							data = imgNode.get(_add_ns('href', 'xlink'))
-
-						if(data.startswith("data:")):
-							ip.dataUrl_to_gcode(data, w, h, upperLeft[0], lowerRight[1], file_id)
-						elif(data.startswith("http://")):
-							ip.imgurl_to_gcode(data, w, h, upperLeft[0], lowerRight[1], file_id)
-						else:
-							self._log.error("Unable to parse img data", data)
-
-						profiler.nest_data(ip.get_profiler())
-
-						processedItemCount += 1
-						report_progress(on_progress, on_progress_args, on_progress_kwargs, processedItemCount, itemAmount)
-					else:
-						self._log.info("postponing non-image layer %s" % ( layer.get('id') ))
+			self._collect_image_units()
+			self._log.info( 'Vector conversion: %s paths' % len(self.paths))
+			self._collect_vector_units(profiler)
 
-			profiler.stop('s5_images').start('s6_vectors')
+			itemAmount = 1 + sum(unit['item_count'] for unit in self._units)
 
-			# paths
-			self._log.info( 'Vector conversion: %s paths' % len(self.paths))
+			profiler.stop('s5_collect_units').start('s6_convert_units')
+			# next to the output, so min_required_disk_space covers both. Parts are removed as soon as they're merged.
+			self._parts_dir = tempfile.mkdtemp(prefix="_converter_parts_", dir=os.path.dirname(self._tempfile))
+			pool = self._start_pool()
+			try:
+				for unit, part_file, unit_profiler, cache_stats in self._convert_units(pool, is_job_cancelled):
+					self.check_free_space_for_part(part_file)
+					with open(part_file, 'r') as part_fh:
+						shutil.copyfileobj(part_fh, fh)
+					os.remove(part_file)
+					if unit_profiler is not None:
+						profiler.nest_data(unit_profiler)
+					if self._cache is not None:
+						profiler.add_value('gcode_cache_hits', cache_stats[0])
+						profiler.add_value('gcode_cache_misses', cache_stats[1])
+
+					processedItemCount += unit['item_count']
+					report_progress(on_progress, on_progress_args, on_progress_kwargs, processedItemCount, itemAmount)
+			finally:
+				# stops the worker processes, also if the job got cancelled or failed
+				self._stop_pool(pool)
+				shutil.rmtree(self._parts_dir, ignore_errors=True)
 
-			for layer in self.layers :
-				if layer in self.paths :
-					paths_by_color = dict()
-					for path in self.paths[layer] :
-						self._log.info("path %s, %s, stroke: %s, fill: %s, mb:gc: %s" % ( layer.get('id', None), path.get('id', None), path.get('stroke', None), path.get('class', None), path.get(_add_ns('gc', 'mb'), '')[:100]))
-
-						strokeInfo = self._get_stroke(path)
-						if(strokeInfo['visible'] == False):
-							continue
-
-						stroke = strokeInfo['color']
-						if "d" not in path.keys() :
-							self._log.error("Warning: One or more paths don't have 'd' parameter")
-							continue
-						if stroke not in paths_by_color.keys() and stroke != 'default':
-							paths_by_color[stroke] = []
-						d = path.get("d")
-						if d != '':
-							paths_by_color[stroke].append(path)# += path
-							processedItemCount += 1
-							report_progress(on_progress, on_progress_args, on_progress_kwargs, processedItemCount, itemAmount)
-
-					layerId = layer.get('id', '?')
-					pathId = path.get('id', '?')
-
-					# path_sorting: set initial laser pos, assuming pleasant left to right, bottom to top processing order
-					current_x = 0
-					current_y = 0
-
-					#for each color generate GCode
-					for colorKey in self.colorOrder:
-						if colorKey == 'none':
-							continue
-
-						settings = self.colorParams.get(colorKey, {'intensity': -1, 'feedrate': -1, 'passes': 0, 'pierce_time': 0, 'cut_compressor': 100})
-						if(settings['feedrate'] == None or settings['feedrate'] == -1 or settings['intensity'] == None or settings['intensity'] <= 0):
-							self._log.info( "convert() skipping color %s, no valid settings %s." % (colorKey, settings))
-							continue
-
-						if(not colorKey in paths_by_color):
-							self._log.info( "convert() skipping color %s, no paths with this color (clipped? path in <defs>?. " % (colorKey))
-							continue
-
-						# gcode_before_job
-						fh.write(machine_settings.gcode_before_job(color=colorKey, compressor=settings.get('cut_compressor', '100')))
-
-						self._log.info( "convert() path sorting active: %s, path size %i below maximum %i." % (self.optimize_path_order, len(paths_by_color[colorKey]), self.optimize_max_paths))
-						# if this O(n^2) algorithm blows performance, limit inner loop to just search within the first 100 items.
-						while len(paths_by_color[colorKey]) > 0:
-							path_sorting = self.optimize_path_order and (len(paths_by_color[colorKey]) < self.optimize_max_paths)
-							# pick closest starting point to (current_x, current_y)
-							closestPath = None
-							if(path_sorting):
-								dist = float('inf')
-								for p in paths_by_color[colorKey]:
-									start_x = p.get(_add_ns('start_x', 'mb'), None)
-									start_y = p.get(_add_ns('start_y', 'mb'), None)
-
-									if(start_x != None and start_y != None):
-										d = pow(float(start_x) - current_x, 2) + pow(float(start_y) - current_y, 2)
-										if(d < dist):
-											dist = d
-											closestPath = p
-
-							path = None
-							if(closestPath != None):
-								path = closestPath
-							else:
-								path = paths_by_color[colorKey][0]
-
-							# process next / closest path...
-							curveGCode = ""
-							mbgc = path.get(_add_ns('gc', 'mb'), None)
-							if(mbgc != None):
-								curveGCode = self._use_embedded_gcode(mbgc)
-							else:
-								d = path.get('d')
-								csp = cubicsuperpath.parsePath(d)
-								csp = self._apply_transforms(path, csp)
-								curve = self._parse_curve(csp, layer)
-								curveGCode = self._generate_gcode(curve)
-
-
-							fh.write("; Layer:" + layerId + ", outline of:" + pathId + ", stroke:" + colorKey +', '+str(settings)+"\n")
-							ity = settings['intensity']
-							pt = settings['pierce_time']
-							fr = int(settings['feedrate'])
-							passes = int(settings['passes'])
-							for p in range(0, passes):
-								if settings.get('progressive', False):
-									f = round(fr * (1 - 0.5 * p/(passes - 1)))
-								else:
-									f = fr
-								fh.write("; pass:%i/%s\n" % (p+1, settings['passes']))
-								# TODO tbd DreamCut different for each pass?
-								gc = self._replace_params_gcode(curveGCode, colorKey, f, ity, pt)
-								fh.write(gc)
-
-							# set current position after processing the path
-							end_x = path.get(_add_ns('end_x', 'mb'), None)
-							end_y = path.get(_add_ns('end_y', 'mb'), None)
-							if(end_x != None and end_y != None):
-								current_x = float(end_x)
-								current_y = float(end_y)
-
-							# finally removed processed path
-							paths_by_color[colorKey].remove(path)
-
-						# TODO check if _after_job should be one(two?) levels less indented
-						# gcode_after_job
-						fh.write(machine_settings.gcode_after_job(color=colorKey))
 			fh.write(self._get_gcode_footer())
 
-		profiler.stop('s6_vectors').start('s7_export')
+		profiler.stop('s6_convert_units').start('s7_export')
 		self.export_gcode()
 		profiler.stop('s7_export')
+		if self._cache is not None:
+			profiler.start('s8_cache_eviction')
+			self._cache.evict()
+			profiler.stop('s8_cache_eviction')
 		summary = profiler.finalize().getShortSummary()
 		self._log.info("conversion finished. Timing: %s", summary)
 
 
+	def _collect_image_units(self):
+		for layer in self.layers :
+			if layer in self.images and self.options['engrave']:
+				for imgNode in self.images[layer] :
+					self._units.append({'type': 'image', 'layer': layer, 'node': imgNode, 'item_count': 1})
+
+	def _collect_vector_units(self, profiler):
+		for layer in self.layers :
+			if layer in self.paths :
+				paths_by_color = dict()
+				for path in self.paths[layer] :
+					self._log.info("path %s, %s, stroke: %s, fill: %s, mb:gc: %s" % ( layer.get('id', None), path.get('id', None), path.get('stroke', None), path.get('class', None), path.get(_add_ns('gc', 'mb'), '')[:100]))
+
+					strokeInfo = self._get_stroke(path)
+					if(strokeInfo['visible'] == False):
+						continue
+
+					stroke = strokeInfo['color']
+					if "d" not in path.keys() :
+						self._log.error("Warning: One or more paths don't have 'd' parameter")
+						continue
+					if stroke not in paths_by_color.keys() and stroke != 'default':
+						paths_by_color[stroke] = []
+					d = path.get("d")
+					if d != '':
+						paths_by_color[stroke].append(path)# += path
+
+				layerId = layer.get('id', '?')
+				pathId = path.get('id', '?')
+
+				# path_sorting: set initial laser pos, assuming pleasant left to right, bottom to top processing order
+				current_x = 0
+				current_y = 0
+
+				#for each color generate GCode
+				for colorKey in self.colorOrder:
+					if colorKey == 'none':
+						continue
+
+					settings = self.colorParams.get(colorKey, {'intensity': -1, 'feedrate': -1, 'passes': 0, 'pierce_time': 0, 'cut_compressor': 100})
+					if(settings['feedrate'] == None or settings['feedrate'] == -1 or settings['intensity'] == None or settings['intensity'] <= 0):
+						self._log.info( "convert() skipping color %s, no valid settings %s." % (colorKey, settings))
+						continue
+
+					if(not colorKey in paths_by_color):
+						self._log.info( "convert() skipping color %s, no paths with this color (clipped? path in <defs>?. " % (colorKey))
+						continue
+
+					self._log.info( "convert() path sorting active: %s, path size %i." % (self.optimize_path_order, len(paths_by_color[colorKey])))
+					sorted_paths = paths_by_color[colorKey]
+					if self.optimize_path_order:
+						profiler.start('s5_path_ordering')
+						sorted_paths = self._sort_paths(sorted_paths, current_x, current_y, profiler)
+						profiler.stop('s5_path_ordering')
+
+					# set current position after processing the paths
+					for path in sorted_paths:
+						end_x = path.get(_add_ns('end_x', 'mb'), None)
+						end_y = path.get(_add_ns('end_y', 'mb'), None)
+						if(end_x != None and end_y != None):
+							current_x = float(end_x)
+							current_y = float(end_y)
+
+					self._units.append({'type': 'color', 'layer': layer, 'layer_id': layerId, 'path_id': pathId,
+					                    'color': colorKey, 'settings': settings, 'paths': sorted_paths,
+					                    'item_count': len(paths_by_color[colorKey])})
+
+	def _start_pool(self):
+		"""
+		:returns: a pool of worker processes or None if the units are converted in this process.
+		"""
+		processes = min(self._processes, len(self._units))
+		self._log.info("converting %i units in %i processes", len(self._units), max(processes, 1))
+		if processes <= 1:
+			return None
+		# the workers are forked and find the parsed document and all units via _pool_converter
+		global _pool_converter
+		_pool_converter = self
+		self._pool_processes = processes
+		try:
+			return Pool(processes)
+		except:
+			_pool_converter = None
+			raise
+
+	def _stop_pool(self, pool):
+		global _pool_converter
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+		_pool_converter = None
+
+	def _convert_units(self, pool, is_job_cancelled):
+		"""
+		Converts all self._units, in the given pool of worker processes if there is one.
+		Each unit is written into its own file in self._parts_dir. Only as many units as there are workers are
+		converted ahead of the one which gets merged next, so just a few part files exist at a time.
+		Yields (unit, part_file, profiler, cache_stats) in the order of self._units as soon as the unit is done.
+		"""
+		if pool is None:
+			for idx, unit in enumerate(self._units):
+				is_job_cancelled()
+				part_file, unit_profiler, cache_stats = self._convert_unit(idx)
+				yield unit, part_file, unit_profiler, cache_stats
+			return
+
+		# at most one unit per worker is converted ahead of the one waited for
+		results = collections.deque()
+		for idx in range(len(self._units)):
+			results.append((idx, pool.apply_async(_convert_unit_in_worker, (idx,))))
+			if len(results) > self._pool_processes:
+				yield self._get_result(results.popleft(), is_job_cancelled)
+		while results:
+			yield self._get_result(results.popleft(), is_job_cancelled)
+
+	def _get_result(self, result, is_job_cancelled):
+		idx, res = result
+		while not res.ready():
+			is_job_cancelled()
+			res.wait(0.1)
+		part_file, unit_profiler, cache_stats = res.get()
+		return self._units[idx], part_file, unit_profiler, cache_stats
+
+	def _convert_unit(self, idx):
+		"""
+		:returns: (part_file, profiler, cache_stats) cache_stats are the (hits, misses) of this unit.
+		"""
+		unit = self._units[idx]
+		part_file = os.path.join(self._parts_dir, "part_%05i.gco" % idx)
+		unit_profiler = None
+		# workers have their own copy of the cache object, so only the difference is reported back
+		hits = self._cache.hits if self._cache is not None else 0
+		misses = self._cache.misses if self._cache is not None else 0
+		with open(part_file, 'w') as fh:
+			if unit['type'] == 'image':
+				unit_profiler = self._convert_image(fh, unit['node'], unit['layer'], part_file)
+			else:
+				self._convert_color(fh, unit)
+		cache_stats = (0, 0)
+		if self._cache is not None:
+			cache_stats = (self._cache.hits - hits, self._cache.misses - misses)
+		return part_file, unit_profiler, cache_stats
+
+	def _convert_image(self, fh, imgNode, layer, part_file):
+		file_id = imgNode.get('data-serveurl', '')
+		x = imgNode.get('x')
+		y = imgNode.get('y')
+		if x is None:
+			x = "0"
+		if y is None:
+			y = "0"
+
+		# pt units
+		x = float(x)
+		y = float(y)
+		w = float(imgNode.get("width"))
+		h = float(imgNode.get("height"))
+
+		_upperLeft = [x, y]
+		_lowerRight = [x + w, y + h]
+
+		# apply svg transforms
+		_mat = self._get_transforms(imgNode)
+		simpletransform.applyTransformToPoint(_mat, _upperLeft)
+		simpletransform.applyTransformToPoint(_mat, _lowerRight)
+
+		### original style with orientation points :( ... TODO
+		# mm conversion
+		upperLeft = self._transform(_upperLeft,layer, False)
+		lowerRight = self._transform(_lowerRight,layer, False)
+
+		w = abs(lowerRight[0] - upperLeft[0])
+		h = abs(lowerRight[1] - upperLeft[1])
+
+		# contrast = 1.0, sharpening = 1.0, beam_diameter = 0.25,
+		# intensity_black = 1000, intensity_white = 0, speed_black = 30, speed_white = 500,
+		# dithering = True, pierce_time = 500, separation = True, material = "default"
+		rasterParams = self.options['raster']
+		backlash_x = _mrbeam_plugin_implementation._settings.get(["machine", "backlash_compensation_x"])
+		data = imgNode.get('href')
+		if(data is None):
+			data = imgNode.get(_add_ns('href', 'xlink'))
+
+		cache_key = None
+		# only data urls contain the image itself, the image behind an http url can change
+		if self._cache is not None and data is not None and data.startswith("data:"):
+			cache_key = GcodeCache.key('image', self._cache_version, data, file_id, w, h, upperLeft[0], lowerRight[1],
+			                           rasterParams, self.options['material'], backlash_x, self._raster_engine,
+			                           self.workingAreaWidth, self.workingAreaHeight)
+			if self._cache.get_to_file(cache_key, fh):
+				return None
+
+		ip = ImageProcessor(output_filehandle = fh,
+							workingAreaWidth = self.workingAreaWidth,
+							workingAreaHeight = self.workingAreaHeight,
+		                    beam_diameter = rasterParams['beam_diameter'],
+		                    backlash_x = backlash_x,
+		                    overshoot_distance = 1,
+							intensity_black = rasterParams['intensity_black'],
+							intensity_white = rasterParams['intensity_white'],
+							intensity_black_user = rasterParams['intensity_black_user'],
+							intensity_white_user = rasterParams['intensity_white_user'],
+							speed_black = rasterParams['speed_black'],
+							speed_white = rasterParams['speed_white'],
+							dithering = rasterParams['dithering'],
+							pierce_time = rasterParams['pierce_time'],
+							engraving_mode = rasterParams['engraving_mode'],
+							eng_compressor = rasterParams['eng_compressor'],
+							material = self.options['material'],
+							raster_engine = self._raster_engine)
+							# material = rasterParams['material'] if 'material' in rasterParams else None)
+
+		if(data.startswith("data:")):
+			ip.dataUrl_to_gcode(data, w, h, upperLeft[0], lowerRight[1], file_id)
+		elif(data.startswith("http://")):
+			ip.imgurl_to_gcode(data, w, h, upperLeft[0], lowerRight[1], file_id)
+		else:
+			self._log.error("Unable to parse img data", data)
+
+		if cache_key is not None:
+			fh.flush()
+			self._cache.put_from_file(cache_key, part_file)
+		return ip.get_profiler().finalize()
+
+	def _convert_color(self, fh, unit):
+		colorKey = unit['color']
+		settings = unit['settings']
+
+		# gcode_before_job
+		fh.write(machine_settings.gcode_before_job(color=colorKey, compressor=settings.get('cut_compressor', '100')))
+
+		for path in unit['paths']:
+			# process next / closest path...
+			curveGCode = ""
+			mbgc = path.get(_add_ns('gc', 'mb'), None)
+			if(mbgc != None):
+				curveGCode = self._use_embedded_gcode(mbgc)
+			else:
+				curveGCode = self._get_path_gcode(path, unit['layer'])
+
+
+			fh.write("; Layer:" + unit['layer_id'] + ", outline of:" + unit['path_id'] + ", stroke:" + colorKey +', '+str(settings)+"\n")
+			ity = settings['intensity']
+			pt = settings['pierce_time']
+			fr = int(settings['feedrate'])
+			passes = int(settings['passes'])
+			for p in range(0, passes):
+				if settings.get('progressive', False):
+					f = round(fr * (1 - 0.5 * p/(passes - 1)))
+				else:
+					f = fr
+				fh.write("; pass:%i/%s\n" % (p+1, settings['passes']))
+				# TODO tbd DreamCut different for each pass?
+				gc = self._replace_params_gcode(curveGCode, colorKey, f, ity, pt)
+				fh.write(gc)
+
+		# TODO check if _after_job should be one(two?) levels less indented
+		# gcode_after_job
+		fh.write(machine_settings.gcode_after_job(color=colorKey))
+
+	def _get_path_gcode(self, path, layer):
+		"""
+		Returns the gcode of a path with laser on/off placeholders. It doesn't depend on the laser params,
+		so the cached gcode of a path is reused as long as its geometry and position don't change.
+		"""
+		d = path.get('d')
+		cache_key = None
+		if self._cache is not None:
+			cache_key = GcodeCache.key('path', self._cache_version, d, self._get_transforms(path),
+			                           self._get_transform_matrix(layer).tolist(), self.optimize_2opt_window)
+			curveGCode = self._cache.get(cache_key)
+			if curveGCode is not None:
+				return curveGCode
+
+		csp = cubicsuperpath.parsePath(d)
+		csp = self._apply_transforms(path, csp)
+		curve = self._parse_curve(csp, layer)
+		curveGCode = self._generate_gcode(curve)
+
+		if cache_key is not None:
+			self._cache.put(cache_key, curveGCode)
+		return curveGCode
+
+	def _sort_paths(self, paths, current_x, current_y, profiler):
+		"""
+		Orders paths by their mb:start_x/y and mb:end_x/y attributes to reduce the rapid move distance.
+		Paths without a start point are appended in their original order.
+		:returns: sorted list of paths
+		"""
+		sortable = []
+		unsortable = []
+		starts = []
+		ends = []
+		for p in paths:
+			start_x = p.get(_add_ns('start_x', 'mb'), None)
+			start_y = p.get(_add_ns('start_y', 'mb'), None)
+			if(start_x != None and start_y != None):
+				start = (float(start_x), float(start_y))
+				end_x = p.get(_add_ns('end_x', 'mb'), None)
+				end_y = p.get(_add_ns('end_y', 'mb'), None)
+				end = (float(end_x), float(end_y)) if (end_x != None and end_y != None) else start
+				sortable.append(p)
+				starts.append(start)
+				ends.append(end)
+			else:
+				unsortable.append(p)
+
+		optimizer = PathOrderOptimizer(two_opt_window=self.optimize_2opt_window)
+		order = optimizer.sort(starts, ends, start_pos=(current_x, current_y))
+		profiler.add_value('rapid_distance', round(optimizer.rapid_distance, 2))
+		self._log.info("_sort_paths() sorted %i paths, %i without start point. rapid distance: %.2f", len(sortable), len(unsortable), optimizer.rapid_distance)
+		return [sortable[i] for i in order] + unsortable
+
 	def collect_paths(self):
 		self._log.info( "collect_paths")
 		self.paths = {}
@@ -647,41 +840,63 @@ class Converter():
 			p = self._transform_csp(p, layer)
 
 			### Sort to reduce Rapid distance
-			k = range(1,len(p))
-			keys = [0]
-			while len(k)>0:
-				end = p[keys[-1]][-1][1]
-				dist = None
-				for i in range(len(k)):
-					start = p[k[i]][0][1]
-					dist = max(   ( -( ( end[0]-start[0])**2+(end[1]-start[1])**2 ) ,i)	,   dist )
-				keys += [k[dist[1]]]
-				del k[dist[1]]
-
-			#keys = range(1,len(p)) # debug unsorted.
-			for k in keys:
+			keys = self._sort_subpaths(p)
+
+			#keys = [(k, False) for k in range(len(p))] # debug unsorted.
+			for k, reverse in keys:
 				subpath = p[k]
+				widths = w[k] if w is not None else None
+				if reverse:
+					subpath = [[sp[2], sp[1], sp[0]] for sp in reversed(subpath)]
+					# the widths belong to the points, so they're reversed with them
+					widths = widths[::-1] if widths is not None else None
 				c += [ [	[subpath[0][1][0],subpath[0][1][1]]   , 'move', 0, 0] ]
 				for i in range(1,len(subpath)):
 					sp1 = [  [subpath[i-1][j][0], subpath[i-1][j][1]] for j in range(3)]
 					sp2 = [  [subpath[i  ][j][0], subpath[i  ][j][1]] for j in range(3)]
-					c += biarc(sp1,sp2,0,0) if w==None else biarc(sp1,sp2,-f(w[k][i-1]),-f(w[k][i]))
+					c += biarc(sp1,sp2,0,0) if widths is None else biarc(sp1,sp2,-f(widths[i-1]),-f(widths[i]))
 				c += [ [ [subpath[-1][1][0],subpath[-1][1][1]]  ,'end',0,0] ]
 
 			#self._log.debug("Curve: " + str(c))
 			return c
 
+	def _sort_subpaths(self, csp):
+		"""
+		Orders the subpaths of a csp to reduce the rapid distance. The first subpath stays first,
+		the others may be processed backwards if their end is closer.
+		:returns: list of (subpath index, reversed) tuples
+		"""
+		starts = [csp[k][0][1] for k in range(1, len(csp))]
+		ends = [csp[k][-1][1] for k in range(1, len(csp))]
+		optimizer = PathOrderOptimizer(two_opt_window=self.optimize_2opt_window)
+		order = optimizer.sort_reversible(starts, ends, start_pos=csp[0][-1][1])
+		return [(0, False)] + [(i + 1, reverse) for i, reverse in order]
+
 	def _transform_csp(self, csp_, layer, reverse = False):
-		self._log.debug("_transform_csp %s , %s, %s" % (csp_, layer, reverse))
-		csp = [  [ [csp_[i][j][0][:],csp_[i][j][1][:],csp_[i][j][2][:]]  for j in range(len(csp_[i])) ]   for i in range(len(csp_)) ]
-		for i in xrange(len(csp)):
-			for j in xrange(len(csp[i])):
-				for k in xrange(len(csp[i][j])):
-					csp[i][j][k] = self._transform(csp[i][j][k],layer, reverse)
+		# all control points of all subpaths as one (N,3,2) array, transformed with a single matrix multiply
+		t = self._get_transform_matrix(layer, reverse)
+		points = numpy.array([node for subpath in csp_ for node in subpath], dtype=float)
+		if len(points) == 0:
+			return [[] for subpath in csp_]
+		points = (numpy.dot(points, t[:2, :2].T) + t[:2, 2]).tolist()
+
+		csp = []
+		start = 0
+		for subpath in csp_:
+			csp.append(points[start:start+len(subpath)])
+			start += len(subpath)
 		return csp
 
 	def _transform(self, source_point, layer, reverse=False):
-		self._log.debug('_transform %s,%s,%s ' % (source_point, layer, reverse))
+		x,y = source_point[0], source_point[1]
+		t = self._get_transform_matrix(layer, reverse)
+		return [float(t[0,0]*x+t[0,1]*y+t[0,2]), float(t[1,0]*x+t[1,1]*y+t[1,2])]
+
+	def _get_transform_matrix(self, layer, reverse=False):
+		"""
+		Returns the 3x3 transformation matrix (svg user units => mm) of the given layer as numpy array.
+		Matrices are calculated once per layer and cached.
+		"""
 		if layer == None :
 			layer = self.document.getroot()
 		if layer not in self.transform_matrix:
@@ -720,23 +935,20 @@ class Converter():
 							numpy.array(
 								[[points[0][1][0]], [points[0][1][1]], [1], [points[1][1][0]], [points[1][1][1]], [1], [points[2][1][0]], [points[2][1][1]], [1]]
 										)
-							).tolist()
-						self.transform_matrix[layer] = [[m[j*3+i][0] for i in range(3)] for j in range(3)]
+							)
+						self.transform_matrix[layer] = m.reshape(3, 3)
 
 					else :
 						self._log.error("Orientation points are wrong! (if there are two orientation points they sould not be the same. If there are three orientation points they should not be in a straight line.)")
 				else :
 					self._log.error("Orientation points are wrong! (if there are two orientation points they sould not be the same. If there are three orientation points they should not be in a straight line.)")
 
-			self.transform_matrix_reverse[layer] = numpy.linalg.inv(self.transform_matrix[layer]).tolist()
+			self.transform_matrix_reverse[layer] = numpy.linalg.inv(self.transform_matrix[layer])
 
-
-		x,y = source_point[0], source_point[1]
 		if not reverse :
-			t = self.transform_matrix[layer]
+			return self.transform_matrix[layer]
 		else :
-			t = self.transform_matrix_reverse[layer]
-		return [t[0][0]*x+t[0][1]*y+t[0][2], t[1][0]*x+t[1][1]*y+t[1][2]]
+			return self.transform_matrix_reverse[layer]
 
 ################################################################################
 ###
@@ -0,0 +1,169 @@
+"""
+gcode_cache.py
+content addressed disk cache for the gcode of single design elements
+
+Copyright (C) 2019 Mr Beam Lasers GmbH
+
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+
+class GcodeCache():
+	"""
+	Stores the gcode fragment of a design element (image, path) in a file named by the sha1 of
+	everything the gcode depends on. Least recently used entries are evicted as soon as the cache
+	exceeds max_size bytes. Entries are written atomically, so the cache can be used by several
+	worker processes at the same time.
+	Entries bigger than MAX_ENTRY_FRACTION of max_size are not stored at all, they'd only push out
+	everything else (or get evicted right away) and wear the SD card.
+	"""
+
+	MAX_ENTRY_FRACTION = 0.25
+
+	def __init__(self, folder, max_size):
+		self._log = logging.getLogger("octoprint.plugins.mrbeam.gcode_cache")
+		self.folder = folder
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		try:
+			if not os.path.isdir(self.folder):
+				os.makedirs(self.folder)
+		except OSError as e:
+			self._log.warn("Can't create gcode cache folder %s: %s", self.folder, e)
+
+	@staticmethod
+	def key(*parts):
+		"""
+		:param parts: everything the gcode depends on. Strings are hashed as they are,
+		              everything else as json with sorted keys.
+		:returns: sha1 hex digest
+		"""
+		sha = hashlib.sha1()
+		for part in parts:
+			if isinstance(part, unicode):
+				part = part.encode('utf-8')
+			elif not isinstance(part, str):
+				part = json.dumps(part, sort_keys=True, default=repr)
+			sha.update(part)
+			sha.update("\0")
+		return sha.hexdigest()
+
+	def get(self, key):
+		"""
+		:returns: cached gcode or None
+		"""
+		path = self._path(key)
+		try:
+			with open(path, 'r') as fh:
+				gcode = fh.read()
+			self._touch(path)
+			self.hits += 1
+			return gcode
+		except (IOError, OSError):
+			self.misses += 1
+			return None
+
+	def get_to_file(self, key, fh):
+		"""
+		Copies the cached gcode into the given file handle.
+		If reading the entry fails halfway, fh is truncated back to where it was.
+		:returns: True if the key was in the cache
+		"""
+		path = self._path(key)
+		pos = fh.tell()
+		try:
+			with open(path, 'r') as cached:
+				shutil.copyfileobj(cached, fh)
+			self._touch(path)
+			self.hits += 1
+			return True
+		except (IOError, OSError) as e:
+			if fh.tell() != pos:
+				self._log.warn("Can't read gcode cache entry %s: %s", key, e)
+				fh.seek(pos)
+				fh.truncate()
+			self.misses += 1
+			return False
+
+	def put(self, key, gcode):
+		if self._fits(len(gcode)):
+			self._write(key, lambda fh: fh.write(gcode))
+
+	def put_from_file(self, key, src_path):
+		try:
+			size = os.path.getsize(src_path)
+		except OSError:
+			return
+		if not self._fits(size):
+			return
+		def copy(fh):
+			with open(src_path, 'r') as src:
+				shutil.copyfileobj(src, fh)
+		self._write(key, copy)
+
+	def evict(self):
+		"""
+		Removes least recently used entries until the cache is not bigger than max_size.
+		"""
+		entries = []
+		total = 0
+		for dirpath, dirnames, filenames in os.walk(self.folder):
+			for name in filenames:
+				path = os.path.join(dirpath, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				total += st.st_size
+
+		removed = 0
+		if total > self.max_size:
+			entries.sort()
+			for mtime, size, path in entries:
+				if total <= self.max_size:
+					break
+				try:
+					os.remove(path)
+					total -= size
+					removed += 1
+				except OSError:
+					pass
+		self._log.info("gcode cache: %i entries, %i bytes (max %i), %i evicted.", len(entries) - removed, total, self.max_size, removed)
+
+	def _fits(self, size):
+		if size > self.max_size * self.MAX_ENTRY_FRACTION:
+			self._log.debug("Not caching %i bytes of gcode, max entry size is %i", size, self.max_size * self.MAX_ENTRY_FRACTION)
+			return False
+		return True
+
+	def _path(self, key):
+		return os.path.join(self.folder, key[:2], key)
+
+	def _touch(self, path):
+		# mtime is the lru timestamp
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+	def _write(self, key, write_func):
+		path = self._path(key)
+		tmp_path = None
+		try:
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			tmp_fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+			with os.fdopen(tmp_fd, 'w') as fh:
+				write_func(fh)
+			os.rename(tmp_path, path)
+		except (IOError, OSError) as e:
+			self._log.warn("Can't write gcode cache entry %s: %s", key, e)
+			if tmp_path is not None and os.path.exists(tmp_path):
+				os.remove(tmp_path)
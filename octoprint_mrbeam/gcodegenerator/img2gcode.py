@@ -33,6 +33,7 @@ import os.path
 import time
 import sys
 import re
+import numpy as np
 from img_separator import ImageSeparator
 from profiler import Profiler
 
@@ -45,6 +46,10 @@ class ImageProcessor:
 
 	ENGRAVING_MODE_DEFAULT      = ENGRAVING_MODE_PRECISE
 
+	RASTER_ENGINE_LEGACY        = 'legacy'
+	RASTER_ENGINE_NUMPY         = 'numpy'
+
+	RASTER_ENGINE_DEFAULT       = RASTER_ENGINE_NUMPY
 
 	def __init__( self,
 	              output_filehandle = None,
@@ -65,7 +70,9 @@ class ImageProcessor:
 	              pierce_time = 0,
 	              overshoot_distance = 1,
 	              eng_compressor = 100, # DreamCut.
-	              material = None):
+	              material = None,
+	              raster_engine = None,
+	              output_buffer_size = 64 * 1024):
 
 		self.log = logging.getLogger("octoprint.plugins.mrbeam.img2gcode")
 		self.profiler = Profiler("img2gcode")
@@ -115,6 +122,11 @@ class ImageProcessor:
 		self.engraving_mode = engraving_mode or self.ENGRAVING_MODE_DEFAULT
 		self.separation = (self.engraving_mode == self.ENGRAVING_MODE_FAST)
 		self.line_by_line = (self.engraving_mode == self.ENGRAVING_MODE_BASIC)
+		# raster engine: both produce the same gcode, numpy is way faster on big images
+		self.raster_engine = raster_engine or self.RASTER_ENGINE_DEFAULT
+		if self.raster_engine not in (self.RASTER_ENGINE_LEGACY, self.RASTER_ENGINE_NUMPY):
+			self.log.warn("Unknown raster engine '%s', using '%s'", self.raster_engine, self.RASTER_ENGINE_DEFAULT)
+			self.raster_engine = self.RASTER_ENGINE_DEFAULT
 
 		# overshoot settings
 		# given an acceleration of 700mm/s², these are the ways necessary to reach target speed of
@@ -134,9 +146,13 @@ class ImageProcessor:
 		self.is_inverted = self.intensity_white > self.intensity_black
 		#self.is_first_pixel = True
 
-		self._lookup_intensity = {}
-		self._lookup_feedrate = {}
-		self._output_gcode = ""
+		# brightness (0..255) => intensity / feedrate
+		self._lookup_intensity = [self._calc_intensity(b) for b in range(256)]
+		self._lookup_feedrate = [self._calc_feedrate(b) for b in range(256)]
+		# gcode is collected in this buffer and written in chunks of about output_buffer_size bytes
+		self.output_buffer_size = output_buffer_size
+		self._gcode_buffer = []
+		self._gcode_buffer_len = 0
 		self.gc_ctx = GC_Context()
 		self.profiler.stop('init')
 
@@ -345,6 +361,8 @@ class ImageProcessor:
 	def generate_gcode(self, imgArray, xMM,yMM,wMM,hMM, file_id):
 		"""
 		takes an array of objects containing the separated image and converts them to gcode.
+		If an output_filehandle is set, the gcode is streamed into it in chunks of output_buffer_size bytes
+		and an empty string is returned.
 		:param imgArray: array of imagedata containing dicts
 		:param xMM: x position of the image in mm (origin: left bottom)
 		:param yMM: y position of the image in mm (origin: left bottom)
@@ -360,6 +378,36 @@ class ImageProcessor:
 		:returns: gcode
 		:rtype: string
 		"""
+		if self.output_filehandle is None:
+			return "".join(self.generate_gcode_lines(imgArray, xMM, yMM, wMM, hMM, file_id))
+
+		for _ in self._generate_gcode(imgArray, xMM, yMM, wMM, hMM, file_id):
+			pass # _append_gcode() writes to the file handle whenever the buffer is full
+		self._flush_gcode()
+		return ""
+
+	def generate_gcode_lines(self, imgArray, xMM,yMM,wMM,hMM, file_id):
+		"""
+		Generator version of generate_gcode() for in-process consumers.
+		Yields the gcode line by line (including the trailing newline) while the image is processed,
+		so only the gcode of a single image line is held in memory.
+		Params see generate_gcode()
+		"""
+		rest = ""
+		for _ in self._generate_gcode(imgArray, xMM, yMM, wMM, hMM, file_id):
+			lines = (rest + self._drain_gcode_buffer()).splitlines(True)
+			rest = lines.pop() if lines and not lines[-1].endswith("\n") else ""
+			for line in lines:
+				yield line
+		lines = (rest + self._drain_gcode_buffer()).splitlines(True)
+		for line in lines:
+			yield line
+
+	def _generate_gcode(self, imgArray, xMM,yMM,wMM,hMM, file_id):
+		"""
+		Does the actual work of generate_gcode(). The gcode is written via _append_gcode().
+		This is a generator which yields after each image line, so callers can consume the buffered gcode.
+		"""
 
 		# write all parameters used for generating the gcode into the file
 		self.profiler.start('settings_as_comment')
@@ -380,7 +428,7 @@ class ImageProcessor:
 		self.gc_ctx.s = 0 #TODO hack. set with line above
 		self.gc_ctx.laser_active = True #TODO hack. set with line above
 
-		direction_positive = True
+		self.gc_ctx.direction_positive = True
 		#self.is_first_pixel = True
 
 		# sort imgArray
@@ -388,6 +436,7 @@ class ImageProcessor:
 		imgArray = self._sortImgArray(imgArray)
 
 		self.profiler.stop('sort_imgArray').start('write_img')
+		self.log.info("raster engine: %s", self.raster_engine)
 		# iterate through the image parts
 		for img_data in imgArray:
 			# img_data = {'i': px_data, 'x': offset_px_x, 'y':offset_px_y, 'id': id_str}
@@ -406,30 +455,12 @@ class ImageProcessor:
 			gc = self._get_gcode_g0(x=x_off, y=y_off, comment="; Move to start ({},{})".format(x_off, y_off))
 			self._append_gcode(gc)
 			self._append_gcode('M3S0\nG4P0') # initialize laser
-			# iterate line by line
-			pix = img.load()
-			for row in range(height_px-1,-1,-1):
-
-				line_info = self.get_pixelinfo_of_line(pix, size, row)
-				y = img_pos_mm[1] - (self.beam * line_info['row'])
-
-				if line_info['left'] != None and y >= 0 and y <= self.workingAreaHeight:
-
-					# prepare line start
-					self.write_gcode_for_line_start(y, img_pos_mm, pix, line_info, direction_positive, debug=self.debug)
-
-					# do line
-					self.write_gcode_for_trimmed_line(img_pos_mm, pix, line_info, direction_positive, debug=self.debug)
-
-					# after line
-					self.write_gcode_for_line_end(img_pos_mm, line_info, direction_positive, debug=self.debug)
-
-					# flip direction after each line to go back and forth
-					direction_positive = not direction_positive
-				else:
-					if line_info['left'] != None:
-						# skip line vertical out of working area
-						self._append_gcode("; ignoring line y={}, out of working area.".format(y))
+			if self.raster_engine == self.RASTER_ENGINE_NUMPY:
+				part_writer = self._write_part_numpy(img, img_pos_mm)
+			else:
+				part_writer = self._write_part_legacy(img, img_pos_mm)
+			for _ in part_writer:
+				yield
 
 			self._append_gcode("; EndPart")
 			self._append_gcode("M3S0")
@@ -441,11 +472,86 @@ class ImageProcessor:
 		# self._append_gcode(";EndImage\nM5\nM100P0 ; mrbeam_compressor:0") # important for gcode preview!
 		self.profiler.stop('write_img')
 		self.gc_ctx.laser_active = False
-		return self._output_gcode
+		yield
 
 	def get_profiler(self):
 		return self.profiler
 
+	def _write_part_legacy(self, img, img_pos_mm):
+		"""
+		Writes the gcode of one image part pixel by pixel. Generator, yields after each line.
+		The line direction is taken from and stored in self.gc_ctx.direction_positive
+		:param img: image part
+		:param img_pos_mm: lower left corner of the image part in mm
+		"""
+		size = img.size # size of the img fraction in pixels
+		height_px = size[1]
+
+		# iterate line by line
+		pix = img.load()
+		for row in range(height_px-1,-1,-1):
+			direction_positive = self.gc_ctx.direction_positive
+
+			line_info = self.get_pixelinfo_of_line(pix, size, row)
+			y = img_pos_mm[1] - (self.beam * line_info['row'])
+
+			if line_info['left'] != None and y >= 0 and y <= self.workingAreaHeight:
+
+				# prepare line start
+				self.write_gcode_for_line_start(y, img_pos_mm, pix, line_info, direction_positive, debug=self.debug)
+
+				# do line
+				self.write_gcode_for_trimmed_line(img_pos_mm, pix, line_info, direction_positive, debug=self.debug)
+
+				# after line
+				self.write_gcode_for_line_end(img_pos_mm, line_info, direction_positive, debug=self.debug)
+
+				# flip direction after each line to go back and forth
+				self.gc_ctx.direction_positive = not direction_positive
+			else:
+				if line_info['left'] != None:
+					# skip line vertical out of working area
+					self._append_gcode("; ignoring line y={}, out of working area.".format(y))
+			yield
+
+	def _write_part_numpy(self, img, img_pos_mm):
+		"""
+		Same as _write_part_legacy() but vectorized: the image part is loaded once into a numpy array,
+		first and last juicy pixels are searched for all rows at once and equal pixels are merged
+		by run length encoding. The resulting gcode is byte-identical.
+		:param img: image part
+		:param img_pos_mm: lower left corner of the image part in mm
+		"""
+		if img.mode != 'L':
+			img = img.convert('L') # mode '1' (dithering) becomes 0 / 255 like img.load() delivers it
+		pixels = np.asarray(img, dtype=np.uint8)
+		if pixels.size == 0:
+			return
+
+		height_px, width_px = pixels.shape
+		juicy = pixels <= self.ignore_brighter_than
+		has_juicy = juicy.any(axis=1)
+		first_juicy = juicy.argmax(axis=1)
+		last_juicy = width_px - 1 - juicy[:, ::-1].argmax(axis=1)
+
+		for row in range(height_px-1,-1,-1):
+			if not has_juicy[row]:
+				continue
+
+			direction_positive = self.gc_ctx.direction_positive
+			line_info = {'left': int(first_juicy[row]), 'right': int(last_juicy[row]), 'row': row, 'img_w': width_px, 'img_h': height_px}
+			y = img_pos_mm[1] - (self.beam * row)
+
+			if y >= 0 and y <= self.workingAreaHeight:
+				self.write_gcode_for_line_start(y, img_pos_mm, None, line_info, direction_positive, debug=self.debug)
+				self._write_gcode_for_trimmed_line_numpy(img_pos_mm, pixels[row], line_info, direction_positive, debug=self.debug)
+				self.write_gcode_for_line_end(img_pos_mm, line_info, direction_positive, debug=self.debug)
+				self.gc_ctx.direction_positive = not direction_positive
+			else:
+				# skip line vertical out of working area
+				self._append_gcode("; ignoring line y={}, out of working area.".format(y))
+			yield
+
 	# helper methods for gcode generation
 	def _sortImgArray(self, imgArray):
 		# pragmatic O(n^2) sorting
@@ -618,6 +724,34 @@ class ImageProcessor:
 			end_of_line = end_of_line if (direction_positive) else end_of_line + self.backlash_compensation_x
 			pos = self.write_gcode_for_equal_pixels(brightness, end_of_line, debug=debug)
 
+	def _write_gcode_for_trimmed_line_numpy(self, img_pos_mm, row_pixels, line_info, direction_positive, debug=False):
+		"""
+		Same as write_gcode_for_trimmed_line() but works on a numpy row and only iterates over
+		the spans of equal brightness instead of every single pixel.
+		"""
+		left = line_info['left']
+		right = line_info['right']
+		span = row_pixels[left:right+1]
+		if not direction_positive:
+			span = span[::-1]
+
+		# index (in travel direction) of every pixel with a brightness different to its predecessor
+		changes = np.flatnonzero(span[1:] != span[:-1]) + 1
+		run_brightness = span[changes - 1].tolist() # brightness of the span which ends at the change
+
+		for j, brightness in zip(changes.tolist(), run_brightness):
+			if direction_positive:
+				xpos = img_pos_mm[0] + self.beam * (left + j - 1)
+			else:
+				xpos = img_pos_mm[0] + self.beam * (right - j) + self.backlash_compensation_x
+			self.write_gcode_for_equal_pixels(brightness, xpos, debug=debug)
+
+		brightness = int(span[-1])
+		if not self._ignore_pixel_brightness(brightness) and self.get_intensity(brightness) > 0: # finish non-white line
+			end_of_line = img_pos_mm[0] + (right if direction_positive else left) * self.beam
+			end_of_line = end_of_line if (direction_positive) else end_of_line + self.backlash_compensation_x
+			self.write_gcode_for_equal_pixels(brightness, end_of_line, debug=debug)
+
 	def write_gcode_for_equal_pixels(self, brightness, target_x, comment=None, debug=False):
 		"""
 		Writes gcode for a sequence of equal pixels.
@@ -760,17 +894,19 @@ class ImageProcessor:
 		return "{0:.2f}".format(fl)
 
 	def get_intensity(self, brightness):
-		if not brightness in self._lookup_intensity:
-			intensity = (1.0 - brightness/255.0) * (self.intensity_black - self.intensity_white) + self.intensity_white
-			self._lookup_intensity[brightness] = int(intensity)
 		return self._lookup_intensity[brightness]
 
 	def get_feedrate(self, brightness):
-		if not brightness in self._lookup_feedrate:
-			feedrate = brightness/255.0 * (self.feedrate_white - self.feedrate_black) + self.feedrate_black
-			self._lookup_feedrate[brightness] = int(feedrate)
 		return self._lookup_feedrate[brightness]
 
+	def _calc_intensity(self, brightness):
+		intensity = (1.0 - brightness/255.0) * (self.intensity_black - self.intensity_white) + self.intensity_white
+		return int(intensity)
+
+	def _calc_feedrate(self, brightness):
+		feedrate = brightness/255.0 * (self.feedrate_white - self.feedrate_black) + self.feedrate_black
+		return int(feedrate)
+
 	def get_alpha_composition(self, pixel):
 		brightness = pixel[0] # 0..255
 		opacity = pixel[1] # 0..255
@@ -797,14 +933,22 @@ class ImageProcessor:
 			return 0
 
 	def _append_gcode(self, gcode, add_new_line=True):
-		if self.output_filehandle is not None:
-			self.output_filehandle.write(gcode)
-			if add_new_line:
-				self.output_filehandle.write("\n")
-		else:
-			self._output_gcode += gcode
-			if add_new_line:
-				self._output_gcode += "\n"
+		if add_new_line:
+			gcode += "\n"
+		self._gcode_buffer.append(gcode)
+		self._gcode_buffer_len += len(gcode)
+		if self.output_filehandle is not None and self._gcode_buffer_len >= self.output_buffer_size:
+			self._flush_gcode()
+
+	def _drain_gcode_buffer(self):
+		gcode = "".join(self._gcode_buffer)
+		self._gcode_buffer = []
+		self._gcode_buffer_len = 0
+		return gcode
+
+	def _flush_gcode(self):
+		if self._gcode_buffer_len > 0:
+			self.output_filehandle.write(self._drain_gcode_buffer())
 
 
 class GC_Context():
@@ -817,6 +961,7 @@ class GC_Context():
 		self.f = None
 		self.s = None
 		self.laser_active = False
+		self.direction_positive = True
 
 
 # debug string
@@ -843,6 +988,7 @@ if __name__ == "__main__":
 	opts.add_option("", "--sharpening", type="float", help="image sharpening: 0.0 => blurred, 1.0 => unchanged, >1.0 => sharpened", default=1.0, dest="sharpening")
 	opts.add_option("", "--dithering", type="string", help="convert image to black and white pixels", default="false", dest="dithering")
 	opts.add_option("", "--mode", type="string", help="engraving mode: {}, {}, {}".format(ImageProcessor.ENGRAVING_MODE_FAST, ImageProcessor.ENGRAVING_MODE_BASIC, ImageProcessor.ENGRAVING_MODE_DEFAULT), default=ImageProcessor.ENGRAVING_MODE_DEFAULT, dest="engraving_mode")
+	opts.add_option("", "--engine", type="string", help="raster engine: {}, {}".format(ImageProcessor.RASTER_ENGINE_NUMPY, ImageProcessor.RASTER_ENGINE_LEGACY), default=ImageProcessor.RASTER_ENGINE_DEFAULT, dest="raster_engine")
 	opts.add_option("", "--no-headers", action="store_true", default=False, help="omits Mr Beam start and end sequences", dest="noheaders")
 
 	(options, args) = opts.parse_args()
@@ -909,7 +1055,8 @@ M2
 			dithering = boolDither,
 			engraving_mode=options.engraving_mode,
 			pierce_time = options.pierce_time,
-			material = None
+			material = None,
+			raster_engine = options.raster_engine
 		)
 
 		lh = logging.StreamHandler(sys.stdout)
@@ -0,0 +1,256 @@
+"""
+path_order.py
+ordering of paths to reduce the distance of rapid (laser off) moves
+
+Copyright (C) 2019 Mr Beam Lasers GmbH
+
+"""
+import logging
+import math
+
+
+class PathOrderOptimizer():
+	"""
+	Orders paths given by their start and end points in a greedy nearest neighbour tour.
+	Nearest neighbours are looked up in a grid based spatial index, so the ordering runs in
+	near-linear time instead of O(n^2). A bounded 2-opt pass can improve the tour afterwards.
+	Used for whole paths (sort(), direction is fixed) and subpaths (sort_reversible(), a subpath
+	may be processed backwards if its end is closer).
+	"""
+
+	def __init__(self, two_opt_window=0, two_opt_max_passes=2):
+		"""
+		:param two_opt_window: max number of paths reversed by one 2-opt move. 0 disables 2-opt.
+		:param two_opt_max_passes: max number of 2-opt passes over the whole tour
+		"""
+		self._log = logging.getLogger("octoprint.plugins.mrbeam.path_order")
+		self.two_opt_window = two_opt_window
+		self.two_opt_max_passes = two_opt_max_passes
+		self.rapid_distance = 0.0
+
+	def sort(self, starts, ends, start_pos=(0.0, 0.0)):
+		"""
+		:param starts: list of (x, y) start points
+		:param ends: list of (x, y) end points, same length as starts
+		:param start_pos: position of the laser head before the first path
+		:returns: list of indices into starts / ends in processing order
+		"""
+		n = len(starts)
+		order = []
+		if n > 0:
+			index = _GridIndex(starts, range(n))
+			pos = start_pos
+			while index.count > 0:
+				i = index.nearest(pos[0], pos[1])
+				index.remove(i)
+				order.append(i)
+				pos = ends[i]
+				if index.is_sparse():
+					index.build(index.remaining())
+
+			if self.two_opt_window > 0:
+				self._two_opt(order, starts, ends, start_pos)
+
+		self.rapid_distance = self.get_rapid_distance(order, starts, ends, start_pos)
+		return order
+
+	def sort_reversible(self, starts, ends, start_pos=(0.0, 0.0)):
+		"""
+		Like sort(), but a path may be entered at its end point and processed backwards.
+		:param starts: list of (x, y) start points
+		:param ends: list of (x, y) end points, same length as starts
+		:param start_pos: position of the laser head before the first path
+		:returns: list of (index, reversed) tuples in processing order
+		"""
+		n = len(starts)
+		order = []
+		if n > 0:
+			# point k < n enters path k at its start, point k >= n enters path k-n at its end
+			points = list(starts) + list(ends)
+			index = _GridIndex(points, range(2 * n))
+			pos = start_pos
+			while index.count > 0:
+				k = index.nearest(pos[0], pos[1])
+				i = k % n
+				index.remove(i)
+				index.remove(i + n)
+				reverse = k >= n
+				order.append((i, reverse))
+				pos = starts[i] if reverse else ends[i]
+				if index.is_sparse():
+					index.build(index.remaining())
+
+			if self.two_opt_window > 0:
+				self._two_opt_reversible(order, starts, ends, start_pos)
+
+		self.rapid_distance = self.get_rapid_distance_reversible(order, starts, ends, start_pos)
+		return order
+
+	@staticmethod
+	def get_rapid_distance(order, starts, ends, start_pos=(0.0, 0.0)):
+		distance = 0.0
+		pos = start_pos
+		for i in order:
+			distance += _dist(pos, starts[i])
+			pos = ends[i]
+		return distance
+
+	@staticmethod
+	def get_rapid_distance_reversible(order, starts, ends, start_pos=(0.0, 0.0)):
+		distance = 0.0
+		pos = start_pos
+		for i, reverse in order:
+			distance += _dist(pos, ends[i] if reverse else starts[i])
+			pos = starts[i] if reverse else ends[i]
+		return distance
+
+	def _two_opt(self, order, starts, ends, start_pos):
+		# Paths are directed, so reversing a segment of the tour changes the cost of all
+		# rapid moves within the segment. Both sums are extended incrementally while the segment grows.
+		n = len(order)
+		for _ in range(self.two_opt_max_passes):
+			improved = False
+			for i in range(-1, n - 2):
+				prev_end = start_pos if i < 0 else ends[order[i]]
+				first = order[i+1]
+				cost_into_first = _dist(prev_end, starts[first])
+				old_inner = 0.0
+				new_inner = 0.0
+				for j in range(i + 2, min(n, i + 2 + self.two_opt_window)):
+					old_inner += _dist(ends[order[j-1]], starts[order[j]])
+					new_inner += _dist(ends[order[j]], starts[order[j-1]])
+					old = cost_into_first + old_inner
+					new = _dist(prev_end, starts[order[j]]) + new_inner
+					if j + 1 < n:
+						next_start = starts[order[j+1]]
+						old += _dist(ends[order[j]], next_start)
+						new += _dist(ends[first], next_start)
+					if new < old - 1e-9:
+						order[i+1:j+1] = order[i+1:j+1][::-1]
+						improved = True
+						break
+			if not improved:
+				break
+
+	def _two_opt_reversible(self, order, starts, ends, start_pos):
+		# Reversing a segment also reverses each of its paths, so only the two rapid moves
+		# at the segment boundaries change.
+		entry = lambda item: ends[item[0]] if item[1] else starts[item[0]]
+		leave = lambda item: starts[item[0]] if item[1] else ends[item[0]]
+		n = len(order)
+		for _ in range(self.two_opt_max_passes):
+			improved = False
+			for i in range(-1, n - 1):
+				prev_end = start_pos if i < 0 else leave(order[i])
+				first = order[i+1]
+				for j in range(i + 1, min(n, i + 1 + self.two_opt_window)):
+					last = order[j]
+					old = _dist(prev_end, entry(first))
+					new = _dist(prev_end, leave(last))
+					if j + 1 < n:
+						next_entry = entry(order[j+1])
+						old += _dist(leave(last), next_entry)
+						new += _dist(entry(first), next_entry)
+					if new < old - 1e-9:
+						order[i+1:j+1] = [(idx, not rev) for idx, rev in reversed(order[i+1:j+1])]
+						improved = True
+						break
+			if not improved:
+				break
+
+
+class _GridIndex():
+	"""
+	Uniform grid over a set of points with about one point per cell.
+	Supports removal of points and nearest neighbour queries.
+	"""
+
+	def __init__(self, points, indices):
+		self._points = points
+		self.build(indices)
+
+	def build(self, indices):
+		indices = list(indices)
+		xs = [self._points[i][0] for i in indices]
+		ys = [self._points[i][1] for i in indices]
+		self._min_x = min(xs)
+		self._min_y = min(ys)
+		w = max(xs) - self._min_x
+		h = max(ys) - self._min_y
+		n = len(indices)
+		self._cell = max(math.sqrt(w * h / n), max(w, h) / n) or 1.0
+		self._nx = int(w / self._cell) + 1
+		self._ny = int(h / self._cell) + 1
+		self._cells = dict()
+		for i in indices:
+			key = self._key(self._points[i][0], self._points[i][1])
+			if key in self._cells:
+				self._cells[key].add(i)
+			else:
+				self._cells[key] = set([i])
+		self.count = n
+
+	def remaining(self):
+		res = []
+		for cell in self._cells.values():
+			res.extend(cell)
+		return res
+
+	def is_sparse(self):
+		# rebuilding keeps the ring search short once most points are gone
+		return self.count > 32 and self.count * 8 < self._nx * self._ny
+
+	def remove(self, i):
+		key = self._key(self._points[i][0], self._points[i][1])
+		cell = self._cells[key]
+		cell.discard(i)
+		if not cell:
+			del self._cells[key]
+		self.count -= 1
+
+	def nearest(self, x, y):
+		qx, qy = self._key(x, y)
+		max_r = max(abs(qx), abs(qx - self._nx + 1), abs(qy), abs(qy - self._ny + 1))
+		best = None
+		best_d = float('inf')
+		r = 0
+		while r <= max_r:
+			for key in self._ring(qx, qy, r):
+				cell = self._cells.get(key)
+				if cell:
+					for i in cell:
+						p = self._points[i]
+						d = (p[0] - x) ** 2 + (p[1] - y) ** 2
+						if d < best_d or (d == best_d and i < best):
+							best = i
+							best_d = d
+			# all points in ring r+1 are at least r cells away
+			if best is not None and best_d <= (r * self._cell) ** 2:
+				break
+			r += 1
+		return best
+
+	def _key(self, x, y):
+		return int(math.floor((x - self._min_x) / self._cell)), int(math.floor((y - self._min_y) / self._cell))
+
+	def _ring(self, qx, qy, r):
+		# all cells with a chebyshev distance of r to (qx, qy), clipped to the grid
+		if r == 0:
+			yield (qx, qy)
+			return
+		x_from = max(qx - r, 0)
+		x_to = min(qx + r, self._nx - 1)
+		for cy in (qy - r, qy + r):
+			if 0 <= cy < self._ny:
+				for cx in range(x_from, x_to + 1):
+					yield (cx, cy)
+		y_from = max(qy - r + 1, 0)
+		y_to = min(qy + r - 1, self._ny - 1)
+		for cx in (qx - r, qx + r):
+			if 0 <= cx < self._nx:
+				for cy in range(y_from, y_to + 1):
+					yield (cx, cy)
+
+
+def _dist(p, q):
+	return math.hypot(p[0] - q[0], p[1] - q[1])
@@ -8,15 +8,30 @@ class Profiler:
 		self.name = sessionName
 		self.eventlog = []
 		self.events = {}
+		self.values = {}
 		self.sessionDuration = -1
 		self.sessionStart = time.time()
 		self.lastStopped = self.sessionStart
+		self.log = self._get_logger()
+
+	def __getstate__(self):
+		# loggers can't be pickled, e.g. when a profiler is returned from a worker process
+		state = self.__dict__.copy()
+		del state['log']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.log = self._get_logger()
+
+	@staticmethod
+	def _get_logger():
 		try:
 			from octoprint_mrbeam.mrb_logger import init_mrb_logger, mrb_logger
-			self.log = mrb_logger("octoprint.plugins.gcodegenerator.profiler")
+			return mrb_logger("octoprint.plugins.gcodegenerator.profiler")
 		except ImportError:
 			# when called via command line
-			self.log = logging.getLogger("octoprint.plugins.gcodegenerator.profiler")
+			return logging.getLogger("octoprint.plugins.gcodegenerator.profiler")
 		
 	def start(self, eventname):
 		ts = time.time()
@@ -34,6 +49,11 @@ class Profiler:
 		self.eventlog.append((duration, eventname, 'stop', ts))
 		return self
 	
+	def add_value(self, name, value):
+		# values (distances, counts, ...) are summed up and listed in the summaries
+		self.values[name] = self.values.get(name, 0) + value
+		return self
+
 	def nest_data(self, otherProfiler):
 		otherProfiler.finalize()
 		otherName = otherProfiler.name
@@ -41,6 +61,8 @@ class Profiler:
 			tmp = (event[0]," %s_%s" % (otherName, event[1]),event[2],event[3])
 			self.log.info(tmp)
 			self.eventlog.append(tmp)
+		for name, value in otherProfiler.values.items():
+			self.add_value("%s_%s" % (otherName, name), value)
 			
 		return self
 		
@@ -58,11 +80,15 @@ class Profiler:
 	def getSummary(self):
 		self.stopAll()
 		summary = map(lambda x: "%f %s %s: %.4fs" % x,  self.eventlog)
-		return ("Profiling session %s (total: %.4f):\n" % (self.name, self.sessionDuration)) + "\n".join(summary)
+		return ("Profiling session %s (total: %.4f):\n" % (self.name, self.sessionDuration)) + "\n".join(summary) + self._get_values_summary()
 
 	def getShortSummary(self):
 		self.stopAll()
 		summary = map(lambda x: ("% 6.2f%% %s" % (100 * x[0]/self.sessionDuration ,x[1]) ) if(x[2] == 'stop') else None,  self.eventlog)
 		summary = filter(None, summary)
-		return ("Profiling session %s:\n" % self.name) + "\n".join(summary) + "\nTotal: %.4fs" % self.sessionDuration
+		return ("Profiling session %s:\n" % self.name) + "\n".join(summary) + "\nTotal: %.4fs" % self.sessionDuration + self._get_values_summary()
+
+	def _get_values_summary(self):
+		summary = map(lambda k: "%s: %s" % (k, self.values[k]), sorted(self.values.keys()))
+		return "".join(map(lambda x: "\n" + x, summary))
 	
@@ -15,13 +15,13 @@ from octoprint_mrbeam.mrbeam_events import MrBeamEvents
 
 # don't crash on a dev computer where you can't install picamera
 import octoprint_mrbeam.camera
-from octoprint_mrbeam.camera import gaussBlurDiff, QD_KEYS, PICAMERA_AVAILABLE
+from octoprint_mrbeam.camera import FrameSignature, QD_KEYS, PICAMERA_AVAILABLE
 from octoprint_mrbeam.util import json_serialisor, logme
 import octoprint_mrbeam.camera.exc as exc
 if PICAMERA_AVAILABLE:
-	from octoprint_mrbeam.camera.mrbcamera import MrbCamera
+	from octoprint_mrbeam.camera.mrbcamera import MrbCamera, STOP_CHECK_INTERVAL
 	from octoprint_mrbeam.camera.undistort import prepareImage, MAX_OBJ_HEIGHT, \
-		CAMERA_HEIGHT, _getCamParams, _getPicSettings, DIST_KEY, MTX_KEY
+		CAMERA_HEIGHT, _getCamParams, _getPicSettings, DIST_KEY, MTX_KEY, clearRemapCache, MarkerDetectionPool, MarkerTracker
 
 SIMILAR_PICS_BEFORE_UPSCALE = 1
 LOW_QUALITY = 65 # low JPEG quality for compressing bigger pictures
@@ -31,6 +31,12 @@ DEFAULT_MM_TO_PX = 1 # How many pixels / mm is used for the output image
 
 SIMILAR_PICS_BEFORE_REFRESH = 20
 MAX_PIC_THREAD_RETRIES = 2
+# Longest wait (s) between two pictures while nothing changes under the lid, see CaptureGovernor
+MAX_SIMILAR_PIC_INTERVAL = 1.5
+CPU_TEMP_FILE = "/sys/class/thermal/thermal_zone0/temp"
+# Above this CPU temperature (deg C) the camera slows down to prevent overheating
+CPU_TEMP_WARM = 65.0
+MARKER_DETECTION_PROCESSES = 4
 
 from octoprint_mrbeam.iobeam.iobeam_handler import IoBeamEvents
 from octoprint.events import Events as OctoPrintEvents
@@ -59,6 +65,9 @@ class LidHandler(object):
 		self._logger = mrb_logger("octoprint.plugins.mrbeam.iobeam.lidhandler",
 		                          logging.INFO)
 		self._lid_closed = True
+		# set while the lid is open, lid_opened_ts is the time it opened last
+		self.lid_opened_event = Event()
+		self.lid_opened_ts = None
 		self._interlock_closed = True
 		self._is_slicing = False
 		self._client_opened = False
@@ -76,6 +85,9 @@ class LidHandler(object):
 		self._analytics_handler = self._plugin.analytics_handler
 		self._event_bus.subscribe(MrBeamEvents.MRB_PLUGIN_INITIALIZED, self._subscribe)
 
+	def _onProfileChanged(self, event, payload):
+		self._laserCutterProfile = self._plugin.laserCutterProfileManager.get_current_or_default()
+
 	def _subscribe(self, event, payload):
 		self._event_bus.subscribe(IoBeamEvents.LID_OPENED, self.onEvent)
 		self._event_bus.subscribe(IoBeamEvents.INTERLOCK_OPEN, self.onEvent)
@@ -89,12 +101,15 @@ class LidHandler(object):
 		self._event_bus.subscribe(OctoPrintEvents.SLICING_FAILED,self._onSlicingEvent)
 		self._event_bus.subscribe(OctoPrintEvents.SLICING_CANCELLED, self._onSlicingEvent)
 		self._event_bus.subscribe(OctoPrintEvents.PRINTER_STATE_CHANGED,self._printerStateChanged)
+		self._event_bus.subscribe(MrBeamEvents.LASER_CUTTER_PROFILE_CHANGED, self._onProfileChanged)
 
 	def onEvent(self, event, payload):
 		self._logger.debug("onEvent() event: %s, payload: %s", event, payload)
 		if event == IoBeamEvents.LID_OPENED:
 			self._logger.debug("onEvent() LID_OPENED")
+			self.lid_opened_ts = time.time()
 			self._lid_closed = False
+			self.lid_opened_event.set()
 			self._startStopCamera(event)
 		if event == IoBeamEvents.INTERLOCK_OPEN:
 			self._logger.debug("onEvent() INTERLOCK_OPEN")
@@ -105,6 +120,7 @@ class LidHandler(object):
 		elif event == IoBeamEvents.LID_CLOSED:
 			self._logger.debug("onEvent() LID_CLOSED")
 			self._lid_closed = True
+			self.lid_opened_event.clear()
 			self._startStopCamera(event)
 		elif event == OctoPrintEvents.CLIENT_OPENED:
 			self._logger.debug("onEvent() CLIENT_OPENED sending client lidClosed: %s", self._lid_closed)
@@ -185,12 +201,15 @@ class LidHandler(object):
 
 		# load cam_params from file
 		cam_params = _getCamParams(path_to_cam_params)
+		# the lens calibration might have changed since the last session
+		clearRemapCache()
 		self._logger.debug('Loaded cam_params: {}'.format(cam_params))
 
 		# load pic_settings json
 		pic_settings = _getPicSettings(path_to_pic_settings)
 		self._logger.debug('Loaded pic_settings: {}'.format(pic_settings))
 		if not self._photo_creator.active:
+			self._photo_creator.start_marker_pool()
 			if self._photo_creator.stopping:
 				self._photo_creator.restart(pic_settings=pic_settings, cam_params=cam_params, out_pic_size=out_pic_size)
 			else:
@@ -201,6 +220,7 @@ class LidHandler(object):
 	def _end_photo_worker(self):
 		if self._photo_creator is not None:
 			self._photo_creator.stop()
+			self._photo_creator.stop_marker_pool()
 			self._photo_creator.save_debug_images = False
 			self._photo_creator.undistorted_pic_path = None
 
@@ -241,6 +261,7 @@ class PhotoCreator(object):
 		self._front_ready = Event()
 		self.last_correction_result = None
 		self.worker = None
+		self.marker_pool = None
 		if debug:
 			self._logger = mrb_logger("octoprint.plugins.mrbeam.iobeam.lidhandler.PhotoCreator", logging.DEBUG)
 		else:
@@ -291,6 +312,16 @@ class PhotoCreator(object):
 	def stopping(self):
 		return self.stopEvent.isSet()
 
+	def start_marker_pool(self):
+		if self.marker_pool is None:
+			self.marker_pool = MarkerDetectionPool(processes=MARKER_DETECTION_PROCESSES,
+			                                       img_shape=octoprint_mrbeam.camera.LEGACY_STILL_RES[::-1] + (3,))
+
+	def stop_marker_pool(self):
+		if self.marker_pool is not None:
+			self.marker_pool.close()
+			self.marker_pool = None
+
 	def restart(self, pic_settings=None, cam_params=None, out_pic_size=None, blocking=True):
 		if self.active:
 			self.stop(blocking)
@@ -364,6 +395,8 @@ class PhotoCreator(object):
 		"""
 
 		session_details = blank_session_details()
+		session_start = time.time()
+		governor = CaptureGovernor()
 		self._front_ready.set()
 		try:
 			cam.start()  # starts capture to the cam.worker
@@ -372,7 +405,10 @@ class PhotoCreator(object):
 			cam.stop(1)
 			raise
 		# --- Decide on the picture quality to give to the user and whether the pic is different ---
-		prev = None # previous image
+		prev = None # FrameSignature of the previous image
+		diff_thresh = self._settings.get(['cam', 'frameDiffThreshold'])
+		tile_diff_thresh = self._settings.get(['cam', 'frameDiffTileThreshold'])
+		frame_stats = blank_frame_change_stats()
 		nb_consecutive_similar_pics = 0
 		# Output image has a resolution based on the physical size of the workspace
 		# JPEG compression quality of output image
@@ -385,13 +421,13 @@ class PhotoCreator(object):
 		pic_qual_index = 0
 		# Marker positions detected on the last loop
 		markers = None
+		tracker = MarkerTracker()
 		# waste the first picture : doesn't matter how long we wait to warm up, the colors will be off.
 		cam.wait()
-		while self._plugin.lid_handler._lid_closed:
+		while not self._plugin.lid_handler.lid_opened_event.wait(STOP_CHECK_INTERVAL):
 			# Wait for the lid to be completely open
 			if self._plugin.lid_handler._interlock_closed or self.stopping:
 				return
-			time.sleep(.2)
 		# The lid didn't open during waiting time
 		cam.async_capture()
 		while not self.stopping:
@@ -400,6 +436,8 @@ class PhotoCreator(object):
 				path_to_pic_settings = self._settings.get(["cam", "correctionSettingsFile"])
 				self._logger.info("Refreshing picture settings from %s" % path_to_pic_settings)
 				pic_settings = _getPicSettings(path_to_pic_settings)
+				clearRemapCache()
+				tracker.reset()
 				prev=None # Forces to take a new picture
 			cam.wait()  # waits until the next picture is ready
 			if self.stopping: break
@@ -414,12 +452,17 @@ class PhotoCreator(object):
 			#     TODO apply shutter speed adjustment from preliminary measurements
 
 			# Compare previous image with the current one.
-			if prev is None or gaussBlurDiff(latest, prev, resize=.5):
+			signature = FrameSignature(latest)
+			if prev is None or self._frame_changed(signature, prev, diff_thresh, tile_diff_thresh, frame_stats):
 				# The 2 images are different, try to work on this one.
-				prev = latest # no need to copy because latest should be immutable
+				prev = signature
 				nb_consecutive_similar_pics = 0
 				pic_qual_index = 0
 				# TODO change the upscale factor depending on how fast the connection is
+				interval = governor.next_interval(changed=True)
+				if interval > 0:
+					# only when the CPU is hot
+					self.stopEvent.wait(interval)
 			else:
 				# Picture too similar to the previous, discard or upscale it
 				nb_consecutive_similar_pics += 1
@@ -429,14 +472,15 @@ class PhotoCreator(object):
 					# TODO check connection through netconnectd ?
 					# TODO use response from front-end
 					pic_qual_index += 1
-					prev = latest
+					prev = signature
 				elif nb_consecutive_similar_pics % SIMILAR_PICS_BEFORE_REFRESH == 0 \
 						and not self._front_ready.isSet():
 					# Try to send a picture despite the client not responding / being ready
-					prev = latest
+					prev = signature
 					self._front_ready.set()
 				else:
-					time.sleep(1.5) # Let the raspberry breathe a bit (prevent overheating)
+					# Let the raspberry breathe a bit (prevent overheating)
+					self.stopEvent.wait(governor.next_interval(changed=False))
 					continue
 			# Get the desired scale and quality of the picture to serve
 			upscale_factor , quality = pic_qualities[pic_qual_index]
@@ -459,7 +503,9 @@ class PhotoCreator(object):
 			                                                      debug_out=self.save_debug_images,  # self.save_debug_images,
 			                                                      undistorted=True,
 			                                                      stopEvent=self.stopEvent,
-			                                                      threads=4)
+			                                                      threads=MARKER_DETECTION_PROCESSES,
+			                                                      pool=self.marker_pool,
+			                                                      tracker=tracker)
 			if self.stopping: return False, None, None, None, None
 			success = workspaceCorners is not None
 			# Conform to the legacy result to be sent to frontend
@@ -475,6 +521,12 @@ class PhotoCreator(object):
 								 'error': err}
 			# Send result to fronted ASAP
 			if success:
+				if session_details['first_pic_latency'] is None:
+					# time from the opening of the lid, or from the start of this session if the lid was open already
+					lid_opened_ts = self._plugin.lid_handler.lid_opened_ts
+					latency_start = session_start if lid_opened_ts is None else max(lid_opened_ts, session_start)
+					session_details['first_pic_latency'] = time.time() - latency_start
+					self._logger.info("First picture after %.2f s", session_details['first_pic_latency'])
 				self._ready_to_send_pic(correction_result)
 			else:
 				# Just tell front end that there was an error
@@ -485,10 +537,31 @@ class PhotoCreator(object):
 										  increment_pic=True,
 										  error=err)
 		cam.stop_preview()
+		session_details['marker_detection'] = tracker.get_stats()
+		session_details['capture_governor'] = governor.get_stats()
+		session_details['frame_changes'] = frame_stats
 		if session_details['num_pics'] > 0:
 			self._analytics_handler.add_camera_session_details(session_details)
 		self._logger.debug("PhotoCreator_stopping")
 
+	def _frame_changed(self, signature, prev, diff_thresh, tile_diff_thresh, frame_stats):
+		"""
+		Compares the signatures of two pictures and keeps the statistics needed to tune the thresholds:
+		how often each tile changed and the highest differences measured on pictures seen as unchanged.
+		"""
+		tile_diff, tile_hist_diff = signature.diff(prev)
+		changed_tiles = (tile_diff > diff_thresh) | (tile_hist_diff > tile_diff_thresh)
+		changed = bool(changed_tiles.any())
+		frame_stats['compared'] += 1
+		if changed:
+			frame_stats['changed'] += 1
+			frame_stats['tile_changes'] = (np.asarray(frame_stats['tile_changes']) + changed_tiles).tolist()
+		else:
+			frame_stats['max_unchanged_diff'] = max(frame_stats['max_unchanged_diff'], int(tile_diff.max()))
+			frame_stats['max_unchanged_tile_hist_diff'] = max(frame_stats['max_unchanged_tile_hist_diff'], float(tile_hist_diff.max()))
+		self._logger.debug("Picture changed: %s, tile diffs:\n%s\ntile histogram diffs:\n%s", changed, tile_diff, np.round(tile_hist_diff, 3))
+		return changed
+
 	# @logme(True)
 	def _add_result_to_analytics(self,
                                  session_details,
@@ -572,6 +645,76 @@ class PhotoCreator(object):
 		except Exception as e:
 			self._logger.warn("exception_while_moving_file-_%s", e)
 
+class CaptureGovernor(object):
+	"""
+	Decides how long to wait before processing the next picture.
+	As long as the picture changes, there is no wait at all. Every picture similar to the previous one
+	doubles the interval, up to MAX_SIMILAR_PIC_INTERVAL. When the CPU gets hotter than CPU_TEMP_WARM,
+	the intervals are stretched and even changing pictures are slowed down.
+	"""
+
+	MIN_INTERVAL = .1
+	TEMP_CHECK_INTERVAL = 10.0
+
+	def __init__(self, max_interval=MAX_SIMILAR_PIC_INTERVAL, temp_file=CPU_TEMP_FILE):
+		self._logger = mrb_logger("octoprint.plugins.mrbeam.iobeam.lidhandler.CaptureGovernor")
+		self.max_interval = max_interval
+		self.temp_file = temp_file
+		self.interval = 0.
+		self.cpu_temp = None
+		self.max_cpu_temp = None
+		self.longest_interval = 0.
+		self._last_temp_check = None
+
+	def next_interval(self, changed):
+		"""
+		:param changed: whether the last picture was different from the previous one
+		:return: time (s) to wait before the next picture
+		"""
+		if changed:
+			self.interval = 0.
+		else:
+			self.interval = min(max(self.MIN_INTERVAL, 2 * self.interval), self.max_interval)
+		factor = self._heat_factor()
+		interval = self.interval * factor + self.MIN_INTERVAL * (factor - 1)
+		self.longest_interval = max(self.longest_interval, interval)
+		return interval
+
+	def _heat_factor(self):
+		now = time.time()
+		if self._last_temp_check is None or now - self._last_temp_check > self.TEMP_CHECK_INTERVAL:
+			self._last_temp_check = now
+			self.cpu_temp = self._read_cpu_temp()
+			if self.cpu_temp is not None:
+				self.max_cpu_temp = max(self.max_cpu_temp, self.cpu_temp)
+		if self.cpu_temp is None or self.cpu_temp <= CPU_TEMP_WARM:
+			return 1.
+		# twice as slow 5 degrees above CPU_TEMP_WARM, at most 4 times
+		return min(1. + (self.cpu_temp - CPU_TEMP_WARM) / 5., 4.)
+
+	def _read_cpu_temp(self):
+		try:
+			with open(self.temp_file) as f:
+				return int(f.read().strip()) / 1000.
+		except (IOError, ValueError):
+			# not a raspberry
+			return None
+
+	def get_stats(self):
+		return {'max_interval': self.longest_interval,
+		        'max_cpu_temp': self.max_cpu_temp}
+
+
+def blank_frame_change_stats():
+	"""
+	Statistics of the comparison of consecutive pictures, see PhotoCreator._frame_changed()
+	"""
+	return {'compared': 0,
+	        'changed': 0,
+	        'tile_changes': np.zeros(octoprint_mrbeam.camera.SIGNATURE_TILES, dtype=int).tolist(),
+	        'max_unchanged_diff': 0,
+	        'max_unchanged_tile_hist_diff': 0.}
+
 def blank_session_details():
 	"""
 	Add to these session details when taking the pictures.
@@ -587,7 +730,14 @@ def blank_session_details():
 									'SW': {...},
 									'NE': {...}},
 						'errors': list(dict),
-						'mean_upload_speed': int}
+						'mean_upload_speed': int,
+						'first_pic_latency': float,
+						'capture_governor': {'max_interval': float, 'max_cpu_temp': float},
+						'marker_detection': {'tracked': int,
+						                     'full_search': int,
+						                     'track_rate': float,
+						                     'avg_detection_time': float,
+						                     'max_detection_time': float}}
 	"""
 	_init_marker = {'missed':  0,
                     'found':   0,
@@ -604,5 +754,9 @@ def blank_session_details():
 	                               'SW': copy.deepcopy(_init_marker),
 	                               'NE': copy.deepcopy(_init_marker)},
 	                   'errors': {},
-                       'avg_upload_speed': None}
+                       'avg_upload_speed': None,
+	                   'marker_detection': None,
+	                   'first_pic_latency': None,
+	                   'capture_governor': None,
+	                   'frame_changes': None}
 	return session_details
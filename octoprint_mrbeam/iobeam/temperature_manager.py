@@ -28,10 +28,7 @@ class TemperatureManager(object):
 		self._event_bus = plugin._event_bus
 		self.temperature = None
 		self.temperature_ts = 0
-		self.temperature_max = plugin.laserCutterProfileManager.get_current_or_default()['laser']['max_temperature']
-		self.hysteresis_temperature = plugin.laserCutterProfileManager.get_current_or_default()['laser']['hysteresis_temperature']
-		self.cooling_duration = plugin.laserCutterProfileManager.get_current_or_default()['laser']['cooling_duration']
-		self.mode_time_based = self.cooling_duration > 0
+		self._load_profile()
 		self.temp_timer = None
 		self.is_cooling_since = 0
 		self._msg_is_temperature_recent = None
@@ -50,6 +47,7 @@ class TemperatureManager(object):
 		self._logger.info(msg)
 
 		self._event_bus.subscribe(MrBeamEvents.MRB_PLUGIN_INITIALIZED, self._on_mrbeam_plugin_initialized)
+		self._event_bus.subscribe(MrBeamEvents.LASER_CUTTER_PROFILE_CHANGED, self._on_profile_changed)
 
 	def _on_mrbeam_plugin_initialized(self, event, payload):
 		self._iobeam = self._plugin.iobeam
@@ -72,12 +70,21 @@ class TemperatureManager(object):
 		self._shutting_down = True
 
 	def reset(self):
-		self.temperature_max = self._plugin.laserCutterProfileManager.get_current_or_default()['laser']['max_temperature']
-		self.hysteresis_temperature = self._plugin.laserCutterProfileManager.get_current_or_default()['laser']['hysteresis_temperature']
-		self.cooling_duration = self._plugin.laserCutterProfileManager.get_current_or_default()['laser']['cooling_duration']
-		self.mode_time_based = self.cooling_duration > 0
+		self._load_profile()
 		self.is_cooling_since = 0
 
+	def _on_profile_changed(self, event, payload):
+		self._load_profile()
+		self._logger.info("Laser cutter profile changed. temperature_max: %s, hysteresis_temperature: %s, cooling_duration: %s",
+		                  self.temperature_max, self.hysteresis_temperature, self.cooling_duration)
+
+	def _load_profile(self):
+		laser = self._plugin.laserCutterProfileManager.get_current_or_default()['laser']
+		self.temperature_max = laser['max_temperature']
+		self.hysteresis_temperature = laser['hysteresis_temperature']
+		self.cooling_duration = laser['cooling_duration']
+		self.mode_time_based = self.cooling_duration > 0
+
 	def onEvent(self, event, payload):
 		if event == IoBeamValueEvents.LASER_TEMP:
 			self.handle_temp(payload)
@@ -1,6 +1,9 @@
 import os
+import json
+import hashlib
 import yaml
 from octoprint_mrbeam.mrb_logger import mrb_logger
+from octoprint_mrbeam.util import material_csv_parser
 
 
 # singleton
@@ -14,6 +17,12 @@ def materials(plugin):
 
 
 class Materials(object):
+	"""
+	Custom materials and the material settings from materials.csv.
+	Custom materials are kept in memory and written through to FILE_CUSTOM_MATERIALS on every change.
+	The material settings response is serialized once per laserhead and served from memory
+	until the csv file or the custom materials change.
+	"""
 
 	FILE_CUSTOM_MATERIALS = "materials.yaml"
 
@@ -26,6 +35,30 @@ class Materials(object):
 		self.custom_materials = dict()
 		self.custom_materials_loaded = False
 
+		# (laserhead, csv version, custom materials version) -> (json, etag)
+		self._responses = dict()
+		self._custom_materials_version = 0
+
+	def get_material_settings(self, laserhead):
+		"""
+		Material settings of this laserhead and the custom materials, serialized to json.
+		:param laserhead: model id of the laserhead
+		:return: (json string, etag)
+		"""
+		self._load()
+		csv_materials, csv_version = material_csv_parser.load_csv()
+		key = (laserhead, csv_version, self._custom_materials_version)
+		res = self._responses.get(key)
+		if res is None:
+			data = material_csv_parser.select_laserhead(csv_materials, laserhead)
+			data['custom_materials'] = self.custom_materials
+			data = json.dumps(data)
+			res = (data, hashlib.sha1(data).hexdigest())
+			# older versions are never asked for again
+			self._responses = {key: res}
+			self._logger.debug("Serialized material settings for laserhead %s: %s bytes", laserhead, len(data))
+		return res
+
 
 	def get_custom_materials(self):
 		"""
@@ -94,6 +127,7 @@ class Materials(object):
 
 	def _load(self, force=False):
 		if not self.custom_materials_loaded or force:
+				self._custom_materials_version += 1
 				try:
 					if os.path.isfile(self.custom_materials_file):
 						with open(self.custom_materials_file) as yaml_file:
@@ -114,6 +148,7 @@ class Materials(object):
 	def _save(self, force=False):
 		if not self.custom_materials_loaded and not force:
 			raise Exception("You need to load custom_materials before trying to save.")
+		self._custom_materials_version += 1
 		try:
 			data = dict(custom_materials=self.custom_materials)
 			with open(self.custom_materials_file, 'wb') as new_yaml:
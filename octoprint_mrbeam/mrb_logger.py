@@ -1,31 +1,102 @@
 import sys
-import datetime
+import time
+import heapq
+import itertools
 import logging
 import collections
-import copy
 import threading
 import traceback
-from inspect import getframeinfo, stack
+
+from octoprint_mrbeam.terminal_feed import TerminalFeed
 
 
 _printer = None
 
+# all terminal output goes through this ring buffer
+terminal_feed = TerminalFeed()
+
 
 def init_mrb_logger(printer):
 	global _printer
 	_printer = printer
+	if printer is not None:
+		terminal_feed.set_printer(printer)
 
 def mrb_logger(id, lvl=logging.DEBUG):
 	return MrbLogger(id, lvl=lvl)
 
 
+# file, line and function of the code which called the logger
+Caller = collections.namedtuple('Caller', ['filename', 'lineno', 'function'])
+
+
+class LogDispatcher(object):
+	"""
+	Runs the analytics log events and terminal dumps of all MrbLoggers in one background thread,
+	so that logging doesn't block the calling thread (e.g. the comm threads during a cascade of GRBL errors).
+	Tasks run in the order they were added, delayed tasks as soon as they are due.
+	"""
+
+	QUEUE_MAXSIZE = 10000
+
+	def __init__(self):
+		self._queue = collections.deque(maxlen=self.QUEUE_MAXSIZE)
+		self._delayed = []
+		self._seq = itertools.count()
+		self._cond = threading.Condition()
+		self._thread = None
+
+	def put(self, func, *args):
+		with self._cond:
+			self._queue.append((func, args))
+			self._start()
+			self._cond.notify()
+
+	def put_delayed(self, delay, func, *args):
+		with self._cond:
+			heapq.heappush(self._delayed, (time.time() + delay, next(self._seq), func, args))
+			self._start()
+			self._cond.notify()
+
+	def _start(self):
+		if self._thread is None or not self._thread.is_alive():
+			self._thread = threading.Thread(target=self._run, name="MrbLogDispatcher")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._queue and not (self._delayed and self._delayed[0][0] <= time.time()):
+					# untimed wait unless a delayed task is pending
+					self._cond.wait(self._delayed[0][0] - time.time() if self._delayed else None)
+				tasks = list(self._queue)
+				self._queue.clear()
+				while self._delayed and self._delayed[0][0] <= time.time():
+					tasks.append(heapq.heappop(self._delayed)[2:])
+
+			for func, args in tasks:
+				try:
+					func(*args)
+				except:
+					logging.getLogger("octoprint.plugins.mrbeam.mrb_logger").exception("Exception in LogDispatcher task %s: ", func)
+
+
+_dispatcher = LogDispatcher()
+
+
 class MrbLogger(object):
 
 	LEVEL_COMM = '_COMM_'
 
 	TERMINAL_BUFFER_DELAY = 2.0
+	TERMINAL_DUMP_MAX_LINES = 100
+
+	# identical messages (level WARN and above or with analytics/terminal_dump) within this time are only counted
+	RATE_LIMIT_INTERVAL = 1.0
 
-	terminal_buffer = collections.deque(maxlen=100)
+	# terminal_feed.seq of the first comm line which was not dumped yet
+	terminal_dump_seq = 0
 
 	def __init__(self, id, ignorePrinter=False, lvl=logging.DEBUG):
 		global _printer
@@ -36,6 +107,11 @@ class MrbLogger(object):
 		# TODO: this line overrides logging.yaml!!!
 		self.logger.setLevel(lvl)
 
+		self._rate_lock = threading.Lock()
+		self._last_message = None
+		self._last_message_ts = 0.0
+		self._repeated = 0
+
 	def comm(self, msg, *args, **kwargs):
 		kwargs['id'] = ''
 		self._terminal(self.LEVEL_COMM, msg, *args, **kwargs)
@@ -68,6 +144,10 @@ class MrbLogger(object):
 	def log(self, level, msg, *args, **kwargs):
 		"""
 		Logs the given message like the regular python logger. Still there are mrb-specific options available.
+		Terminal output only goes to the terminal_feed ring, analytics events and terminal dumps are done by the
+		LogDispatcher thread.
+		Bursts of identical messages (level WARN and above or with analytics or terminal_dump) are collapsed:
+		within RATE_LIMIT_INTERVAL only the first one is logged, the others are counted.
 		:param level: log level
 		:param msg: the message to log
 		:param args: arguments to logger or to the message
@@ -78,6 +158,11 @@ class MrbLogger(object):
 		:param terminal_dump: Collect and log a terminal dump. Terminal dumps are also sent to analytics if analytics is not explicitly set to False.
 		:type kwargs:
 		"""
+		analytics = kwargs.get('analytics', None)
+		terminal_dump = kwargs.get('terminal_dump', False)
+		if (level >= logging.WARN or analytics or terminal_dump) and self._is_repeated(level, msg, args):
+			return
+
 		if kwargs.pop('terminal', True if level >= logging.WARN else False):
 			self._terminal(level, msg, *args, **kwargs)
 		if kwargs.pop('terminal_as_comm', False) or level == self.LEVEL_COMM:
@@ -90,7 +175,7 @@ class MrbLogger(object):
 		terminal_dump =  kwargs.pop('terminal_dump', False)
 		if terminal_dump:
 			analytics = analytics if analytics else False
-			self._dump_terminal_buffer(level=level, analytics=analytics)
+			_dispatcher.put(self._dump_terminal_buffer, level, True, analytics)
 		if analytics:
 			kwargs['terminal_dump'] = terminal_dump
 
@@ -108,49 +193,74 @@ class MrbLogger(object):
 		kwargs.pop('terminal_dump', None)
 		self.logger.log(level, msg, *args, **kwargs)
 
-	def _terminal(self, level, msg, *args, **kwargs):
-		global _printer
+	def _is_repeated(self, level, msg, args):
+		"""
+		:return: True if the same message was logged less than RATE_LIMIT_INTERVAL ago
+		"""
+		try:
+			message = (level, msg % args if args and msg else msg)
+		except:
+			return False
+		now = time.time()
+		with self._rate_lock:
+			if message == self._last_message and now - self._last_message_ts < self.RATE_LIMIT_INTERVAL:
+				if self._repeated == 0:
+					_dispatcher.put_delayed(self._last_message_ts + self.RATE_LIMIT_INTERVAL - now, self._log_repeated)
+				self._repeated += 1
+				return True
+		self._log_repeated()
+		with self._rate_lock:
+			self._last_message = message
+			self._last_message_ts = now
+		return False
+
+	def _log_repeated(self):
+		with self._rate_lock:
+			message, repeated = self._last_message, self._repeated
+			self._repeated = 0
+		if repeated:
+			level, text = message
+			self.logger.log(level, "Last message repeated %s times: %s", repeated, text)
+			if level >= logging.WARN:
+				self._terminal(level, "Last message repeated %s times", repeated)
 
-		date = self._getDateString()
+	def _terminal(self, level, msg, *args, **kwargs):
 		id = kwargs.pop('id', self.id_short)
-
-		level = logging._levelNames[level] if level in logging._levelNames else level
-
 		msg = msg % args if args and msg else msg
 		exception = ''
 		if kwargs.pop('exc_info', False):
 			exctype, value = sys.exc_info()[:2]
 			exception = " (Exception: {type} - {value})".format(type=(exctype.__name__ if exctype else None), value=value)
-		output = "{date} {level}{space}{id}: {msg}{exception}".format(date=date, space=(' ' if id else ''), id=id, level=level, msg=msg, exception=exception)
-
-		if level == self.LEVEL_COMM:
-			MrbLogger.terminal_buffer.append(output)
-
-		if _printer:
-			_printer.on_comm_log(output)
-		else:
-			logging.getLogger("octoprint.plugins.mrbeam.terminal").warn("Can't log to terminal since _printer is None. Message: %s", msg)
+		terminal_feed.add(time.time(), level, id, msg, exception)
 
 	def _serial(self, msg, *args, **kwargs):
 		msg = msg % args if args and msg else msg
 		logging.getLogger("SERIAL").debug(msg)
 
 	def _analytics_log_event(self, level, msg, analytics_id, *args, **kwargs):
+		try:
+			msg = msg % args if args and msg else msg
+			# first frame outside of this file, without reading any source code like inspect.stack() does
+			frame = sys._getframe(1)
+			myself = frame.f_code.co_filename
+			while frame is not None and frame.f_code.co_filename == myself:
+				frame = frame.f_back
+			caller = Caller(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name) if frame is not None else None
+			del frame
+
+			exc_info = sys.exc_info() if kwargs.get('exc_info', 0) else None
+			_dispatcher.put(self._add_analytics_log_event, level, msg, analytics_id, caller, exc_info, kwargs.get('terminal_dump', False))
+		except:
+			self.logger.exception("Exception in _analytics_log_event: ")
+
+	def _add_analytics_log_event(self, level, msg, analytics_id, caller, exc_info, terminal_dump):
 		analytics_handler = self._get_analytics_handler()
 		if analytics_handler is not None:
 			try:
-				msg = msg % args if args and msg else msg
-				caller = None
-				caller_myself = getframeinfo(stack()[0][0])
-				i = 1
-				while caller is None or caller.filename == caller_myself.filename:
-					caller = getframeinfo(stack()[i][0])
-					i += 1
-
 				exception_str = None
 				stacktrace = None
-				if kwargs.get('exc_info', 0):
-					exctype, value, tb = sys.exc_info()
+				if exc_info:
+					exctype, value, tb = exc_info
 					exception_str = "{}: '{}'".format(exctype.__name__ if exctype is not None else None, value)
 					stacktrace = traceback.format_tb(tb)
 					msg = "{} - Exception: {}".format(msg, exception_str)
@@ -167,7 +277,7 @@ class MrbLogger(object):
 					stacktrace=stacktrace,
 				)
 
-				analytics_handler.add_logger_event(event_details, wait_for_terminal_dump=kwargs.get('terminal_dump', False))
+				analytics_handler.add_logger_event(event_details, wait_for_terminal_dump=terminal_dump)
 
 			except:
 				self.logger.exception("Exception in _analytics_log_event: ")
@@ -175,18 +285,18 @@ class MrbLogger(object):
 			self.logger.error('Could not write exception to analytics, the analytics handler was not initialized.')
 
 	def _dump_terminal_buffer(self, level=logging.INFO, repeat=True, analytics=True):
+		# runs in the LogDispatcher thread
 		try:
+			# comm lines since the last dump
+			lines, MrbLogger.terminal_dump_seq = terminal_feed.get_lines(
+				since=MrbLogger.terminal_dump_seq, level=self.LEVEL_COMM, max_lines=self.TERMINAL_DUMP_MAX_LINES)
 			if repeat:
-				self.my_buffer = copy.copy(MrbLogger.terminal_buffer)
+				self.my_buffer = lines
 			else:
-				self.my_buffer.extend(MrbLogger.terminal_buffer)
-			MrbLogger.terminal_buffer.clear()
+				self.my_buffer = (self.my_buffer + lines)[-self.TERMINAL_DUMP_MAX_LINES:]
 
 			if repeat:
-				temp_timer = threading.Timer(self.TERMINAL_BUFFER_DELAY, self._dump_terminal_buffer, kwargs=(dict(level=level, repeat=False, analytics=analytics)))
-				temp_timer.daemon = True
-				temp_timer.name = "MrbLoggerTimer"
-				temp_timer.start()
+				_dispatcher.put_delayed(self.TERMINAL_BUFFER_DELAY, self._dump_terminal_buffer, level, False, analytics)
 			else:
 				tmp_arr = []
 				my_logger = logging.getLogger('octoprint.plugins.mrbeam.terminal_dump')
@@ -198,17 +308,13 @@ class MrbLogger(object):
 					analytics_handler = self._get_analytics_handler()
 					if analytics_handler is not None:
 						analytics_handler.log_terminal_dump(tmp_arr)
-				self.my_buffer.clear()
+				self.my_buffer = []
 		except:
 			self.logger.exception("Exception in MrbLogger::dump_terminal_buffer() ")
 
 	def _shorten_id(self, id):
 		return id.replace('octoprint.plugins.', '')
 
-	def _getDateString(self):
-		return datetime.datetime.now().strftime("%H:%M:%S,%f")[:-3]
-		# return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
-
 	def _get_analytics_handler(self):
 		analytics_handler = None
 		try:
@@ -43,6 +43,8 @@ class MrBeamEvents(object):
 
 	LASER_HEAD_READ             = "LaserHeadRead"
 
+	LASER_CUTTER_PROFILE_CHANGED = "LaserCutterProfileChanged"
+
 	@classmethod
 	def register_with_octoprint(cls):
 		"""
@@ -1,42 +1,70 @@
 # coding=utf-8
 
 import collections
-from octoprint_mrbeam.lib.rwlock import RWLock
+import threading
+
+
+class AccLineBufferItem(object):
+	"""
+	A command sent to grbl and the machine state BEFORE it gets executed.
+	"""
+
+	__slots__ = ('cmd', 'i', 'f', 'x', 'y', 'l', 'id', 'dirty', 'sent_ts')
+
+	def __init__(self, cmd, i, f, x, y, l, id, dirty, sent_ts):
+		self.cmd = cmd
+		self.i = i
+		self.f = f
+		self.x = x
+		self.y = y
+		self.l = l
+		self.id = id
+		self.dirty = dirty
+		self.sent_ts = sent_ts
+
 
 class AccLineBuffer(object):
+	"""
+	Keeps track of the commands sent to grbl which are not acknowledged yet.
+	The character count and the number of dirty items are kept up to date with every change, so all getters are O(1).
+	Changes are serialized with a plain lock. Getters don't lock: they only read a single attribute,
+	which is atomic, and the comm threads can live with a value that is outdated a moment later anyway.
+	"""
 
 	DEFAULT_HISTORY_LENGTH = 3
 
 	def __init__(self):
-		self._lock = RWLock()
+		self._lock = threading.Lock()
 		self.buffer_cmds = collections.deque()
 		self.declined_cmds = collections.deque()
 		self._last_responded = None
-		self.char_len = -1
+		self.char_len = 0
 		self.id = 0
 		self.dirty = False
+		# number of dirty items in buffer_cmds and declined_cmds
+		self._dirty_count = 0
 
 	def reset(self):
-		self._lock.writer_acquire()
-		self.buffer_cmds.clear()
-		self.declined_cmds.clear()
-		self._last_responded = None
-		self._reset_char_len()
-		self.id = 0
-		self._lock.writer_release()
+		with self._lock:
+			self.buffer_cmds.clear()
+			self.declined_cmds.clear()
+			self._last_responded = None
+			self.char_len = 0
+			self._dirty_count = 0
+			self.id = 0
 
 	def reset_clogged(self):
 		"""
 		Should we find out that our counting got incorrect (e.g. we missed an 'ok' from grbl)
 		this resets the command counter. Should be called only when you're sure that grbl's serial buffer is empty.
 		"""
-		self._lock.writer_acquire()
-		self._last_responded = self.buffer_cmds.pop()
-		self.buffer_cmds.clear()
-		self._reset_char_len()
-		self._lock.writer_release()
+		with self._lock:
+			self._last_responded = self.buffer_cmds.pop()
+			self.buffer_cmds.clear()
+			self.char_len = 0
+			self._dirty_count = sum(1 for c in self.declined_cmds if c.dirty)
 
-	def add(self, cmd, intensity, feedrate, pos_x, pos_y, laser):
+	def add(self, cmd, intensity, feedrate, pos_x, pos_y, laser, sent_ts=None):
 		"""
 		Add a new command (item)
 		:param cmd:
@@ -45,22 +73,15 @@ class AccLineBuffer(object):
 		:param pos_x:
 		:param pos_y:
 		:param laser:
+		:param sent_ts: (optional) time the command is written to serial
 		"""
-		self._lock.writer_acquire()
-		d = dict(
-			cmd=cmd,
-			i=intensity,
-			f=feedrate,
-			x=pos_x,
-			y=pos_y,
-			l=laser,
-			id=self.id,
-			dirty=self.dirty
-		)
-		self.id += 1
-		self.buffer_cmds.append(d)
-		self._reset_char_len()
-		self._lock.writer_release()
+		with self._lock:
+			item = AccLineBufferItem(cmd, intensity, feedrate, pos_x, pos_y, laser, self.id, self.dirty, sent_ts)
+			self.id += 1
+			self.buffer_cmds.append(item)
+			self.char_len += len(cmd)
+			if item.dirty:
+				self._dirty_count += 1
 
 	def acknowledge_cmd(self):
 		"""
@@ -68,163 +89,123 @@ class AccLineBuffer(object):
 		Will be still available per get_last_acknowledged() iuntil this method is called next time
 		and is ignored in get_command_count() and is_empty() and get_char_len()
 		"""
-		if self.is_empty():
-			return None # happens after a reset during cancellation of a job
-		self._lock.writer_acquire()
-		self._last_responded = self.buffer_cmds.popleft()
-		self._reset_char_len()
-		self._lock.writer_release()
-		return self._last_responded
+		with self._lock:
+			if not self.buffer_cmds:
+				return None # happens after a reset during cancellation of a job
+			item = self.buffer_cmds.popleft()
+			self.char_len -= len(item.cmd)
+			if item.dirty:
+				self._dirty_count -= 1
+			self._last_responded = item
+			return item
 
 	def decline_cmd(self):
 		"""
 		Removes the oldest command (item) from the buffer and keeps it as recovery command
 		# TODO: if the error is not recovery, this cmd remains in memory until the next reset()
 		"""
-		if self.is_empty():
-			return None
-		self._lock.writer_acquire()
-		self._last_responded = self.buffer_cmds.popleft()
-		self._reset_char_len()
-		self.declined_cmds.append(self._last_responded)
-		self._lock.writer_release()
-		return self._last_responded
+		with self._lock:
+			if not self.buffer_cmds:
+				return None
+			item = self.buffer_cmds.popleft()
+			self.char_len -= len(item.cmd)
+			self.declined_cmds.append(item)
+			self._last_responded = item
+			return item
 
 	def get_first_item(self):
 		"""
 		Returns the first (oldest) item. This is the one to be removed next.
-		:return: item dict(cmd="", i=1, f=23) or None if empty
+		:return: AccLineBufferItem or None if empty
 		"""
-		if self.is_empty():
+		try:
+			return self.buffer_cmds[0]
+		except IndexError:
 			return None
-		self._lock.reader_acquire()
-		res =  self.buffer_cmds[0]
-		self._lock.reader_release()
-		return res
 
 	def get_last_responded(self):
 		"""
 		returns the last acknowledged command
 		:return: item
 		"""
-		self._lock.reader_acquire()
-		res = self._last_responded
-		self._lock.reader_release()
-		return res
+		return self._last_responded
 
 	def recover_next_command(self):
 		res = None
-		self._lock.writer_acquire()
-		if self.declined_cmds:
-			d = self.declined_cmds.popleft()
-			res = d['cmd'].rstrip()
-		self._lock.writer_release()
+		with self._lock:
+			if self.declined_cmds:
+				item = self.declined_cmds.popleft()
+				if item.dirty:
+					self._dirty_count -= 1
+				res = item.cmd.rstrip()
 		return res
 
 	def set_dirty(self):
 		"""
 		Marks all currently waiting and all new commands as dirty until add_cleaned is called
 		"""
-		self._lock.writer_acquire()
-		self.dirty = True
-		for c in self.buffer_cmds:
-			c['dirty'] = True
-		for c in self.declined_cmds:
-			c['dirty'] = True
-		self._lock.writer_release()
+		with self._lock:
+			self.dirty = True
+			for c in self.buffer_cmds:
+				c.dirty = True
+			for c in self.declined_cmds:
+				c.dirty = True
+			self._dirty_count = len(self.buffer_cmds) + len(self.declined_cmds)
 
 	def set_clean(self):
 		"""
 		No further items will be marked as dirty. Once all dirty items left the system, it'll be seen as clean again
 		"""
-		self._lock.writer_acquire()
-		self.dirty = False
-		self._lock.writer_release()
+		with self._lock:
+			self.dirty = False
 
 	def is_dirty(self):
 		"""
 		Returns True if any item in any queue is marked dirty
 		"""
-		if self.dirty:
-			return True
-		res = False
-		self._lock.reader_acquire()
-		for c in self.buffer_cmds:
-			if c['dirty']:
-				res = True
-				break
-		if not res:
-			for c in self.declined_cmds:
-				if c['dirty']:
-					res = True
-					break
-		self._lock.reader_release()
-		return res
+		return self.dirty or self._dirty_count > 0
 
 	def get_command_count(self):
 		"""
 		Number of commands in buffer (ignores history)
 		:return: int length
 		"""
-		self._lock.reader_acquire()
-		res = len(self.buffer_cmds)
-		self._lock.reader_release()
-		return res
+		return len(self.buffer_cmds)
 
 	def is_empty(self):
 		"""
 		True if the buffer is empty
 		:return: boolean
 		"""
-		self._lock.reader_acquire()
-		res = len(self.buffer_cmds) == 0
-		self._lock.reader_release()
-		return res
+		return len(self.buffer_cmds) == 0
 
 	def is_recovery_empty(self):
 		"""
 		True if the buffer is empty
 		:return: boolean
 		"""
-		self._lock.reader_acquire()
-		res = len(self.declined_cmds) == 0
-		self._lock.reader_release()
-		return res
+		return len(self.declined_cmds) == 0
 
 	def get_char_len(self):
 		"""
 		Character count of all commands in buffer (ignores history)
 		:return:
 		"""
-		self._lock.reader_acquire()
-		if self.char_len < 0:
-			self.char_len = sum([len(x['cmd']) for x in self.buffer_cmds])
-		res = self.char_len
-		self._lock.reader_release()
-		return res
-
-	def _reset_char_len(self):
-		self.char_len = -1
+		return self.char_len
 
 	def __str__(self):
-		self._lock.reader_acquire()
-		buffer = []
-		for c in self.buffer_cmds:
-			buffer.append(self._item_as_str(c))
-		dec_buffer = []
-		for c in self.declined_cmds:
-			dec_buffer.append(self._item_as_str(c))
-		self._lock.reader_release()
+		with self._lock:
+			buffer = [self._item_as_str(c) for c in self.buffer_cmds]
+			dec_buffer = [self._item_as_str(c) for c in self.declined_cmds]
 		return "AccLineBuffer: is_dirty: {dirty}, acc_buffer: ({len})[{buffer}], declined_cmds: ({len_declined})[{declined}]".format(
 			dirty=self.is_dirty(),
-			len=self.get_command_count(),
+			len=len(buffer),
 			buffer=", ".join(buffer),
-			len_declined=len(self.declined_cmds),
+			len_declined=len(dec_buffer),
 			declined=", ".join(dec_buffer))
 
 	def _item_as_str(self, item):
-		item['cmd'] = item['cmd'].strip() if item is not None else None
-		return "{{{id}: {cmd}{dirty}}}".format(id=item['id'], cmd=item['cmd'], dirty=' !dirty!' if item['dirty'] else '')
+		return "{{{id}: {cmd}{dirty}}}".format(id=item.id, cmd=item.cmd.strip(), dirty=' !dirty!' if item.dirty else '')
 
 	@staticmethod
 	def get_cmd_from_item(cmd_obj):
@@ -232,6 +213,8 @@ class AccLineBuffer(object):
 		if cmd_obj is not None:
 			if isinstance(cmd_obj, basestring):
 				my_cmd = cmd_obj
+			elif isinstance(cmd_obj, AccLineBufferItem):
+				my_cmd = cmd_obj.cmd.rstrip() if cmd_obj.cmd else cmd_obj.cmd
 			else:
 				my_cmd = cmd_obj.get('cmd', None) if cmd_obj else None
 				my_cmd = my_cmd.rstrip() if my_cmd else my_cmd
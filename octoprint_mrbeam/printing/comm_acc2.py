@@ -26,8 +26,10 @@ from octoprint_mrbeam.printing.profile import laserCutterProfileManager
 from octoprint_mrbeam.mrb_logger import mrb_logger
 from octoprint_mrbeam.printing.acc_line_buffer import AccLineBuffer
 from octoprint_mrbeam.printing.acc_watch_dog import AccWatchDog
+from octoprint_mrbeam.printing.gcode_command_table import GcodeCommandTable, GcodeTableReader, process_gcode_line, strip_comment
 from octoprint_mrbeam.util.cmd_exec import exec_cmd_output
 from octoprint_mrbeam.mrbeam_events import MrBeamEvents
+from octoprint_mrbeam.analytics.value_collector import ValueCollector
 
 ### MachineCom #########################################################################################################
 class MachineCom(object):
@@ -181,6 +183,13 @@ class MachineCom(object):
 
 		self.grbl_auto_update_enabled = _mrbeam_plugin_implementation._settings.get(['dev', 'grbl_auto_update_enabled'])
 		self._terminal_show_checksums = _mrbeam_plugin_implementation._settings.get(['terminal_show_checksums'])
+		self._pipelined_sending = _mrbeam_plugin_implementation._settings.get(['grbl_pipelined_sending'])
+
+		# send statistics of the current job
+		self._stats_rx_occupancy = None
+		self._stats_ok_latency = None
+		self._stats_lines_per_write = None
+		self._reset_send_stats()
 
 		#grbl features
 		self.grbl_feat_rescue_from_home = False
@@ -327,9 +336,9 @@ class MachineCom(object):
 				self._process_rt_commands()
 				# if self.isPrinting() and self._commandQueue.empty():
 				if self.isPrinting() and self._commandQueue.empty() and not self._recovery_lock:
-					cmd = self._getNext() # get next cmd form file
-					if cmd is not None:
-						self.sendCommand(cmd)
+					idx = self._getNext() # get next cmd form file
+					if idx is not None:
+						self._send_table_command(idx)
 						self._callback.on_comm_progress()
 					else:
 						# TODO: this code is about lasering the same file several times. not gonna happen in mrbII
@@ -340,9 +349,9 @@ class MachineCom(object):
 								self._set_print_finished()
 								self.watch_dog.log_state(trigger="after_set_print_finished")
 						self._currentFile.resetToBeginning()
-						cmd = self._getNext() # get next cmd form file
-						if cmd is not None:
-							self.sendCommand(cmd)
+						idx = self._getNext() # get next cmd form file
+						if idx is not None:
+							self._send_table_command(idx)
 							self._callback.on_comm_progress()
 
 				self._sendCommand()
@@ -488,31 +497,30 @@ class MachineCom(object):
 					# In recovery: if acc_line_buffer is marked dirty we must check if it is set to clean again.
 					if self._acc_line_buffer.is_dirty() and self.COMMAND_RESET_ALARM in my_cmd:
 						self._acc_line_buffer.set_clean()
-					self._log("Send: %s" % (my_cmd), is_command=True)
-					self._acc_line_buffer.add(my_cmd + '\n',
-					                          intensity=self._current_intensity,
-					                          feedrate=self._current_feedrate,
-					                          pos_x=self._current_pos_x,
-					                          pos_y=self._current_pos_y,
-					                          laser=self._current_laser_on)
-
-					if self.DEBUG_PRODUCE_CHECKSUM_ERRORS:
-						if random.randint(0, self.DEBUG_PRODUCE_CHECKSUM_ERRORS_RND) == 1:
-							orig_command = my_cmd
-							rnd = random.randint(0, len(my_cmd)-1)
-							my_cmd = my_cmd[:rnd-1] + chr(random.randint(0,255)) + my_cmd[rnd:]
-							self._logger.warn("DEBUG Randomly changed '%s' to '%s' to cause checksum error.", orig_command, my_cmd, terminal_as_comm=True)
+					cmds = [my_cmd]
+					data = self._add_to_acc_line_buffer(my_cmd)
+					self._cmd.pop('cmd', None)
+					if self._pipelined_sending and len(self._cmd) <= 0:
+						# pack all following plain commands which still fit into grbl's rx buffer into the same write
+						self._cmd = None
+						next_cmd = self._get_next_pipelined_cmd()
+						while next_cmd is not None:
+							cmds.append(next_cmd)
+							data += self._add_to_acc_line_buffer(next_cmd)
+							next_cmd = self._get_next_pipelined_cmd()
 					try:
-						self._serial.write(bytes(my_cmd + '\n'))
-						self._process_command_phase("sent", my_cmd)
-						self._cmd.pop('cmd', None)
+						self._serial.write(bytes(data))
+						self._stats_rx_occupancy.addValue(self._acc_line_buffer.get_char_len())
+						self._stats_lines_per_write.addValue(len(cmds))
+						for sent_cmd in cmds:
+							self._process_command_phase("sent", sent_cmd)
 					# except serial.SerialException:
 					except Exception:
-						self._logger.exception("Exception while writing to serial: cmd: %s - %s" % (my_cmd, get_exception_string()))
+						self._logger.exception("Exception while writing to serial: cmd: %s - %s" % (data, get_exception_string()))
 						self._errorValue = get_exception_string()
 						self.close(True)
 
-			if len(self._cmd) <= 0:
+			if self._cmd is None or len(self._cmd) <= 0:
 				# ok, we're done with this command
 				self._cmd = None
 				self._send_event.set()
@@ -528,14 +536,71 @@ class MachineCom(object):
 				self._errorValue = get_exception_string()
 				self.close(True)
 
+	def _add_to_acc_line_buffer(self, cmd):
+		"""
+		Adds cmd to the acc_line_buffer.
+		:returns: the line to write to serial
+		"""
+		self._log("Send: %s" % (cmd), is_command=True)
+		self._acc_line_buffer.add(cmd + '\n',
+		                          intensity=self._current_intensity,
+		                          feedrate=self._current_feedrate,
+		                          pos_x=self._current_pos_x,
+		                          pos_y=self._current_pos_y,
+		                          laser=self._current_laser_on,
+		                          sent_ts=time.time())
+
+		if self.DEBUG_PRODUCE_CHECKSUM_ERRORS:
+			if random.randint(0, self.DEBUG_PRODUCE_CHECKSUM_ERRORS_RND) == 1:
+				orig_command = cmd
+				rnd = random.randint(0, len(cmd)-1)
+				cmd = cmd[:rnd-1] + chr(random.randint(0,255)) + cmd[rnd:]
+				self._logger.warn("DEBUG Randomly changed '%s' to '%s' to cause checksum error.", orig_command, cmd, terminal_as_comm=True)
+		return cmd + '\n'
+
+	def _get_next_pipelined_cmd(self):
+		"""
+		Takes the next command from the queue (and the next line of the current job if the queue is empty).
+		Returns it if it's a plain command which still fits into grbl's rx buffer.
+		Otherwise it becomes self._cmd and is handled by _sendCommand() as usual (FLUSH, SYNC, compressor, ...)
+		:return: command string or None
+		"""
+		if self._acc_line_buffer.is_dirty():
+			return None
+		if self._commandQueue.empty() and self.isPrinting() and not self._recovery_lock:
+			idx = self._getNext()
+			if idx is not None:
+				self._send_table_command(idx)
+				self._callback.on_comm_progress()
+		if self._commandQueue.empty():
+			return None
+
+		tmp = self._commandQueue.get()
+		self._cmd = {'cmd': tmp} if isinstance(tmp, basestring) else tmp
+		my_cmd = self._cmd.get('cmd', None)
+		if len(self._cmd) == 1 and my_cmd and my_cmd not in (self.COMMAND_FLUSH, self.COMMAND_SYNC) \
+				and len(my_cmd) + 1 < self.GRBL_LINE_BUFFER_SIZE \
+				and self._acc_line_buffer.get_char_len() + len(my_cmd) + 1 < self.GRBL_WORKING_RX_BUFFER_SIZE:
+			self._cmd = None
+			return my_cmd
+		return None
+
+	def _reset_send_stats(self):
+		self._stats_rx_occupancy = ValueCollector('RxOccupancy')
+		self._stats_ok_latency = ValueCollector('OkLatency')
+		self._stats_lines_per_write = ValueCollector('LinesPerWrite')
+
+	def _log_send_stats(self):
+		self._logger.info("Send stats: pipelined_sending: %s, rx buffer occupancy (chars): %s, ok latency (s): %s, lines per write: %s",
+		                  self._pipelined_sending,
+		                  self._stats_rx_occupancy.getSummary(),
+		                  self._stats_ok_latency.getSummary(),
+		                  self._stats_lines_per_write.getSummary())
+
 	def _calc_checksum(self, cmd):
-		checksum = 0
-		for c in list(cmd):
-			# whitespaces are ignored for checksum!
-			if c != ' ':
-				checksum += ord(c)
-		checksum = checksum % 256
-		return checksum
+		# whitespaces are ignored for checksum!
+		checksum = sum(map(ord, cmd)) - ord(' ') * cmd.count(' ')
+		return checksum % 256
 
 	def _add_checksum_to_cmd(self, cmd):
 		if cmd is None:
@@ -637,6 +702,8 @@ class MachineCom(object):
 			self._send_event.set()
 			if 'ok' in ret:
 				cmd = self._acc_line_buffer.acknowledge_cmd()
+				if cmd and cmd.sent_ts:
+					self._stats_ok_latency.addValue(time.time() - cmd.sent_ts)
 				if self._recovery_ignore_further_alarm_responses:
 					recovery_str = "RECOVERY END"
 			elif 'err' in ret or 'ALARM' in ret: # TODO: are all ALARM messages to be counted?
@@ -666,13 +733,16 @@ class MachineCom(object):
 		return ret
 
 	def _getNext(self):
+		"""
+		:returns: index of the next command in self._currentFile.getTable() or None
+		"""
 		if self._finished_currentFile is False:
-			line = self._currentFile.getNext()
-			if line is None:
+			idx = self._currentFile.getNextIndex()
+			if idx is None:
 				self._finished_passes += 1
 				if self._finished_passes >= self._passes:
 					self._finished_currentFile = True
-			return line
+			return idx
 		else:
 			return None
 
@@ -682,6 +752,7 @@ class MachineCom(object):
 		self._changeState(self.STATE_OPERATIONAL)
 		payload = self._get_printing_file_state()
 		self.watch_dog.stop()
+		self._log_send_stats()
 		self._move_home()
 		_mrbeam_plugin_implementation.fire_event(MrBeamEvents.PRINT_DONE_PAYLOAD, payload)
 
@@ -1015,12 +1086,12 @@ class MachineCom(object):
 			restart_commands = [' ', # send a new line before $X to make sure, grbl regards it as a new command.
 			                    self._add_checksum_to_cmd(self.COMMAND_RESET_ALARM)
 			                    ]
-			if cmd_obj and cmd_obj['i'] is not None:
+			if cmd_obj and cmd_obj.i is not None:
 				# grbl internally adds a "S0" in case of a checksum error. (This "S0" is NOT acknowledged by grbl.)
 				# Therefor we need to turn the laser power back on.
 				# This is the intensity value which was current BEFORE this command. It might be different from
 				# a S-value within the command causing the checksum error.
-				restart_commands.append(self._add_checksum_to_cmd("S{}".format(int(cmd_obj['i']))))
+				restart_commands.append(self._add_checksum_to_cmd("S{}".format(int(cmd_obj.i))))
 
 			recover_cmd = restart_commands.pop(0)
 			while not self._recovery_thread_kill and self._acc_line_buffer.is_dirty():
@@ -1542,35 +1613,24 @@ class MachineCom(object):
 		obj = self._regex_feedrate.search(cmd)
 		if obj is not None:
 			feedrate_cmd = cmd[obj.start():obj.end()]
-			self._current_feedrate = int(feedrate_cmd[1:])
-
-			# Limit if necessary
-			if self._current_feedrate > 5000:  # The frontend limits to 3000
-				self._current_feedrate = 5000
-			elif self._current_feedrate < 30:  # The frontend limits to 100
-				self._current_feedrate = 30
-
+			self._current_feedrate = self._limit_feedrate(int(feedrate_cmd[1:]))
 			return cmd.replace(feedrate_cmd, 'F%d' % self._current_feedrate)
 
 		return cmd
 
+	def _limit_feedrate(self, feedrate):
+		if feedrate > 5000:  # The frontend limits to 3000
+			return 5000
+		elif feedrate < 30:  # The frontend limits to 100
+			return 30
+		return feedrate
+
 	def _replace_intensity(self, cmd):
 		obj = self._regex_intensity.search(cmd)
 		if obj is not None:
-			intensity_limit = int(self._laserCutterProfile['laser']['intensity_limit'])
 			intensity_cmd = cmd[obj.start():obj.end()]
 			parsed_intensity = int(intensity_cmd[1:])
-
-			# Limit GCode input (in case users enter a too high value in the gcode)
-			self._current_intensity = parsed_intensity
-			if self._current_intensity > intensity_limit:
-				self._current_intensity = intensity_limit
-
-			# Apply power correction factor and limit again (in case there is something wrong with the calculation of
-			# the correction factor)
-			self._current_intensity = int(round(self._current_intensity * self._power_correction_factor))
-			if self._gcode_intensity_limit and self._current_intensity > self._gcode_intensity_limit:
-				self._current_intensity = self._gcode_intensity_limit
+			self._current_intensity = self._correct_intensity(parsed_intensity)
 
 			# self._logger.info('Intensity command changed from S{old} to S{new} (correction factor {factor} and '
 			# 				  'intensity limit {limit})'.format(old=parsed_intensity, new=self._current_intensity,
@@ -1580,6 +1640,19 @@ class MachineCom(object):
 			return cmd.replace(intensity_cmd, 'S%d' % self._current_intensity)
 		return cmd
 
+	def _correct_intensity(self, intensity):
+		# Limit GCode input (in case users enter a too high value in the gcode)
+		intensity_limit = int(self._laserCutterProfile['laser']['intensity_limit'])
+		if intensity > intensity_limit:
+			intensity = intensity_limit
+
+		# Apply power correction factor and limit again (in case there is something wrong with the calculation of
+		# the correction factor)
+		intensity = int(round(intensity * self._power_correction_factor))
+		if self._gcode_intensity_limit and intensity > self._gcode_intensity_limit:
+			intensity = self._gcode_intensity_limit
+		return intensity
+
 	def get_hex_str_from_str(self, data):
 		res = []
 		for i in range(len(data)):
@@ -1732,6 +1805,48 @@ class MachineCom(object):
 			self._send_event.set()
 			self.watch_dog.notify_command(cmd_obj)
 
+	def _send_table_command(self, idx):
+		"""
+		Queues the command idx of the current job's GcodeCommandTable.
+		Does the same as sendCommand() and the _gcode_*_sending() handlers, but uses the values parsed when the file
+		was selected. Only the limits and the power correction are applied here.
+		Commands which weren't pre-parsed take the regular sendCommand() way.
+		"""
+		table = self._currentFile.getTable()
+		if table is None:
+			# job closed in the meantime
+			return
+		gcode = table.get_gcode(idx)
+		if gcode is None:
+			self.sendCommand(table.get_command(idx))
+			return
+
+		x = table.x[idx]
+		if x == x: # NaN if not given
+			self._current_pos_x = x
+		y = table.y[idx]
+		if y == y:
+			self._current_pos_y = y
+		if gcode in GcodeCommandTable.GCODES_LASER_ON:
+			self._current_laser_on = True
+		elif gcode in GcodeCommandTable.GCODES_LASER_OFF:
+			self._current_laser_on = False
+
+		feedrate = None
+		if table.feedrate[idx] != GcodeCommandTable.NO_VALUE:
+			self._current_feedrate = feedrate = self._limit_feedrate(table.feedrate[idx])
+		intensity = None
+		if table.intensity[idx] != GcodeCommandTable.NO_VALUE:
+			self._current_intensity = intensity = self._correct_intensity(table.intensity[idx])
+
+		cmd = table.get_command(idx, feedrate=feedrate, intensity=intensity)
+		if self.grbl_feat_checksums:
+			cmd = self._add_checksum_to_cmd(cmd)
+		cmd_obj = {'cmd': cmd}
+		self._commandQueue.put(cmd_obj)
+		self._send_event.set()
+		self.watch_dog.notify_command(cmd_obj)
+
 	def _handle_user_command(self, cmd):
 		"""
 		Handles commands the user can enter on the terminal starting with /
@@ -1893,8 +2008,7 @@ class MachineCom(object):
 		self._finished_passes = 0
 		self._pauseWaitTimeLost = 0.0
 		self._pauseWaitStartTime = None
-
-
+		self._reset_send_stats()
 
 		try:
 			self.watch_dog.reset()
@@ -2263,15 +2377,13 @@ class PrintingFileInformation(object):
 
 class PrintingGcodeFileInformation(PrintingFileInformation):
 	"""
-	Encapsulates information regarding an ongoing direct print. Takes care of the needed file handle and ensures
-	that the file is closed in case of an error.
+	Encapsulates information regarding an ongoing direct print. While the job runs, a GcodeTableReader compiles the file
+	chunk by chunk into GcodeCommandTables ahead of the send loop, so sending doesn't need any file access or line parsing.
 	"""
 
 	def __init__(self, filename, offsets_callback=None, current_tool_callback=None):
 		PrintingFileInformation.__init__(self, filename)
 
-		self._handle = None
-
 		self._first_line = None
 
 		self._offsets_callback = offsets_callback
@@ -2287,71 +2399,111 @@ class PrintingGcodeFileInformation(PrintingFileInformation):
 		self._lines_read = 0
 		self._lines_read_bak = 0
 
+		# current chunk of the job, the reader is started by the first getNextIndex()
+		self._reader = None
+		self._table = None
+		self._index = None
+
 	def start(self):
 		"""
-		Opens the file for reading and determines the file size.
+		Marks the job as started and rewinds to the first command.
 		"""
 		PrintingFileInformation.start(self)
-		self._handle = open(self._filename, "r")
+		self._stop_reader()
+		self._index = 0
 		self._lines_read = 0
 		self._lines_read_bak = 0
 
 	def close(self):
 		"""
-		Closes the file if it's still open.
+		Closes the print job.
 		"""
 		PrintingFileInformation.close(self)
-		if self._handle is not None:
-			try:
-				self._handle.close()
-			except:
-				pass
-		self._handle = None
+		self._stop_reader()
+		self._index = None
 
 	def resetToBeginning(self):
 		"""
-		resets the file handle so you can read from the beginning again.
+		resets to the first command so you can read from the beginning again.
 		"""
 		self._logger.debug("resetToBeginning() self._lines_read %s, self._lines_read_bak: %s", self._lines_read, self._lines_read_bak)
-		self._handle = open(self._filename, "r")
+		self._stop_reader()
+		self._index = 0
 		self._lines_read = 0
 
-	def getNext(self):
+	def getTable(self):
 		"""
-		Retrieves the next line for printing.
+		:returns: the chunk of the job the last getNextIndex() refers to
 		"""
-		if self._handle is None:
-			raise ValueError("File %s is not open for reading" % self._filename)
+		return self._table
 
-		try:
-			processed = None
-			while processed is None:
-				if self._handle is None:
-					# file got closed just now
-					self._logger.debug("getNext() self._handle is None -> returning None")
+	def getNextIndex(self):
+		"""
+		Retrieves the index of the next command in getTable() or None if the end of the job is reached.
+		Waits for the next chunk if the reader isn't ahead.
+		"""
+		if self._index is None:
+			self._logger.debug("getNextIndex() job is closed -> returning None")
+			return None
+
+		# close() or resetToBeginning() on another thread stop the reader and reset _reader and _table
+		reader = self._reader
+		table = self._table
+		if reader is None:
+			reader = self._reader = self._open_reader()
+			table = self._table = reader.next_table()
+			if table is None:
+				self._logger.debug("getNextIndex() reader stopped -> returning None")
+				return None
+		index = self._index
+		while index is not None and index >= len(table):
+			next_table = reader.next_table()
+			if next_table is None:
+				if reader.is_stopped():
+					self._logger.debug("getNextIndex() reader stopped -> returning None")
 					return None
-				line = self._handle.readline()
-				if not line:
-					self._logger.debug("getNext() read line is None -> closing self._handle")
-					self.close()
-				else:
-					self._lines_read += 1
-					self._lines_read_bak += 1
-					# self._logger.debug("getNext() increased self._lines_read to %s", self._lines_read)
-				processed = process_gcode_line(line)
-				if processed is None:
-					self._comment_size += len(line)
-			self._pos = self._handle.tell()
-
-			return processed
-		except Exception as e:
-			self.close()
-			self._logger.exception("Exception while processing line")
-			raise e
+				self._logger.debug("getNextIndex() end of job -> closing")
+				self._lines_read_bak += table.lines_total - self._lines_read
+				self._lines_read = table.lines_total
+				self._comment_size = table.comment_size
+				self.close()
+				return None
+			table = self._table = next_table
+			index = self._index = 0
+		if index is None or reader.is_stopped():
+			self._logger.debug("getNextIndex() job got closed -> returning None")
+			# a reader started after the job got closed has to be stopped here
+			reader.stop()
+			return None
+
+		self._index = index + 1
+		self._lines_read_bak += table.line_numbers[index] - self._lines_read
+		self._lines_read = table.line_numbers[index]
+		self._comment_size = table.comment_sizes[index]
+		self._pos = table.file_pos[index]
+		return index
+
+	def getNext(self):
+		"""
+		Retrieves the next line for printing.
+		"""
+		idx = self.getNextIndex()
+		if idx is None:
+			return None
+		return self._table.get_command(idx)
 
 	def getLinesTotal(self):
 		return self._lines_total
 
+	def _open_reader(self):
+		return GcodeTableReader(filename=self._filename)
+
+	def _stop_reader(self):
+		if self._reader is not None:
+			self._reader.stop()
+			self._reader = None
+		self._table = None
+
 	def getLinesRead(self):
 		return self._lines_read or self._lines_read_bak
 
@@ -2374,68 +2526,29 @@ class PrintingGcodeFromMemoryInformation(PrintingGcodeFileInformation):
 
 	def __init__(self, gcode):
 		PrintingFileInformation.__init__(self, "in_memory_gcode")
-		self._gcode = gcode.split("\n")
+		lines = gcode.split("\n")
 		self._size = len(gcode)
 		self._first_line = None
 		self._offsets_callback = None
 		self._current_tool_callback = None
 		self._pos = 0
 		self._comment_size = 0
-		self._lines_total = len(self._gcode)
-		self._lines_read = 0
-		self._lines_read_bak = 0
-
-	def start(self):
-		PrintingFileInformation.start(self)
+		self._lines_total = len(lines)
 		self._lines_read = 0
 		self._lines_read_bak = 0
+		self._lines = lines
+		self._reader = None
+		self._table = None
+		self._index = None
 
-	def close(self):
-		PrintingFileInformation.close(self)
-		self._gcode = None
+	def _open_reader(self):
+		return GcodeTableReader(lines=self._lines)
 
 	def resetToBeginning(self):
-		self._logger.debug("resetToBeginning() self._lines_read %s, self._lines_read_bak: %s", self._lines_read, self._lines_read_bak)
-		self._lines_read = 0
+		PrintingGcodeFileInformation.resetToBeginning(self)
 		self._pos = 0
 		self._comment_size = 0
 
-	def getNext(self):
-		"""
-		Retrieves the next line for printing.
-		"""
-		if self._gcode is None:
-			raise ValueError("Line buffer is not filled")
-
-		try:
-			processed = None
-			while processed is None:
-				if self._gcode is None:
-					# file got closed just now
-					self._logger.debug("getNext() self._gcode is None -> returning None")
-					return None
-
-				line = None
-				try:
-					line = self._gcode[self._lines_read]
-					self._lines_read += 1
-					self._lines_read_bak += 1
-					self._pos += len(line)
-				except IndexError:
-					self._logger.debug("getNext() read line raised IndexError -> closing self._gcode")
-					self.close()
-
-				if(line != None):
-					processed = process_gcode_line(line)
-					if processed is None:
-						self._comment_size += len(line)
-
-			return processed
-		except Exception as e:
-			self.close()
-			self._logger.exception("Exception while processing line")
-			raise e
-
 
 def convert_pause_triggers(configured_triggers):
 	triggers = {
@@ -2466,26 +2579,6 @@ def convert_pause_triggers(configured_triggers):
 	return result
 
 
-def process_gcode_line(line):
-	line = strip_comment(line).strip()
-	line = line.replace(" ", "")
-	if not len(line):
-		return None
-	return line
-
-def strip_comment(line):
-	if not ";" in line:
-		# shortcut
-		return line
-	escaped = False
-	result = []
-	for c in line:
-		if c == ";" and not escaped:
-			break
-		result += c
-		escaped = (c == "\\") and not escaped
-	return "".join(result)
-
 def get_new_timeout(t):
 	now = time.time()
 	return now + get_interval(t)
@@ -0,0 +1,277 @@
+import re
+import time
+import threading
+import collections
+from array import array
+from octoprint_mrbeam.mrb_logger import mrb_logger
+
+
+class GcodeCommandTable(object):
+	"""
+	G-code of a laser job (or a chunk of it, see GcodeTableReader) compiled into a table of commands, one entry per non-empty line.
+	Comments and whitespace are stripped, the command identifier and the X/Y/F/S values are parsed once,
+	so the send loop doesn't have to run regexes on every line while the laser is running.
+	Everything except the command text itself is stored in arrays to keep the table small for huge raster jobs.
+
+	Values follow the command handlers of MachineCom (_gcode_*_sending()):
+	- X/Y are only parsed for G0-G3 (position tracking), NaN if not given
+	- F is only parsed for commands which get their feedrate replaced (G1-G3, M3, F), -1 if not given
+	- S is only parsed for commands which get their intensity replaced (G1-G3, M3, S), -1 if not given
+	"""
+
+	GCODES_POSITION = ('G0', 'G1', 'G2', 'G3', 'G01', 'G02', 'G03')
+	GCODES_FEEDRATE = ('G1', 'G2', 'G3', 'G01', 'G02', 'G03', 'M3', 'M03', 'F')
+	GCODES_INTENSITY = ('G1', 'G2', 'G3', 'G01', 'G02', 'G03', 'M3', 'M03', 'S')
+	GCODES_LASER_ON = ('M3', 'M03')
+	GCODES_LASER_OFF = ('M5', 'M05')
+	# commands which can be sent by MachineCom._send_table_command(). Everything else takes the regular sendCommand() way.
+	GCODES_PREPARSED = frozenset(GCODES_POSITION + GCODES_FEEDRATE + GCODES_INTENSITY + GCODES_LASER_OFF)
+
+	NO_VALUE = -1
+	# limits of the arrays: the F/S spans are shorts, the F/S values ints
+	MAX_SPAN = 2 ** 15 - 1
+	MAX_VALUE = 2 ** 31 - 1
+
+	# same expressions as in MachineCom
+	_regex_command = re.compile("^\s*\*?\d*\s*\$?([GM]\d+|[THFSX])")
+	_regex_feedrate = re.compile("F\d+", re.IGNORECASE)
+	_regex_intensity = re.compile("S\d+", re.IGNORECASE)
+	_regex_gcode = re.compile("([XY])(\d+\.?\d*)", re.IGNORECASE)
+
+	def __init__(self, lines_total=0, size=0, comment_size=0):
+		self._text = bytearray()
+		self._text_offsets = array('I', [0])
+		self._gcode_names = [None]
+		self._gcode_ids = {None: 0}
+		self.gcodes = array('H')
+		self.x = array('d')
+		self.y = array('d')
+		self.feedrate = array('i')
+		self.intensity = array('i')
+		# start and end of the F/S value within the command text
+		self._feedrate_span = (array('h'), array('h'))
+		self._intensity_span = (array('h'), array('h'))
+		# position in the file after the line of a command, number of lines read and size of all skipped lines so far
+		self.file_pos = array('I')
+		self.line_numbers = array('I')
+		self.comment_sizes = array('I')
+
+		# counted from the beginning of the file, also if this table is just a chunk of it
+		self.lines_total = lines_total
+		self.size = size
+		self.comment_size = comment_size
+
+	@classmethod
+	def from_lines(cls, lines):
+		table = cls()
+		for line in lines:
+			table.add_line(line)
+		return table
+
+	def next_chunk(self):
+		"""
+		:returns: an empty table for the lines following the ones of this table
+		"""
+		return self.__class__(lines_total=self.lines_total, size=self.size, comment_size=self.comment_size)
+
+	def __len__(self):
+		return len(self.gcodes)
+
+	def add_line(self, line):
+		self.lines_total += 1
+		self.size += len(line)
+		cmd = process_gcode_line(line)
+		if cmd is None:
+			self.comment_size += len(line)
+			return
+
+		gcode = None
+		x = y = float('nan')
+		feedrate = intensity = self.NO_VALUE
+		feedrate_span = intensity_span = (self.NO_VALUE, self.NO_VALUE)
+
+		match = self._regex_command.search(cmd)
+		if match and cmd.startswith(match.group(1)) and match.group(1) in self.GCODES_PREPARSED:
+			gcode = match.group(1)
+			try:
+				if gcode in self.GCODES_POSITION:
+					for axis, val in self._regex_gcode.findall(cmd):
+						if axis in 'xX':
+							x = float(val)
+						else:
+							y = float(val)
+				if gcode in self.GCODES_FEEDRATE:
+					match = self._regex_feedrate.search(cmd)
+					if match:
+						feedrate = int(match.group()[1:])
+						feedrate_span = match.span()
+				if gcode in self.GCODES_INTENSITY:
+					match = self._regex_intensity.search(cmd)
+					if match:
+						intensity = int(match.group()[1:])
+						intensity_span = match.span()
+				if max(feedrate_span[1], intensity_span[1]) > self.MAX_SPAN or max(feedrate, intensity) > self.MAX_VALUE:
+					raise OverflowError("Command too long or value too big for the table")
+			except (ValueError, OverflowError):
+				# leave it to the regular command handlers to complain about it
+				gcode = None
+				x = y = float('nan')
+				feedrate = intensity = self.NO_VALUE
+				feedrate_span = intensity_span = (self.NO_VALUE, self.NO_VALUE)
+
+		if gcode not in self._gcode_ids:
+			self._gcode_ids[gcode] = len(self._gcode_names)
+			self._gcode_names.append(gcode)
+
+		if isinstance(cmd, unicode):
+			cmd = cmd.encode('utf-8')
+		self._text.extend(cmd)
+		self._text_offsets.append(len(self._text))
+		self.gcodes.append(self._gcode_ids[gcode])
+		self.x.append(x)
+		self.y.append(y)
+		self.feedrate.append(feedrate)
+		self.intensity.append(intensity)
+		for span, val in ((self._feedrate_span, feedrate_span), (self._intensity_span, intensity_span)):
+			span[0].append(val[0])
+			span[1].append(val[1])
+		self.file_pos.append(self.size)
+		self.line_numbers.append(self.lines_total)
+		self.comment_sizes.append(self.comment_size)
+
+	def get_gcode(self, idx):
+		"""
+		:returns: command identifier (e.g. 'G1' or 'F') if the command can be sent pre-parsed, None otherwise
+		"""
+		return self._gcode_names[self.gcodes[idx]]
+
+	def get_command(self, idx, feedrate=None, intensity=None):
+		"""
+		Returns the command text. If feedrate or intensity are given, they replace the parsed F/S values.
+		"""
+		cmd = str(self._text[self._text_offsets[idx]:self._text_offsets[idx+1]])
+		replace = []
+		if feedrate is not None and self._feedrate_span[0][idx] >= 0:
+			replace.append((self._feedrate_span[0][idx], self._feedrate_span[1][idx], 'F%d' % feedrate))
+		if intensity is not None and self._intensity_span[0][idx] >= 0:
+			replace.append((self._intensity_span[0][idx], self._intensity_span[1][idx], 'S%d' % intensity))
+		# replace from the end, so the span of the other value stays valid
+		for start, end, val in sorted(replace, reverse=True):
+			cmd = cmd[:start] + val + cmd[end:]
+		return cmd
+
+
+class GcodeTableReader(object):
+	"""
+	Compiles a gcode file (or a list of lines) into GcodeCommandTables of CHUNK_COMMANDS commands each.
+	This runs on a background thread which is at most CHUNKS_AHEAD chunks ahead of next_table(), so selecting a job
+	doesn't block and memory stays bounded no matter how big the job is.
+	A reader reads the job only once, use a new one to start over.
+	"""
+
+	CHUNK_COMMANDS = 2000
+	CHUNKS_AHEAD = 4
+
+	def __init__(self, filename=None, lines=None):
+		self._logger = mrb_logger("octoprint.plugins.mrbeam.printing.gcode_command_table")
+		self.filename = filename
+		self._lines = lines
+		# tables, then None at the end of the job or the exception which stopped the compilation
+		self._chunks = collections.deque()
+		self._cond = threading.Condition()
+		self._stopped = False
+
+		self._thread = threading.Thread(target=self._run, name="GcodeTableReader")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def next_table(self):
+		"""
+		Waits for the next chunk of the job.
+		:returns: GcodeCommandTable or None if the end of the job is reached or the reader got stopped
+		"""
+		with self._cond:
+			while not self._chunks and not self._stopped:
+				self._cond.wait()
+			if self._stopped:
+				return None
+			chunk = self._chunks[0]
+			if isinstance(chunk, GcodeCommandTable):
+				self._chunks.popleft()
+				self._cond.notify()
+		if isinstance(chunk, Exception):
+			raise chunk
+		return chunk
+
+	def is_stopped(self):
+		return self._stopped
+
+	def stop(self):
+		with self._cond:
+			self._stopped = True
+			self._chunks.clear()
+			self._cond.notify_all()
+
+	def _run(self):
+		ts = time.time()
+		try:
+			if self._lines is not None:
+				table, commands = self._compile(self._lines)
+			else:
+				with open(self.filename, 'r') as fh:
+					table, commands = self._compile(fh)
+			if table is not None and self._put(table) and self._put(None):
+				self._logger.debug("Compiled %s: %i lines, %i commands in %.3fs",
+				                   self.filename, table.lines_total, commands, time.time() - ts)
+		except Exception as e:
+			self._logger.exception("Exception while compiling %s: ", self.filename)
+			self._put(e)
+
+	def _compile(self, lines):
+		"""
+		:returns: (last table, number of commands) or (None, 0) if the reader got stopped
+		"""
+		table = GcodeCommandTable()
+		commands = 0
+		for line in lines:
+			table.add_line(line)
+			if len(table) >= self.CHUNK_COMMANDS:
+				if not self._put(table):
+					return None, 0
+				commands += len(table)
+				table = table.next_chunk()
+		return table, commands + len(table)
+
+	def _put(self, chunk):
+		"""
+		:returns: False if the reader got stopped
+		"""
+		with self._cond:
+			while len(self._chunks) >= self.CHUNKS_AHEAD and not self._stopped:
+				self._cond.wait()
+			if self._stopped:
+				return False
+			self._chunks.append(chunk)
+			self._cond.notify()
+			return True
+
+
+def process_gcode_line(line):
+	line = strip_comment(line).strip()
+	line = line.replace(" ", "")
+	if not len(line):
+		return None
+	return line
+
+def strip_comment(line):
+	if not ";" in line:
+		# shortcut
+		return line
+	escaped = False
+	result = []
+	for c in line:
+		if c == ";" and not escaped:
+			break
+		result += c
+		escaped = (c == "\\") and not escaped
+	return "".join(result)
@@ -1,6 +1,7 @@
 import time
 from octoprint.printer.standard import Printer, StateMonitor
 from octoprint.events import eventManager, Events
+from octoprint.util import to_unicode
 from octoprint_mrbeam.mrbeam_events import MrBeamEvents
 from octoprint_mrbeam.printing import comm_acc2 as comm
 from octoprint_mrbeam.mrb_logger import mrb_logger
@@ -182,6 +183,15 @@ class Laser(Printer):
 		if WPos is not None:
 			self._stateMonitor.setWorkPosition(WPos)
 
+	def on_comm_log_batch(self, lines):
+		"""
+		Called by the TerminalFeed with a frame of terminal lines instead of on_comm_log() per line
+		"""
+		lines = [to_unicode(line, "utf-8", errors="replace") for line in lines]
+		self._log.extend(lines)
+		for line in lines:
+			self._stateMonitor.add_log(line)
+
 	def _init_terminal(self):
 		from collections import deque
 		terminalMaxLines = _mrbeam_plugin_implementation._settings.get(['dev', 'terminalMaxLines'])
@@ -9,10 +9,14 @@ __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms
 import os
 import copy
 import re
+import time
+import threading
 import collections
 
 from octoprint.util import dict_merge, dict_clean, dict_contains_keys
 from octoprint.settings import settings
+from octoprint.events import eventManager
+from octoprint_mrbeam.mrbeam_events import MrBeamEvents
 from octoprint_mrbeam.mrb_logger import mrb_logger
 
 # singleton
@@ -66,11 +70,20 @@ class InvalidProfileError(Exception):
 
 
 class LaserCutterProfileManager(object):
+	"""
+	Profiles are parsed and validated only once and then served from memory. Callers always get a copy of the
+	cached profile, so they can't change the cache by accident.
+	The cache entry of a profile is dropped on save() and remove() or if the mtime of its file changed.
+	Every change fires MrBeamEvents.LASER_CUTTER_PROFILE_CHANGED.
+	"""
 
 	SETTINGS_PATH_PROFILE_DEFAULT_ID = ['lasercutterProfiles', 'default']
 	SETTINGS_PATH_PROFILE_DEFAULT_PROFILE = ['lasercutterProfiles', 'defaultProfile']
 	# SETTINGS_PATH_PROFILE_CURRENT_ID = ['lasercutterProfiles', 'current']
 
+	# a cached profile file is stat()ed at most once in this time to see if it was changed on disk
+	MTIME_CHECK_INTERVAL = 2.0
+
 	# old default dictionary for Mr Beam I
 	# default = dict(
 	# 	id = "_mrbeam_junior",
@@ -226,6 +239,11 @@ class LaserCutterProfileManager(object):
 			os.makedirs(self._folder)
 		self._logger = mrb_logger("octoprint.plugins.mrbeam.profile")
 
+		# identifier -> dict(profile, mtime, size, checked): parsed and validated profiles
+		self._cache = dict()
+		self._cache_lock = threading.Lock()
+		self._default_profiles = dict()
+
 	def select(self, identifier):
 		"""
 		Selects a profile non-persistently
@@ -249,8 +267,8 @@ class LaserCutterProfileManager(object):
 		try:
 			if identifier == "_default":
 				return self._load_default()
-			elif self.exists(identifier):
-				return self._load_from_path(self._get_profile_path(identifier))
+			elif identifier is not None:
+				return self._load_cached(identifier)
 			else:
 				return None
 		except InvalidProfileError:
@@ -259,7 +277,9 @@ class LaserCutterProfileManager(object):
 	def remove(self, identifier):
 		if identifier == "_default":
 			return False
-		return self._remove_from_path(self._get_profile_path(identifier))
+		removed = self._remove_from_path(self._get_profile_path(identifier))
+		self._profile_changed(identifier)
+		return removed
 
 	def save(self, profile, allow_overwrite=False, make_default=False):
 		"""
@@ -289,6 +309,7 @@ class LaserCutterProfileManager(object):
 			self.settings.save()
 		else:
 			self._save_to_path(self._get_profile_path(identifier), profile, allow_overwrite=allow_overwrite)
+			self._profile_changed(identifier)
 
 			if make_default:
 				self.set_default(identifier)
@@ -300,7 +321,7 @@ class LaserCutterProfileManager(object):
 
 	def get_default(self):
 		default = self.settings.get(self.SETTINGS_PATH_PROFILE_DEFAULT_ID)
-		if default is not None and self.exists(default):
+		if default is not None:
 			profile = self.get(default)
 			if profile is not None:
 				return profile
@@ -312,8 +333,11 @@ class LaserCutterProfileManager(object):
 		if identifier is not None and not identifier in all_identifiers:
 			return
 
+		changed = identifier != self.settings.get(self.SETTINGS_PATH_PROFILE_DEFAULT_ID)
 		self.settings.set(self.SETTINGS_PATH_PROFILE_DEFAULT_ID, identifier, force=True)
 		self.settings.save()
+		if changed:
+			self._fire_profile_changed(identifier)
 
 	def get_current_or_default(self):
 		if self._current is not None:
@@ -338,7 +362,7 @@ class LaserCutterProfileManager(object):
 		results = dict()
 		for identifier, path in all_identifiers.items():
 			try:
-				profile = self._load_from_path(path)
+				profile = self._load_cached(identifier)
 			except InvalidProfileError:
 				continue
 
@@ -379,6 +403,58 @@ class LaserCutterProfileManager(object):
 		profile = self._underlay_profile_with_default(profile)
 		return profile
 
+	def _load_cached(self, identifier):
+		"""
+		Like _load_from_path() but the profile is parsed only if it's not cached or its file changed.
+		:return: a copy of the profile or None if there is no such profile file
+		"""
+		now = time.time()
+		with self._cache_lock:
+			entry = self._cache.get(identifier)
+			if entry is not None and now - entry['checked'] < self.MTIME_CHECK_INTERVAL:
+				return copy.deepcopy(entry['profile'])
+
+		path = self._get_profile_path(identifier)
+		try:
+			stat = os.stat(path)
+		except OSError:
+			stat = None
+		if stat is None or not os.path.isfile(path):
+			if self._drop_cached(identifier):
+				self._profile_changed(identifier)
+			return None
+
+		if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+			entry['checked'] = now
+			return copy.deepcopy(entry['profile'])
+
+		profile = self._load_from_path(path)
+		if profile is None:
+			return None
+		with self._cache_lock:
+			self._cache[identifier] = dict(profile=profile, mtime=stat.st_mtime, size=stat.st_size, checked=now)
+		if entry is not None:
+			self._logger.info("Profile file changed on disk: %s", path)
+			self._profile_changed(identifier, reload=False)
+		return copy.deepcopy(profile)
+
+	def _drop_cached(self, identifier):
+		with self._cache_lock:
+			return self._cache.pop(identifier, None) is not None
+
+	def _profile_changed(self, identifier, reload=True):
+		if reload:
+			self._drop_cached(identifier)
+		if self._current is not None and self._current.get('id') == identifier:
+			self._current = self.get(identifier) or self.get_default()
+		self._fire_profile_changed(identifier)
+
+	def _fire_profile_changed(self, identifier):
+		try:
+			eventManager().fire(MrBeamEvents.LASER_CUTTER_PROFILE_CHANGED, dict(id=identifier))
+		except:
+			self._logger.exception("Exception while firing %s: ", MrBeamEvents.LASER_CUTTER_PROFILE_CHANGED)
+
 	def _save_to_path(self, path, profile, allow_overwrite=False):
 		validated_profile = self._ensure_valid_profile(profile)
 		if not validated_profile:
@@ -402,18 +478,21 @@ class LaserCutterProfileManager(object):
 			return False
 
 	def _load_default(self, defaultModel = None):
-		default = copy.deepcopy(self.__class__.default)
-		if defaultModel is not None and defaultModel == "_mrbeam_senior":
-			default['volume']['width'] *= 2
-			default['volume']['depth'] *= 2
-			default['model'] = "Senior"
-			default['id'] = "_mrbeam_senior"
-
-		profile = self._ensure_valid_profile(default)
-		if not profile:
-			self._logger.warn("Invalid default profile after applying overrides")
-			raise InvalidProfileError()
-		return profile
+		profile = self._default_profiles.get(defaultModel)
+		if profile is None:
+			default = copy.deepcopy(self.__class__.default)
+			if defaultModel is not None and defaultModel == "_mrbeam_senior":
+				default['volume']['width'] *= 2
+				default['volume']['depth'] *= 2
+				default['model'] = "Senior"
+				default['id'] = "_mrbeam_senior"
+
+			profile = self._ensure_valid_profile(default)
+			if not profile:
+				self._logger.warn("Invalid default profile after applying overrides")
+				raise InvalidProfileError()
+			self._default_profiles[defaultModel] = profile
+		return copy.deepcopy(profile)
 
 	def _get_profile_path(self, identifier):
 		return os.path.join(self._folder, "%s.profile" % identifier)
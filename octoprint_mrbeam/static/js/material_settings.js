@@ -12,7 +12,12 @@ $(function () {
 
         self.loadMaterialSettings = function (callback) {
             console.log("Loading standard materials");
-            OctoPrint.simpleApiCommand("mrbeam", "material_settings", {})
+            // GET, so that the browser can revalidate its cached copy (ETag) instead of downloading it again
+            $.ajax({
+                url: BASEURL + "plugin/mrbeam/material_settings",
+                type: "GET",
+                dataType: "json"
+            })
                 .done(function (response) {
                     let materialImportedSettings = response['materials'];
                     self.laserSource = response['laser_source'];
@@ -0,0 +1,108 @@
+import datetime
+import logging
+import threading
+import time
+
+
+class TerminalFeed(object):
+	"""
+	Terminal of the web UI: a ring buffer of the last RING_SIZE terminal lines.
+	Lines are stored raw as (timestamp, level, id, msg, exception) and only formatted when they're read.
+	A feeder thread hands the new lines to the printer (OctoPrint's terminal) in frames, at most one every
+	FRAME_INTERVAL seconds and with at most MAX_LINES_PER_FRAME lines. If more lines came in, the oldest are
+	replaced by a "skipped N lines" marker.
+	"""
+
+	RING_SIZE = 1000
+	FRAME_INTERVAL = 0.5
+	MAX_LINES_PER_FRAME = 100
+
+	def __init__(self, ring_size=RING_SIZE):
+		self._logger = logging.getLogger("octoprint.plugins.mrbeam.terminal")
+		self._ring = [None] * ring_size
+		self._size = ring_size
+		# number of lines ever added, the newest line is at (seq - 1) % size
+		self.seq = 0
+		self._lock = threading.Lock()
+
+		self._printer = None
+		self._fed_seq = 0
+		self._new_lines = threading.Event()
+		self._thread = None
+
+		self.frames = 0
+		self.lines_fed = 0
+		self.lines_skipped = 0
+
+	def set_printer(self, printer):
+		self._printer = printer
+		if self._thread is None or not self._thread.is_alive():
+			self._thread = threading.Thread(target=self._feed, name="TerminalFeed")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def add(self, ts, level, id, msg, exception=''):
+		with self._lock:
+			self._ring[self.seq % self._size] = (ts, level, id, msg, exception)
+			self.seq += 1
+		self._new_lines.set()
+
+	def get_lines(self, since=0, level=None, max_lines=None):
+		"""
+		Formatted lines which are still in the ring.
+		:param since: seq of the first line
+		:param level: only lines of this level
+		:param max_lines: only the newest max_lines (after filtering by level)
+		:return: (list of lines, seq of the next line)
+		"""
+		with self._lock:
+			seq = self.seq
+			entries = [self._ring[i % self._size] for i in xrange(max(since, seq - self._size), seq)]
+		if level is not None:
+			entries = [e for e in entries if e[1] == level]
+		if max_lines is not None:
+			entries = entries[-max_lines:] if max_lines > 0 else []
+		return [self.format(e) for e in entries], seq
+
+	def get_stats(self):
+		return dict(lines=self.seq, frames=self.frames, lines_fed=self.lines_fed, lines_skipped=self.lines_skipped)
+
+	@staticmethod
+	def format(entry):
+		ts, level, id, msg, exception = entry
+		date = datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S,%f")[:-3]
+		level = logging._levelNames[level] if level in logging._levelNames else level
+		return "{date} {level}{space}{id}: {msg}{exception}".format(date=date, space=(' ' if id else ''), id=id, level=level, msg=msg, exception=exception)
+
+	def _feed(self):
+		while True:
+			try:
+				self._new_lines.wait()
+				self._new_lines.clear()
+
+				with self._lock:
+					seq = self.seq
+					first = max(self._fed_seq, seq - self._size, seq - self.MAX_LINES_PER_FRAME)
+					entries = [self._ring[i % self._size] for i in xrange(first, seq)]
+				skipped = first - self._fed_seq
+				self._fed_seq = seq
+
+				lines = [self.format(e) for e in entries]
+				if skipped:
+					lines.insert(0, "[... skipped {} lines ...]".format(skipped))
+				self._send(lines)
+				self.frames += 1
+				self.lines_fed += len(entries)
+				self.lines_skipped += skipped
+
+				time.sleep(self.FRAME_INTERVAL)
+			except:
+				self._logger.exception("Exception in TerminalFeed: ")
+				time.sleep(self.FRAME_INTERVAL)
+
+	def _send(self, lines):
+		if hasattr(self._printer, 'on_comm_log_batch'):
+			self._printer.on_comm_log_batch(lines)
+		else:
+			for line in lines:
+				self._printer.on_comm_log(line)
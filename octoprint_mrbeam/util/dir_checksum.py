@@ -0,0 +1,183 @@
+import os
+import stat
+import json
+import time
+import locale
+import hashlib
+import tempfile
+import threading
+from octoprint_mrbeam.mrb_logger import mrb_logger
+
+
+# setlocale() is process wide
+_collate_lock = threading.Lock()
+
+
+class DirChecksums(object):
+	"""
+	Checksums of directory trees, same result as
+		find "<folder>" -type f -exec md5sum {} \; | sort -k 2 | md5sum
+	The lines are sorted like sort does with the locale of the environment (LC_ALL, LC_COLLATE, LANG), so the
+	checksums are the same as the ones of the shell pipeline run by the same service.
+	Files are hashed in process, in chunks of READ_SIZE. Their digests are cached by (path, size, mtime)
+	in cache_file, so later runs only read the files which changed.
+	Reading is throttled to io_budget bytes per second.
+	"""
+
+	READ_SIZE = 1024 * 1024
+
+	def __init__(self, cache_file=None, io_budget=None):
+		self._logger = mrb_logger("octoprint.plugins.mrbeam.util.dir_checksum")
+		self.cache_file = cache_file
+		self.io_budget = io_budget
+
+		# path -> [size, mtime, md5 hex digest]
+		self._cache = dict()
+		self._seen = dict()
+		self._bytes_read = 0
+		self._read_start = None
+
+		self.files = 0
+		self.files_hashed = 0
+
+	def checksums(self, folders):
+		"""
+		Each tree is walked only once, folders within another one are taken from the walk of the outer one.
+		:param folders: dict name -> path of the folder, must end with /
+		:return: dict name -> checksum
+		"""
+		self._load_cache()
+		self._seen = dict()
+		self._bytes_read = 0
+		self._read_start = time.time()
+		self.files = 0
+		self.files_hashed = 0
+
+		paths = sorted(set(folders.values()), key=len)
+		roots = []
+		for path in paths:
+			if not any(path.startswith(root) for root in roots):
+				roots.append(path)
+		lines = dict()
+		for root in roots:
+			lines[root] = self._walk(root)
+
+		result = dict()
+		for name, path in folders.iteritems():
+			root = next(root for root in roots if path.startswith(root))
+			md5 = hashlib.md5()
+			for file_path, line in lines[root]:
+				if file_path.startswith(path):
+					md5.update(line)
+			result[name] = md5.hexdigest()
+
+		# files which are gone drop out of the cache
+		self._cache = self._seen
+		self._save_cache()
+		self._logger.debug("checksums() %s files, %s hashed, %s bytes read in %.1fs",
+		                   self.files, self.files_hashed, self._bytes_read, time.time() - self._read_start)
+		return result
+
+	def _walk(self, folder):
+		"""
+		:return: list of (path, md5sum output line), sorted like sort -k 2
+		"""
+		lines = []
+		for dirpath, dirnames, filenames in os.walk(folder):
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				try:
+					st = os.lstat(path)
+				except OSError:
+					continue
+				# find -type f: no symlinks
+				if not stat.S_ISREG(st.st_mode):
+					continue
+				digest = self._file_md5(path, st)
+				if digest is None:
+					continue
+				self.files += 1
+				if '\\' in path or '\n' in path:
+					# md5sum escapes such file names and marks the line with a leading backslash
+					escaped = path.replace('\\', '\\\\').replace('\n', '\\n')
+					lines.append((path, "\\{}  {}\n".format(digest, escaped)))
+				else:
+					lines.append((path, "{}  {}\n".format(digest, path)))
+		return self._sort(lines)
+
+	def _sort(self, lines):
+		"""
+		Sorts like sort -k 2: by the line from the blanks after the digest on, then by the whole line.
+		:param lines: list of (path, md5sum output line)
+		"""
+		def key(entry):
+			line = entry[1][:-1]
+			return locale.strxfrm(line[line.index(' '):]), locale.strxfrm(line)
+
+		with _collate_lock:
+			previous = locale.setlocale(locale.LC_COLLATE)
+			try:
+				locale.setlocale(locale.LC_COLLATE, '')
+			except locale.Error:
+				# sort falls back to C as well
+				locale.setlocale(locale.LC_COLLATE, 'C')
+			try:
+				return sorted(lines, key=key)
+			finally:
+				locale.setlocale(locale.LC_COLLATE, previous)
+
+	def _file_md5(self, path, st):
+		entry = self._cache.get(path)
+		if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+			self._seen[path] = entry
+			return entry[2]
+
+		md5 = hashlib.md5()
+		try:
+			with open(path, 'rb') as f:
+				while True:
+					data = f.read(self.READ_SIZE)
+					if not data:
+						break
+					md5.update(data)
+					self._throttle(len(data))
+		except IOError:
+			# md5sum skips unreadable files as well
+			return None
+		digest = md5.hexdigest()
+		self._seen[path] = [st.st_size, st.st_mtime, digest]
+		self.files_hashed += 1
+		return digest
+
+	def _throttle(self, size):
+		self._bytes_read += size
+		if self.io_budget:
+			ahead = self._bytes_read / float(self.io_budget) - (time.time() - self._read_start)
+			if ahead > 0:
+				time.sleep(ahead)
+
+	def _load_cache(self):
+		self._cache = dict()
+		if self.cache_file and os.path.isfile(self.cache_file):
+			try:
+				with open(self.cache_file, 'rb') as f:
+					self._cache = {path.encode('latin-1'): entry for path, entry in json.load(f).iteritems()}
+			except:
+				self._logger.exception("Exception while loading checksum cache %s, hashing all files: ", self.cache_file)
+				self._cache = dict()
+
+	def _save_cache(self):
+		if not self.cache_file:
+			return
+		tmp_fd, tmp_file = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(self.cache_file))
+		try:
+			with os.fdopen(tmp_fd, 'wb') as f:
+				# file names are bytes, latin-1 round trips any of them through json
+				json.dump({path.decode('latin-1'): entry for path, entry in self._cache.iteritems()}, f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(tmp_file, self.cache_file)
+		except:
+			self._logger.exception("Exception while saving checksum cache %s: ", self.cache_file)
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
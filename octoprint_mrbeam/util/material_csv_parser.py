@@ -1,4 +1,4 @@
-import sys, os, csv, json, collections
+import sys, os, csv, json, collections, threading
 import octoprint_mrbeam
 
 MRBEAM = 'Mr Beam II'
@@ -40,17 +40,64 @@ def dict_merge(dct, merge_dct):
 		else:
 			dct[k] = merge_dct[k]
 
+def default_path():
+	return os.path.join(__package_path__, "files/material_settings/materials.csv")
+
+
+# path -> (mtime, size, compiled material settings)
+_compiled = dict()
+_compiled_lock = threading.Lock()
+
+def load_csv(path=None):
+	"""
+	Compiled material settings of all laserheads, see compile_csv().
+	The csv file is compiled only once per mtime. Don't modify the returned dict.
+	:param path: path to csv file
+	:return: (dict, version) version changes whenever the file got compiled again
+	"""
+	path = path or default_path()
+	stat = os.stat(path)
+	with _compiled_lock:
+		entry = _compiled.get(path)
+		if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+			entry = (stat.st_mtime, stat.st_size, compile_csv(path))
+			_compiled[path] = entry
+	return entry[2], (entry[0], entry[1])
+
+def select_laserhead(dictionary, laserhead=MRBEAM):
+	"""
+	:param dictionary: compiled material settings
+	:param laserhead: model id or csv name of the laserhead
+	:return: dict(materials, laser_source) with the material settings to use for that laserhead
+	"""
+	converted_laserhead = model_id_to_csv_name(laserhead)
+	if converted_laserhead:
+		laserhead = converted_laserhead
+	if laserhead not in dictionary:
+		laserhead = DEFAULT_LASER
+	return dict(
+		materials=dictionary.get(laserhead, {}),
+		laser_source=laserhead
+	)
+
 def parse_csv(path = None, laserhead=MRBEAM):
 	"""
+	:param path: path to csv file
+	:param laserhead: the type of laserhead to use. Will return the material settings to use for that laserhead.
+	:return:
+	"""
+	return select_laserhead(compile_csv(path or default_path()), laserhead)
+
+def compile_csv(path):
+	"""
+	Reads the material settings of all laserheads: {laserhead: {material: {'name', 'colors': {color: {'name', 'engrave', 'cut'}}}}}
 
 	Assumes following column order:
 	mrbeamversion, material, colorcode, thickness_or_engrave, intensity, speed, passes, pierce_time, dithering
 
 	:param path: path to csv file
-	:param laserhead: the type of laserhead to use. Will return the material settings to use for that laserhead.
-	:return:
+	:return: dict
 	"""
-	path = path or os.path.join(__package_path__, "files/material_settings/materials.csv")
 	dictionary = {}
 	with open(path, 'r') as f:
 		reader = csv.reader(f)
@@ -135,16 +182,7 @@ def parse_csv(path = None, laserhead=MRBEAM):
                                                                'colors': { current_color: {'name': colorname,
                                                                                        settingname: settings}}}}})
 			prev_vals = [mrbeamversion, current_material, current_color, thickness_or_engrave, intensity, speed, passes, compressor_lvl, pierce_time, dithering] # update current row values for next loop
-	converted_laserhead = model_id_to_csv_name(laserhead)
-	if converted_laserhead:
-		laserhead = converted_laserhead
-	if laserhead not in dictionary:
-		laserhead = DEFAULT_LASER
-	res = dict(
-		materials=dictionary.get(laserhead, {}),
-		laser_source=laserhead
-	)
-	return res
+	return dictionary
 
 
 if __name__ == "__main__":
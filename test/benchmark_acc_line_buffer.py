@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of AccLineBuffer.
+
+Simulates the calls _sendCommand() and _readline() make per command (is_dirty, get_char_len, add,
+acknowledge_cmd, is_empty) with a buffer filled like grbl's rx buffer, and compares the former
+dict / RWLock based implementation with the current one.
+
+usage: python test/benchmark_acc_line_buffer.py [--commands 100000]
+"""
+
+import collections
+import optparse
+import os.path
+import sys
+import time
+
+base = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'octoprint_mrbeam')
+sys.path.insert(0, os.path.join(base, 'printing'))
+sys.path.insert(0, os.path.join(base, 'lib'))
+
+from acc_line_buffer import AccLineBuffer
+from rwlock import RWLock
+
+
+class LegacyAccLineBuffer(object):
+	# the former implementation, reduced to the methods used in this benchmark
+
+	def __init__(self):
+		self._lock = RWLock()
+		self.buffer_cmds = collections.deque()
+		self.declined_cmds = collections.deque()
+		self._last_responded = None
+		self.char_len = -1
+		self.id = 0
+		self.dirty = False
+
+	def add(self, cmd, intensity, feedrate, pos_x, pos_y, laser, sent_ts=None):
+		self._lock.writer_acquire()
+		d = dict(cmd=cmd, i=intensity, f=feedrate, x=pos_x, y=pos_y, l=laser, id=self.id, dirty=self.dirty, sent_ts=sent_ts)
+		self.id += 1
+		self.buffer_cmds.append(d)
+		self.char_len = -1
+		self._lock.writer_release()
+
+	def acknowledge_cmd(self):
+		if self.is_empty():
+			return None
+		self._lock.writer_acquire()
+		self._last_responded = self.buffer_cmds.popleft()
+		self.char_len = -1
+		self._lock.writer_release()
+		return self._last_responded
+
+	def is_dirty(self):
+		if self.dirty:
+			return True
+		res = False
+		self._lock.reader_acquire()
+		for c in self.buffer_cmds:
+			if c['dirty']:
+				res = True
+				break
+		if not res:
+			for c in self.declined_cmds:
+				if c['dirty']:
+					res = True
+					break
+		self._lock.reader_release()
+		return res
+
+	def is_empty(self):
+		self._lock.reader_acquire()
+		res = len(self.buffer_cmds) == 0
+		self._lock.reader_release()
+		return res
+
+	def get_char_len(self):
+		self._lock.reader_acquire()
+		if self.char_len < 0:
+			self.char_len = sum([len(x['cmd']) for x in self.buffer_cmds])
+		res = self.char_len
+		self._lock.reader_release()
+		return res
+
+
+RX_BUFFER_SIZE = 122
+
+
+def run(buffer, commands):
+	cmds = ["G1X{:.4f}Y{:.4f}S{}\n".format(i * 0.1 % 500, i * 0.07 % 390, i % 1000) for i in range(256)]
+	start = time.time()
+	for n in range(commands):
+		cmd = cmds[n % 256]
+		# _readline(): grbl answers 'ok' as soon as its rx buffer is full
+		while buffer.get_char_len() + len(cmd) >= RX_BUFFER_SIZE:
+			buffer.acknowledge_cmd()
+		# _sendCommand()
+		buffer.is_dirty()
+		buffer.get_char_len()
+		buffer.add(cmd, intensity=100, feedrate=1000, pos_x=1.0, pos_y=2.0, laser=True, sent_ts=start)
+		buffer.is_empty()
+	while not buffer.is_empty():
+		buffer.acknowledge_cmd()
+	return time.time() - start
+
+
+if __name__ == "__main__":
+	opts = optparse.OptionParser(usage="usage: %prog [options]")
+	opts.add_option("", "--commands", type="int", default=100000, help="number of commands", dest="commands")
+	(options, args) = opts.parse_args()
+
+	legacy = run(LegacyAccLineBuffer(), options.commands)
+	new = run(AccLineBuffer(), options.commands)
+	print("{:>10} {:>20} {:>20}".format("commands", "legacy [us/command]", "new [us/command]"))
+	print("{:>10} {:>20.2f} {:>20.2f}".format(options.commands, legacy / options.commands * 1e6, new / options.commands * 1e6))
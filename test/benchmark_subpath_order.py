@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the subpath ordering in Converter._parse_curve.
+
+Generates text-heavy SVG fixtures (compound paths made of many small glyph-like subpaths)
+and compares the former O(n^2) nearest neighbour sorting with PathOrderOptimizer.
+
+usage: python test/benchmark_subpath_order.py [--svg-dir DIR] [--sizes 100,1000,5000]
+"""
+
+import optparse
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'octoprint_mrbeam', 'gcodegenerator'))
+
+import cubicsuperpath
+from path_order import PathOrderOptimizer
+
+
+def glyph_path_d(glyph_count, seed=0):
+	"""
+	Path data of text-like outlines: glyphs in lines of 60 characters, each glyph consists of
+	an outer contour and sometimes an inner contour (like 'o', 'e', 'a', ...) and an accent or dot.
+	"""
+	rnd = random.Random(seed)
+	d = []
+	for g in range(glyph_count):
+		x = (g % 60) * 6.0
+		y = (g // 60) * 10.0
+		w = rnd.uniform(3.0, 5.0)
+		h = rnd.uniform(5.0, 7.0)
+		d.append("M {},{} C {},{} {},{} {},{} L {},{} L {},{} Z".format(x, y, x, y + h, x + w, y + h, x + w, y, x + w / 2, y - 1, x, y))
+		if rnd.random() < 0.5:
+			d.append("M {},{} L {},{} L {},{} Z".format(x + 1, y + 1, x + w - 1, y + 1, x + w / 2, y + h - 2))
+		if rnd.random() < 0.2:
+			d.append("M {},{} L {},{}".format(x + w / 2, y + h + 1, x + w / 2 + 0.5, y + h + 2))
+	return " ".join(d)
+
+
+def svg_document(d):
+	return '<svg xmlns="http://www.w3.org/2000/svg" width="400mm" height="400mm"><path d="{}" stroke="#000000" fill="none"/></svg>'.format(d)
+
+
+def legacy_sort(p):
+	# the former implementation of Converter._parse_curve
+	k = range(1,len(p))
+	keys = [0]
+	while len(k)>0:
+		end = p[keys[-1]][-1][1]
+		dist = None
+		for i in range(len(k)):
+			start = p[k[i]][0][1]
+			dist = max(   ( -( ( end[0]-start[0])**2+(end[1]-start[1])**2 ) ,i)	,   dist )
+		keys += [k[dist[1]]]
+		del k[dist[1]]
+	return keys
+
+
+def optimizer_sort(p, two_opt_window):
+	starts = [p[k][0][1] for k in range(1, len(p))]
+	ends = [p[k][-1][1] for k in range(1, len(p))]
+	optimizer = PathOrderOptimizer(two_opt_window=two_opt_window)
+	order = optimizer.sort_reversible(starts, ends, start_pos=p[0][-1][1])
+	return [(0, False)] + [(i + 1, reverse) for i, reverse in order]
+
+
+def rapid_distance(p, keys):
+	starts = [sp[0][1] for sp in p]
+	ends = [sp[-1][1] for sp in p]
+	return PathOrderOptimizer.get_rapid_distance_reversible(keys, starts, ends, start_pos=starts[0])
+
+
+def timed(func, *args):
+	start = time.time()
+	res = func(*args)
+	return res, time.time() - start
+
+
+if __name__ == "__main__":
+	opts = optparse.OptionParser(usage="usage: %prog [options]")
+	opts.add_option("", "--sizes", type="string", default="100,1000,5000", help="glyph counts, comma separated", dest="sizes")
+	opts.add_option("", "--svg-dir", type="string", default=None, help="write the generated SVG fixtures into this folder", dest="svg_dir")
+	opts.add_option("", "--2opt-window", type="int", default=8, help="2-opt window of the optimizer, 0 disables 2-opt", dest="two_opt_window")
+	(options, args) = opts.parse_args()
+
+	print("{:>8} {:>10} {:>12} {:>12} {:>14} {:>14}".format("glyphs", "subpaths", "legacy [s]", "new [s]", "legacy rapid", "new rapid"))
+	for size in [int(s) for s in options.sizes.split(',')]:
+		d = glyph_path_d(size)
+		if options.svg_dir:
+			with open(os.path.join(options.svg_dir, "text_heavy_{}.svg".format(size)), 'w') as fh:
+				fh.write(svg_document(d))
+
+		csp = cubicsuperpath.parsePath(d)
+		legacy_keys, legacy_time = timed(legacy_sort, csp)
+		new_keys, new_time = timed(optimizer_sort, csp, options.two_opt_window)
+		legacy_rapid = rapid_distance(csp, [(k, False) for k in legacy_keys])
+		new_rapid = rapid_distance(csp, new_keys)
+		print("{:>8} {:>10} {:>12.3f} {:>12.3f} {:>14.1f} {:>14.1f}".format(size, len(csp), legacy_time, new_time, legacy_rapid, new_rapid))
@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from octoprint_mrbeam.analytics.analytics_handler import AnalyticsHandler
+from octoprint_mrbeam.analytics.analytics_writer import AnalyticsSegments, AnalyticsFileWriter, read_segment_lines
+
+
+FILENAME = 'analytics_log.json'
+
+
+def make_events(start, count, **extra):
+	events = []
+	for i in range(start, start + count):
+		event = dict(n=i, payload='x' * (i % 50))
+		event.update(extra)
+		events.append(event)
+	return events
+
+
+class AnalyticsSegmentsTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def _read_all(self, segments):
+		lines = []
+		for segment in segments.sealed():
+			lines.extend(read_segment_lines(segments.path(segment)))
+		return [json.loads(line) for line in lines]
+
+	def test_recover_segment_truncated_mid_deflate(self):
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		writer = AnalyticsFileWriter(segments, threading.Lock(), segment_size=10 * 1024 * 1024)
+		complete = []
+		for batch in range(10):
+			events = make_events(batch * 20, 20)
+			writer.write(events)
+			complete.extend(events)
+		path = segments.path(writer._segment)
+		synced_size = os.path.getsize(path)
+
+		# crash in the middle of the deflate stream of the last batch
+		last = make_events(1000, 500)
+		writer.write(last)
+		writer._file.close()
+		with open(path, 'r+b') as f:
+			f.truncate(synced_size + (os.path.getsize(path) - synced_size) / 2)
+
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		self.assertEqual(len(segments.segments), 1)
+		self.assertTrue(segments.segments[0]['sealed'])
+		recovered = self._read_all(segments)
+		# every line written before the last batch, then at most a prefix of the last batch
+		self.assertEqual(recovered[:len(complete)], complete)
+		self.assertEqual(recovered[len(complete):], last[:len(recovered) - len(complete)])
+		self.assertLess(len(recovered), len(complete) + len(last))
+		self.assertEqual(segments.segments[0]['events'], len(recovered))
+
+	def test_recover_unknown_segment(self):
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		writer = AnalyticsFileWriter(segments, threading.Lock(), segment_size=10 * 1024 * 1024)
+		events = make_events(0, 50)
+		writer.write(events)
+		writer._file.close()
+		# index lost, the segment file is still there
+		os.remove(segments.index_file)
+
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		self.assertEqual(self._read_all(segments), events)
+
+	def test_stray_tmp_file_is_removed(self):
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		writer = AnalyticsFileWriter(segments, threading.Lock(), segment_size=10 * 1024 * 1024)
+		events = make_events(0, 50)
+		writer.write(events)
+		writer.seal()
+		segment = segments.sealed()[0]
+		# interrupted rewrite of the segment
+		tmp_file = segments.path(segment) + '.tmp'
+		with open(tmp_file, 'wb') as f:
+			f.write('garbage')
+
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		self.assertFalse(os.path.exists(tmp_file))
+		self.assertEqual(self._read_all(segments), events)
+
+	def test_import_legacy_files(self):
+		old = make_events(0, 30)
+		new = make_events(30, 30)
+		legacy_file = os.path.join(self.folder, FILENAME)
+		for path, events in ((legacy_file + '.1', old), (legacy_file, new)):
+			with open(path, 'wb') as f:
+				for event in events:
+					f.write(json.dumps(event) + '\n')
+
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		# same order as AnalyticsHandler: the rotated file holds the older events
+		for path in (legacy_file + '.1', legacy_file):
+			segments.import_legacy_file(path)
+
+		self.assertFalse(os.path.exists(legacy_file))
+		self.assertFalse(os.path.exists(legacy_file + '.1'))
+		self.assertEqual(len(segments.sealed()), 2)
+		self.assertEqual(self._read_all(segments), old + new)
+		self.assertEqual(segments.total_events(), len(old) + len(new))
+
+		# still there after a restart
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		self.assertEqual(self._read_all(segments), old + new)
+
+	def test_redact_removes_filenames(self):
+		segments = AnalyticsSegments(self.folder, FILENAME)
+		writer = AnalyticsFileWriter(segments, threading.Lock(), segment_size=10 * 1024 * 1024)
+		writer.write(make_events(0, 100, filename='my secret design.svg'))
+		writer.write([dict(n=100, data=dict(filename='other.gco', size=12))])
+		writer.seal()
+		segment = segments.sealed()[0]
+
+		segments.redact(segment, AnalyticsHandler._redact_line)
+
+		lines = list(read_segment_lines(segments.path(segment)))
+		self.assertEqual(len(lines), 101)
+		self.assertEqual(segment['events'], 101)
+		for line in lines:
+			self.assertNotIn('"filename"', line)
+			self.assertNotIn('secret', line)
+		self.assertEqual(lines[-1].count('"size": 12'), 1)
+		self.assertFalse(os.path.exists(segments.path(segment) + '.tmp'))
+
+
+if __name__ == '__main__':
+	unittest.main()
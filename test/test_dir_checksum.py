@@ -0,0 +1,123 @@
+import locale
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mock import patch
+
+from octoprint_mrbeam.util.dir_checksum import DirChecksums
+
+
+LOCALES = ('C', 'POSIX', 'C.UTF-8', 'en_US.UTF-8', 'de_DE.UTF-8')
+
+
+def shell_checksum(folder):
+	# the pipeline DirChecksums replaces, run with the environment of this process
+	cmd = 'find "{folder}" -type f -exec md5sum {{}} \; | sort -k 2 | md5sum'.format(folder=folder)
+	out = subprocess.check_output(cmd, shell=True)
+	return out.replace("  -", '').strip()
+
+
+def locale_available(name):
+	previous = locale.setlocale(locale.LC_COLLATE)
+	try:
+		locale.setlocale(locale.LC_COLLATE, name)
+		return True
+	except locale.Error:
+		return False
+	finally:
+		locale.setlocale(locale.LC_COLLATE, previous)
+
+
+class DirChecksumsTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmp, 'src') + '/'
+		files = [
+			'setup.py',
+			'README.md',
+			'readme.txt',
+			'_private.py',
+			'a-b.py',
+			'a b.py',
+			'ab.py',
+			'A.py',
+			'with space/file one.txt',
+			'with space/file-two.txt',
+			'back\\slash/x\\y.txt',
+			'back\\slash/plain.txt',
+			'new\nline.txt',
+			'pkg/__init__.py',
+			'pkg/sub/module.py',
+			'pkg/sub/deeper/data.json',
+			'pkg/sub-dir/other.py',
+			'pkg.dir/x.py',
+			'\xc3\xa4rger.txt',
+			'empty.txt',
+		]
+		for i, name in enumerate(files):
+			path = os.path.join(self.root, name)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'wb') as f:
+				if name != 'empty.txt':
+					f.write('content of file {}\n'.format(i) * (i + 1))
+		# find -type f doesn't list symlinks
+		os.symlink(os.path.join(self.root, 'setup.py'), os.path.join(self.root, 'link.py'))
+		self.folders = dict(
+			root=self.root,
+			pkg=os.path.join(self.root, 'pkg') + '/',
+			sub=os.path.join(self.root, 'pkg', 'sub') + '/',
+			space=os.path.join(self.root, 'with space') + '/',
+			backslash=os.path.join(self.root, 'back\\slash') + '/',
+		)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_same_as_shell_pipeline(self):
+		tested = 0
+		for name in LOCALES:
+			if not locale_available(name):
+				continue
+			tested += 1
+			with patch.dict(os.environ, LC_ALL=name):
+				checksums = DirChecksums().checksums(self.folders)
+				for key, folder in self.folders.iteritems():
+					self.assertEqual(checksums[key], shell_checksum(folder), msg='{} {}'.format(name, key))
+		self.assertGreater(tested, 0)
+
+	def test_cache(self):
+		cache_file = os.path.join(self.tmp, 'cache.json')
+		dir_checksums = DirChecksums(cache_file=cache_file)
+		first = dir_checksums.checksums(self.folders)
+		self.assertEqual(dir_checksums.files_hashed, dir_checksums.files)
+
+		dir_checksums = DirChecksums(cache_file=cache_file)
+		self.assertEqual(dir_checksums.checksums(self.folders), first)
+		self.assertEqual(dir_checksums.files_hashed, 0)
+
+		path = os.path.join(self.root, 'pkg', 'sub', 'module.py')
+		with open(path, 'ab') as f:
+			f.write('changed\n')
+		os.utime(path, (0, 0))
+		dir_checksums = DirChecksums(cache_file=cache_file)
+		changed = dir_checksums.checksums(self.folders)
+		self.assertEqual(dir_checksums.files_hashed, 1)
+		for key in ('root', 'pkg', 'sub'):
+			self.assertNotEqual(changed[key], first[key])
+			self.assertEqual(changed[key], shell_checksum(self.folders[key]))
+		for key in ('space', 'backslash'):
+			self.assertEqual(changed[key], first[key])
+
+	def test_empty_folder(self):
+		empty = os.path.join(self.tmp, 'empty') + '/'
+		os.makedirs(empty)
+		self.assertEqual(DirChecksums().checksums(dict(empty=empty))['empty'], shell_checksum(empty))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from octoprint_mrbeam.printing.comm_acc2 import PrintingGcodeFromMemoryInformation
+from octoprint_mrbeam.printing.gcode_command_table import GcodeTableReader
+
+
+def slow_lines(count, delay):
+	for i in range(count):
+		time.sleep(delay)
+		yield 'G1X{}Y{}F1000S500\n'.format(i, i)
+
+
+class SlowJob(PrintingGcodeFromMemoryInformation):
+	# a job which compiles slower than it is sent
+
+	def _open_reader(self):
+		return GcodeTableReader(lines=slow_lines(100000, 0.001))
+
+
+def call_in_thread(func):
+	result = []
+	thread = threading.Thread(target=lambda: result.append(func()))
+	thread.daemon = True
+	thread.start()
+	return thread, result
+
+
+class GcodeTableReaderTestCase(unittest.TestCase):
+
+	def test_reads_all_commands(self):
+		lines = ['; comment\n'] + ['G1X{}Y1F1000S500\n'.format(i) for i in range(5000)]
+		reader = GcodeTableReader(lines=lines)
+		commands = []
+		table = reader.next_table()
+		while table is not None:
+			commands.extend(table.get_command(i) for i in range(len(table)))
+			table = reader.next_table()
+		self.assertEqual(commands, [line.strip() for line in lines[1:]])
+		self.assertIsNone(reader.next_table())
+
+	def test_stop_wakes_up_waiting_next_table(self):
+		reader = GcodeTableReader(lines=slow_lines(100000, 0.01))
+		thread, result = call_in_thread(reader.next_table)
+		time.sleep(0.2)
+		self.assertTrue(thread.is_alive())
+		reader.stop()
+		thread.join(2)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(result, [None])
+		self.assertIsNone(reader.next_table())
+
+	def test_close_while_waiting_for_a_chunk(self):
+		job = SlowJob('')
+		job.start()
+		thread, result = call_in_thread(job.getNextIndex)
+		time.sleep(0.2)
+		self.assertTrue(thread.is_alive())
+		job.close()
+		thread.join(2)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(result, [None])
+		self.assertIsNone(job.getNextIndex())
+
+	def test_reset_while_waiting_for_the_next_chunk(self):
+		job = SlowJob('')
+		job.start()
+		# wait for the first chunk, then for the second one
+		self.assertEqual(job.getNextIndex(), 0)
+		job._index = len(job.getTable())
+		thread, result = call_in_thread(job.getNextIndex)
+		time.sleep(0.1)
+		job.resetToBeginning()
+		thread.join(4)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(result, [None])
+		# starts over with a new reader
+		self.assertEqual(job.getNextIndex(), 0)
+		self.assertEqual(job.getTable().get_command(0), 'G1X0Y0F1000S500')
+		job.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+import math
+import random
+import unittest
+
+from octoprint_mrbeam.gcodegenerator.path_order import PathOrderOptimizer, _GridIndex
+
+
+def random_points(rnd, n, clustered=False):
+	if clustered:
+		centers = [(rnd.uniform(0, 500), rnd.uniform(0, 390)) for _ in range(5)]
+		return [(c[0] + rnd.gauss(0, 3), c[1] + rnd.gauss(0, 3)) for c in (rnd.choice(centers) for _ in range(n))]
+	return [(rnd.uniform(0, 500), rnd.uniform(0, 390)) for _ in range(n)]
+
+
+class GridIndexTestCase(unittest.TestCase):
+
+	def _brute_force_nearest(self, points, remaining, x, y):
+		# same tie break as _GridIndex: smallest index
+		return min(remaining, key=lambda i: ((points[i][0] - x) ** 2 + (points[i][1] - y) ** 2, i))
+
+	def test_nearest_matches_brute_force(self):
+		rnd = random.Random(1)
+		for clustered in (False, True):
+			points = random_points(rnd, 300, clustered)
+			remaining = set(range(len(points)))
+			index = _GridIndex(points, remaining)
+			while remaining:
+				# queries inside and outside of the grid
+				x, y = rnd.uniform(-100, 600), rnd.uniform(-100, 500)
+				expected = self._brute_force_nearest(points, remaining, x, y)
+				self.assertEqual(index.nearest(x, y), expected)
+				remaining.discard(expected)
+				index.remove(expected)
+				if index.is_sparse():
+					index.build(index.remaining())
+			self.assertEqual(index.count, 0)
+
+	def test_duplicate_points(self):
+		points = [(1.0, 1.0)] * 5 + [(2.0, 2.0)]
+		index = _GridIndex(points, range(len(points)))
+		self.assertEqual(index.nearest(0.0, 0.0), 0)
+		index.remove(0)
+		self.assertEqual(index.nearest(0.0, 0.0), 1)
+
+
+class PathOrderOptimizerTestCase(unittest.TestCase):
+
+	def _paths(self, seed, n):
+		rnd = random.Random(seed)
+		starts = random_points(rnd, n)
+		ends = [(x + rnd.uniform(-20, 20), y + rnd.uniform(-20, 20)) for x, y in starts]
+		return starts, ends
+
+	def test_sort_is_permutation(self):
+		for two_opt_window in (0, 8):
+			for n in (0, 1, 2, 50, 500):
+				starts, ends = self._paths(n, n)
+				order = PathOrderOptimizer(two_opt_window=two_opt_window).sort(starts, ends)
+				self.assertEqual(sorted(order), range(n))
+
+	def test_sort_reversible_is_permutation(self):
+		for two_opt_window in (0, 8):
+			for n in (0, 1, 2, 50, 500):
+				starts, ends = self._paths(n, n)
+				order = PathOrderOptimizer(two_opt_window=two_opt_window).sort_reversible(starts, ends)
+				self.assertEqual(sorted(i for i, reverse in order), range(n))
+				for i, reverse in order:
+					self.assertIn(reverse, (True, False))
+
+	def test_sort_not_longer_than_input_order(self):
+		for seed in range(5):
+			starts, ends = self._paths(seed, 200)
+			start_pos = (0.0, 0.0)
+			unsorted = PathOrderOptimizer.get_rapid_distance(range(len(starts)), starts, ends, start_pos)
+			for two_opt_window in (0, 8):
+				optimizer = PathOrderOptimizer(two_opt_window=two_opt_window)
+				order = optimizer.sort(starts, ends, start_pos)
+				self.assertLessEqual(optimizer.rapid_distance, unsorted)
+				self.assertAlmostEqual(optimizer.rapid_distance,
+				                       PathOrderOptimizer.get_rapid_distance(order, starts, ends, start_pos))
+
+	def test_sort_reversible_not_longer_than_input_order(self):
+		for seed in range(5):
+			starts, ends = self._paths(seed, 200)
+			start_pos = (250.0, 200.0)
+			unsorted = PathOrderOptimizer.get_rapid_distance_reversible([(i, False) for i in range(len(starts))], starts, ends, start_pos)
+			for two_opt_window in (0, 8):
+				optimizer = PathOrderOptimizer(two_opt_window=two_opt_window)
+				order = optimizer.sort_reversible(starts, ends, start_pos)
+				self.assertLessEqual(optimizer.rapid_distance, unsorted)
+				self.assertAlmostEqual(optimizer.rapid_distance,
+				                       PathOrderOptimizer.get_rapid_distance_reversible(order, starts, ends, start_pos))
+
+	def test_two_opt_does_not_make_it_worse(self):
+		for seed in range(5):
+			starts, ends = self._paths(seed, 300)
+			nearest_neighbour = PathOrderOptimizer(two_opt_window=0)
+			nearest_neighbour.sort_reversible(starts, ends)
+			two_opt = PathOrderOptimizer(two_opt_window=8)
+			two_opt.sort_reversible(starts, ends)
+			self.assertLessEqual(two_opt.rapid_distance, nearest_neighbour.rapid_distance + 1e-9)
+
+	def test_reversed_path_is_entered_at_its_end(self):
+		# the end of the path is right next to the start position
+		starts = [(100.0, 100.0)]
+		ends = [(1.0, 1.0)]
+		optimizer = PathOrderOptimizer()
+		self.assertEqual(optimizer.sort_reversible(starts, ends), [(0, True)])
+		self.assertAlmostEqual(optimizer.rapid_distance, math.hypot(1.0, 1.0))
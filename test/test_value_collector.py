@@ -0,0 +1,87 @@
+import bisect
+import random
+import unittest
+
+import numpy as np
+
+from octoprint_mrbeam.analytics.value_collector import QuantileSketch, ValueCollector
+
+
+class ValueCollectorTestCase(unittest.TestCase):
+
+	def _expected_summary(self, values):
+		return dict(
+			median=round(np.percentile(values, 50), 4),
+			mean=round(np.mean(values), 4),
+			min=round(np.min(values), 4),
+			max=round(np.max(values), 4),
+			std=round(np.std(values), 4),
+			count=len(values),
+			**{'25p': round(np.percentile(values, 25), 4), '75p': round(np.percentile(values, 75), 4)}
+		)
+
+	def test_summary_matches_numpy_up_to_k_samples(self):
+		rnd = random.Random(1)
+		# below and exactly at the size of the sketch
+		for n in (1, 2, 3, 10, QuantileSketch.DEFAULT_SIZE - 1, QuantileSketch.DEFAULT_SIZE):
+			values = [rnd.uniform(0, 100) for _ in range(n)]
+			collector = ValueCollector('test')
+			for value in values:
+				collector.addValue(value)
+			summary = collector.getSummary()
+			expected = self._expected_summary(values)
+			for key in expected:
+				self.assertAlmostEqual(summary[key], expected[key], places=3, msg='n={} {}'.format(n, key))
+
+	def test_sketch_exact_up_to_k_samples(self):
+		rnd = random.Random(2)
+		k = QuantileSketch.DEFAULT_SIZE
+		values = [rnd.gauss(0, 1) for _ in range(k)]
+		# one by one and in batches
+		added, extended = QuantileSketch(), QuantileSketch()
+		for value in values:
+			added.add(value)
+		extended.extend(values[:k // 2])
+		extended.extend(values[k // 2:])
+		for sketch in (added, extended):
+			self.assertTrue(sketch.is_exact())
+			for q in (0, .01, .25, .5, .75, .99, 1):
+				self.assertAlmostEqual(sketch.quantile(q), np.percentile(values, q * 100))
+		added.add(0.0)
+		self.assertFalse(added.is_exact())
+
+	def test_rank_error_is_bounded(self):
+		rnd = random.Random(3)
+		n = 100000
+		for values in ([rnd.uniform(0, 1) for _ in range(n)],
+		               [rnd.expovariate(1) for _ in range(n)],
+		               range(n)):
+			sketch = QuantileSketch()
+			for i in range(0, n, ValueCollector.BATCH_SIZE):
+				sketch.extend(values[i:i + ValueCollector.BATCH_SIZE])
+			self.assertEqual(sketch.count, n)
+			self.assertLess(sum(len(level) for level in sketch.levels), 20 * QuantileSketch.DEFAULT_SIZE)
+			ordered = sorted(values)
+			for q in (.01, .1, .25, .5, .75, .9, .99):
+				value = sketch.quantile(q)
+				rank = (bisect.bisect_left(ordered, value) + bisect.bisect_right(ordered, value)) / 2.0
+				self.assertLess(abs(rank - q * n), .02 * n, msg='q={}'.format(q))
+
+	def test_merge_keeps_rank_error_bounded(self):
+		rnd = random.Random(4)
+		values = [rnd.uniform(0, 1) for _ in range(50000)]
+		merged = ValueCollector('merged')
+		for i in range(0, len(values), 5000):
+			part = ValueCollector('part')
+			for value in values[i:i + 5000]:
+				part.addValue(value)
+			merged.merge(part)
+		summary = merged.getSummary()
+		self.assertEqual(summary['count'], len(values))
+		self.assertAlmostEqual(summary['mean'], np.mean(values), places=3)
+		for key, q in (('25p', 25), ('median', 50), ('75p', 75)):
+			self.assertAlmostEqual(summary[key], np.percentile(values, q), delta=.02)
+
+
+if __name__ == '__main__':
+	unittest.main()